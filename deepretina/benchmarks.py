@@ -0,0 +1,376 @@
+"""
+Throughput benchmarks for the training and inference paths
+
+Each workload is run on synthetic white noise data, for every combination of
+batch size and stimulus size, and reports:
+
+- `samples_per_second`: throughput over a few timed repetitions
+- `peak_rss_delta_mb`: peak resident memory of the process while the case ran,
+  above the resident memory just before it (sampled, so short spikes can be missed)
+- `traced_peak_mb`: peak memory allocated (through Python and numpy) during one repetition
+- `new_blocks`: number of allocated memory blocks still alive after one repetition
+
+Results are appended, tagged with the current git commit, to a JSON lines file,
+so that `compare` can show regressions between commits.
+
+Usage
+-----
+$ python -m deepretina.benchmarks --batchsizes 100 500 --sizes 20 50
+$ python -m deepretina.benchmarks --compare
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import io
+import json
+import shutil
+import argparse
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+from collections import namedtuple, OrderedDict
+from time import time, strftime
+from warnings import warn
+import numpy as np
+import h5py
+import tableprint as tp
+from . import experiments
+from .experiments import Experiment, BatchBuilder
+from .profiling import Progress
+from .utils import allmetrics
+
+__all__ = ['run', 'compare', 'WORKLOADS']
+
+RESULTS_FILE = os.path.expanduser('~/deep-retina-results/benchmarks.jsonl')
+
+# a workload is set up for a given case, and returns a function that runs one
+# repetition and returns the number of samples it processed
+Case = namedtuple('Case', ('experiment', 'batchsize', 'size', 'history', 'ncells'))
+
+
+def _batching(case):
+    """One epoch of training batches from Experiment.train"""
+    builder = BatchBuilder()
+
+    def step():
+        return sum(X.shape[0] for X, _ in case.experiment.train(shuffle=True, builder=builder))
+    return step
+
+
+def _glm(case):
+    """GLM.train_on_batch on a single batch"""
+    from .glms import GLM
+    model = GLM((case.history, case.size, case.size), 5, case.ncells)
+    X, y = case.experiment.batch(0)
+    X, y = np.array(X), np.array(y)
+
+    def step():
+        model.train_on_batch(X, y)
+        return X.shape[0]
+    return step
+
+
+def _keras(name):
+    """One epoch of core.train for the given model from the models module"""
+    def workload(case):
+        from .core import train
+        from . import models
+
+        input_shape = (case.history, case.size, case.size)
+        if name == 'nips_conv':
+            if input_shape != (40, 50, 50):
+                return None
+            layers = models.nips_conv(case.ncells)
+        else:
+            layers = getattr(models, name)(input_shape, case.ncells)
+        model = models.sequential(layers, 'adam', loss='poisson')
+        nsamples = sum(inds.size for _, inds in case.experiment.get_split()[0])
+
+        def step():
+            with contextlib.redirect_stdout(io.StringIO()):
+                train(model, case.experiment, None, 1, progress=Progress(stream=None))
+            return nsamples
+        return step
+    return workload
+
+
+def _test(case):
+    """Experiment.test with a cheap model (no cached predictions)"""
+    def modelrate(data):
+        X = data['stim']
+        rate = np.exp(0.01 * X.reshape(X.shape[0], -1).mean(axis=1))
+        return {'loss': np.repeat(rate[:, np.newaxis], case.ncells, axis=1)}
+
+    nsamples = sum(data.y.shape[0] for data in case.experiment._test_data.values())
+
+    def step():
+        case.experiment.test(modelrate, ('cc', 'lli', 'rmse', 'fev'))
+        return nsamples
+    return step
+
+
+def _allmetrics(case):
+    """utils.allmetrics on a batch of responses"""
+    r = np.random.rand(case.batchsize, case.ncells)
+    rhat = {'loss': np.random.rand(case.batchsize, case.ncells)}
+
+    def step():
+        allmetrics(r, rhat, ('cc', 'lli', 'rmse', 'fev'))
+        return case.batchsize
+    return step
+
+
+WORKLOADS = OrderedDict([
+    ('batching', _batching),
+    ('glm', _glm),
+    ('train_ln', _keras('ln')),
+    ('train_convnet', _keras('convnet')),
+    ('train_nips_conv', _keras('nips_conv')),
+    ('test', _test),
+    ('allmetrics', _allmetrics),
+])
+
+
+def run(workloads=None, batchsizes=(100, 500), sizes=(20, 50), repeats=3, history=40, ncells=4,
+        nframes=5000, results_file=RESULTS_FILE):
+    """Runs the benchmarks and appends the results to results_file
+
+    Parameters
+    ----------
+    workloads : list of strings, optional
+        Which of the WORKLOADS to run (Default: all of them)
+
+    batchsizes : list of ints, optional
+        Batch sizes to benchmark (Default: (100, 500))
+
+    sizes : list of ints, optional
+        Spatial sizes (width and height) of the synthetic stimulus (Default: (20, 50))
+
+    repeats : int, optional
+        Number of timed repetitions of each workload (Default: 3)
+
+    history : int, optional
+        Number of frames of stimulus history (Default: 40)
+
+    ncells : int, optional
+        Number of cells in the synthetic experiment (Default: 4)
+
+    nframes : int, optional
+        Number of frames in the synthetic training stimulus (Default: 5000)
+
+    results_file : string, optional
+        JSON lines file to append the results to (Default: RESULTS_FILE). If
+        None, the results are only returned
+
+    Returns
+    -------
+    results : list of dicts
+    """
+    workloads = workloads or list(WORKLOADS.keys())
+    commit = _commit()
+    results = []
+
+    print(tp.header(['Workload', 'Batch size', 'Size', 'Samples/s', 'Peak dRSS (MB)', 'Traced (MB)']), flush=True)
+    with _synthetic(sizes, nframes, ncells) as expt:
+        for size in sizes:
+            for batchsize in batchsizes:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    data = Experiment(expt, list(range(ncells)), ['whitenoise{}'.format(size)],
+                                      ['whitenoise{}'.format(size)], history, batchsize, nskip=0)
+                case = Case(data, batchsize, size, history, ncells)
+
+                for name in workloads:
+                    try:
+                        result = _measure(WORKLOADS[name], case, repeats)
+                    except ImportError as error:
+                        warn('Skipping the {} benchmark ({})'.format(name, error))
+                        continue
+                    if result is None:
+                        continue
+
+                    result.update(workload=name, batchsize=batchsize, size=size, history=history,
+                                  commit=commit, date=strftime('%Y-%m-%d %H:%M:%S'))
+                    results.append(result)
+                    print(tp.row([name, batchsize, size, result['samples_per_second'], result['peak_rss_delta_mb'],
+                                  result['traced_peak_mb']]), flush=True)
+    print(tp.bottom(6))
+
+    if results_file is not None:
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+        with open(results_file, 'a') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+
+    return results
+
+
+def compare(results_file=RESULTS_FILE, base=None, head=None):
+    """Compares the throughput of two commits
+
+    Parameters
+    ----------
+    results_file : string, optional
+        JSON lines file written by `run` (Default: RESULTS_FILE)
+
+    base, head : string, optional
+        The commits to compare (Default: the last two commits in the file)
+
+    Returns
+    -------
+    ratios : dict
+        head / base throughput for each (workload, batchsize, size)
+    """
+    with open(results_file, 'r') as f:
+        results = [json.loads(line) for line in f if line.strip()]
+
+    commits = list(OrderedDict.fromkeys(result['commit'] for result in results))
+    assert len(commits) >= 2 or (base and head), "need results from two commits to compare"
+    base = base or commits[-2]
+    head = head or commits[-1]
+
+    # the most recent result for each case
+    throughput = {base: {}, head: {}}
+    for result in results:
+        if result['commit'] in throughput:
+            key = (result['workload'], result['batchsize'], result['size'])
+            throughput[result['commit']][key] = result['samples_per_second']
+
+    ratios = {}
+    print(tp.header(['Workload', 'Batch size', 'Size', base[:11], head[:11], 'Ratio']), flush=True)
+    for key in sorted(set(throughput[base]) & set(throughput[head])):
+        ratios[key] = throughput[head][key] / throughput[base][key]
+        print(tp.row(list(key) + [throughput[base][key], throughput[head][key], ratios[key]]), flush=True)
+    print(tp.bottom(6))
+
+    return ratios
+
+
+def _measure(workload, case, repeats):
+    """Times a workload, and measures its memory use"""
+    with _rss_sampler() as rss:
+        step = workload(case)
+        if step is None:
+            return None
+
+        # warm up (e.g. compilation, page cache)
+        step()
+
+        tstart = time()
+        nsamples = sum(step() for _ in range(repeats))
+        elapsed = time() - tstart
+
+    # trace allocations separately, since tracing slows everything down
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    step()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'samples_per_second': nsamples / elapsed,
+        'peak_rss_delta_mb': rss['peak_delta'] / 2 ** 20 if rss['peak_delta'] is not None else None,
+        'traced_peak_mb': peak / 2 ** 20,
+        'new_blocks': sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'lineno')),
+    }
+
+
+def _current_rss():
+    """The current resident memory of this process, in bytes (None if it can not be read)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+@contextlib.contextmanager
+def _rss_sampler(interval=0.005):
+    """Samples the resident memory in a background thread, and stores the peak above the starting value
+
+    (ru_maxrss can not be used, since it is the peak over the lifetime of the process)
+    """
+    result = {'peak_delta': None}
+    baseline = _current_rss()
+    if baseline is None:
+        yield result
+        return
+
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], _current_rss())
+
+    sampler = threading.Thread(target=sample, name='rss_sampler', daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        sampler.join()
+        result['peak_delta'] = max(peak[0], _current_rss()) - baseline
+
+
+@contextlib.contextmanager
+def _synthetic(sizes, nframes, ncells, ntest=1000):
+    """Writes a synthetic white noise experiment (one file per stimulus size) to a temporary directory
+
+    HOME points at the temporary directory while the experiment is in use, so that
+    `experiments._datapath` finds the synthetic files, and the directory is removed afterwards.
+    """
+    expt = 'benchmark'
+    home = tempfile.mkdtemp(prefix='deepretina-benchmark-')
+    previous_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    experiments.NUM_BLOCKS[expt] = 1
+
+    try:
+        os.makedirs(os.path.dirname(experiments._datapath(expt, '')))
+        for size in sizes:
+            with h5py.File(experiments._datapath(expt, 'whitenoise{}'.format(size)), 'w') as f:
+                for split, n in (('train', nframes), ('test', ntest)):
+                    group = f.create_group(split)
+                    group['time'] = np.arange(n) * experiments.dt
+                    group['stimulus'] = np.random.randint(2, size=(n, size, size)).astype('uint8') * 255
+                    group['response/firing_rate_10ms'] = np.random.rand(ncells, n)
+        yield expt
+
+    finally:
+        if previous_home is None:
+            os.environ.pop('HOME')
+        else:
+            os.environ['HOME'] = previous_home
+        experiments.NUM_BLOCKS.pop(expt)
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def _commit():
+    """The git commit of the deep-retina source"""
+    try:
+        output = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL)
+        return str(output, 'utf-8').strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='deep-retina throughput benchmarks on synthetic data')
+    parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS.keys()), help='workloads to run')
+    parser.add_argument('--batchsizes', nargs='+', type=int, default=[100, 500], help='batch sizes')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[20, 50], help='stimulus widths (pixels)')
+    parser.add_argument('--repeats', type=int, default=3, help='timed repetitions of each workload')
+    parser.add_argument('--results', default=RESULTS_FILE, help='JSON lines file to store results in')
+    parser.add_argument('--compare', action='store_true', help='compare the last two commits in the results file')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+    else:
+        run(args.workloads, args.batchsizes, args.sizes, args.repeats, results_file=args.results)
@@ -0,0 +1,136 @@
+"""
+On-disk cache of preprocessed experiment data
+
+Preprocessed (clipped and z-scored) stimuli and responses are stored as float32
+.npy files, so that subsequent loads of the same experiment can memory-map them
+directly. The least recently used entries are evicted once the cache grows beyond
+`MAX_CACHE_SIZE` bytes.
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+__all__ = ['cachekey', 'load_cached', 'store_cached', 'evict']
+
+CACHE_DIR = os.path.expanduser('~/experiments/cache')
+MAX_CACHE_SIZE = 100 * 2 ** 30
+
+
+def cachekey(expt, filename, train_or_test, cells, nskip, zscore_flag, mtime):
+    """Generates a key identifying a preprocessed experiment
+
+    Parameters
+    ----------
+    expt, filename, train_or_test, cells, nskip, zscore_flag
+        The arguments passed to `experiments.loadexpt`
+
+    mtime : float
+        Modification time of the experiment file (changes invalidate the cache)
+    """
+    params = (expt, filename, train_or_test, list(np.atleast_1d(cells)), nskip, bool(zscore_flag), mtime)
+    return hashlib.md5(repr(params).encode('ascii')).hexdigest()
+
+
+def load_cached(key):
+    """Memory-maps the cached stimulus and response for the given key
+
+    Returns
+    -------
+    (stimulus, response) or None, if the key is not in the cache
+    """
+    entry = os.path.join(CACHE_DIR, key)
+    if not os.path.isdir(entry):
+        return None
+
+    stim = np.load(os.path.join(entry, 'stimulus.npy'), mmap_mode='r')
+    resp = np.load(os.path.join(entry, 'response.npy'), mmap_mode='r')
+
+    # mark this entry as recently used
+    os.utime(entry)
+
+    return stim, resp
+
+
+def store_cached(key, frames, shape, response):
+    """Writes a preprocessed stimulus and response to the cache
+
+    Parameters
+    ----------
+    key : string
+        Cache key (see `cachekey`)
+
+    frames : iterable
+        Chunks of preprocessed stimulus frames, concatenated along the first axis
+
+    shape : tuple
+        The shape of the full (concatenated) stimulus
+
+    response : array_like
+        The preprocessed response, with shape (# of samples, # of cells)
+
+    Returns
+    -------
+    (stimulus, response), memory-mapped from the cache
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    # write into a temporary directory first, so that readers never see partial entries
+    tmpdir = tempfile.mkdtemp(dir=CACHE_DIR, prefix='.tmp-')
+    try:
+        stim = np.lib.format.open_memmap(os.path.join(tmpdir, 'stimulus.npy'), mode='w+',
+                                         dtype='float32', shape=shape)
+        offset = 0
+        for chunk in frames:
+            stim[offset:offset + chunk.shape[0]] = chunk
+            offset += chunk.shape[0]
+        assert offset == shape[0], "The frames do not match the given shape"
+        stim.flush()
+        del stim
+
+        np.save(os.path.join(tmpdir, 'response.npy'), np.ascontiguousarray(response, dtype='float32'))
+        os.rename(tmpdir, os.path.join(CACHE_DIR, key))
+
+    except OSError:
+        # another process may have stored the same entry in the meantime
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        if not os.path.isdir(os.path.join(CACHE_DIR, key)):
+            raise
+
+    evict(MAX_CACHE_SIZE, keep=(key,))
+    return load_cached(key)
+
+
+def evict(max_size, keep=()):
+    """Removes the least recently used entries until the cache is smaller than max_size bytes
+
+    Parameters
+    ----------
+    max_size : int
+        The maximum total size of the cache, in bytes
+
+    keep : iterable, optional
+        Keys that should never be evicted
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+
+    # size and last access time of every entry
+    entries = []
+    for key in os.listdir(CACHE_DIR):
+        entry = os.path.join(CACHE_DIR, key)
+        if key.startswith('.') or not os.path.isdir(entry):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(entry), size, key))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_size:
+            break
+        if key not in keep:
+            shutil.rmtree(os.path.join(CACHE_DIR, key), ignore_errors=True)
+            total -= size
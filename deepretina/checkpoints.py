@@ -0,0 +1,354 @@
+"""
+Full-state training checkpoints
+
+A checkpoint stores everything needed to resume training mid-epoch: the model
+weights, the optimizer state, the epoch / iteration counters, the order of the
+batches in the current epoch and the position within it, the numpy random state,
+the experiment's train / validation split, and the state of the monitor (its
+results directory, best iteration and save schedule) and plateau schedule.
+
+A `WeightStore` keeps a history of weight snapshots (e.g. every save of a
+Monitor), storing each distinct weight array once, compressed, and pruning old
+snapshots according to a retention policy.
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import io
+import json
+import hashlib
+from collections import namedtuple
+import numpy as np
+import h5py
+from .utils import get_weights, set_weights, get_learning_rate, set_learning_rate
+
+__all__ = ['save_checkpoint', 'load_checkpoint', 'TrainingState', 'WeightStore']
+
+TrainingState = namedtuple('TrainingState', ('epoch', 'iteration', 'order', 'position', 'stopped'))
+
+
+def save_checkpoint(filepath, model, experiment, state, monitor=None, plateau=None):
+    """Saves the full training state to an hdf5 file
+
+    The file is written next to filepath first and then moved into place, so an
+    interruption while saving never corrupts an existing checkpoint.
+
+    Parameters
+    ----------
+    filepath : string
+        Where to save the checkpoint
+
+    model : keras.models.Model or glms.GLM
+        The model being trained
+
+    experiment : experiments.Experiment or experiments.ShardedExperiment
+        The experiment the model is trained on
+
+    state : TrainingState
+        The current epoch and iteration, the batch order of the current epoch, the
+        number of batches of that order that have been trained on, and whether
+        training was stopped early
+
+    monitor : io.Monitor, optional
+        If given, its state (results directory, best iteration, save schedule) is saved
+
+    plateau : schedules.Plateau, optional
+        If given, its state is saved
+    """
+    tmppath = filepath + '.tmp'
+    with h5py.File(tmppath, 'w') as f:
+
+        # training progress
+        f.attrs['epoch'] = state.epoch
+        f.attrs['iteration'] = state.iteration
+        f.attrs['position'] = state.position
+        f.attrs['stopped'] = state.stopped
+        f['order'] = np.asarray(state.order, dtype='int64')
+
+        # model and optimizer
+        _save_arrays(f.create_group('weights'), get_weights(model))
+        if hasattr(model, 'optimizer'):
+            group = f.create_group('optimizer')
+            _save_arrays(group, [np.array(v) for v in model.optimizer.get_state()])
+            group.attrs['lr'] = get_learning_rate(model)
+        else:
+            _save_attributes(f.create_group('opt'), model.opt)
+
+        # random number generator
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        f['rng'] = keys
+        f['rng'].attrs.update(name=name, pos=pos, has_gauss=has_gauss, cached_gaussian=cached_gaussian)
+
+        # train / validation split (the batches of indices are concatenated, since either split may be empty)
+        for name, batches in zip(('train', 'validation'), experiment.get_split()):
+            group = f.create_group('split/' + name)
+            group['keys'] = np.array([json.dumps(key) for key, _ in batches], dtype='S')
+            group['lengths'] = np.array([len(inds) for _, inds in batches], dtype='int64')
+            group['indices'] = np.concatenate([np.asarray(inds, dtype='int64') for _, inds in batches] or
+                                              [np.zeros(0, dtype='int64')])
+
+        # monitoring and learning rate schedule
+        if monitor is not None:
+            f.attrs['monitor'] = json.dumps(monitor.get_state())
+        if plateau is not None:
+            f.attrs['plateau'] = json.dumps(plateau.get_state())
+
+    os.replace(tmppath, filepath)
+
+
+def load_checkpoint(filepath, model, experiment, monitor=None, plateau=None):
+    """Restores the training state saved with `save_checkpoint`
+
+    Sets the model weights, optimizer state, numpy random state and the
+    experiment's train / validation split, and the state of the monitor and
+    plateau schedule (if given, and saved in the checkpoint).
+
+    Returns
+    -------
+    state : TrainingState
+        The epoch, iteration, batch order and position to resume training from
+    """
+    with h5py.File(filepath, 'r') as f:
+
+        set_weights(model, _load_arrays(f['weights']))
+        if 'optimizer' in f:
+            model.optimizer.set_state(_load_arrays(f['optimizer']))
+            if 'lr' in f['optimizer'].attrs:
+                set_learning_rate(model, float(f['optimizer'].attrs['lr']))
+        else:
+            _load_attributes(f['opt'], model.opt)
+
+        attrs = f['rng'].attrs
+        np.random.set_state((attrs['name'], np.array(f['rng']), int(attrs['pos']),
+                             int(attrs['has_gauss']), float(attrs['cached_gaussian'])))
+
+        split = []
+        for name in ('train', 'validation'):
+            group = f['split'][name]
+            keys = [_tuplify(json.loads(key.decode('utf-8'))) for key in group['keys']]
+            indices = np.array(group['indices'])
+            batches = np.split(indices, np.cumsum(group['lengths'][()])[:-1]) if len(keys) > 0 else []
+            split.append(list(zip(keys, batches)))
+        experiment.set_split(*split)
+
+        if monitor is not None and 'monitor' in f.attrs:
+            monitor.set_state(json.loads(f.attrs['monitor']))
+        if plateau is not None and 'plateau' in f.attrs:
+            plateau.set_state(json.loads(f.attrs['plateau']))
+
+        return TrainingState(int(f.attrs['epoch']), int(f.attrs['iteration']), np.array(f['order']),
+                             int(f.attrs['position']), bool(f.attrs.get('stopped', False)))
+
+
+class WeightStore(object):
+    def __init__(self, directory, keep_last=None, keep_every=None):
+        """A content-addressed store of compressed weight snapshots
+
+        Every weight array is stored once, compressed, in `blobs/<sha1>.npz`, no
+        matter how many snapshots contain it (e.g. layers that are frozen or did
+        not change between saves). Each snapshot is a small JSON manifest in
+        `snapshots/`, listing the blobs of its weights, so any snapshot can be
+        restored without reading any of the others.
+
+        Parameters
+        ----------
+        directory : string
+            Where to keep the store (created if it does not exist). An existing
+            store is reopened, so snapshots survive a restart.
+
+        keep_last : int, optional
+            If given, only this many of the most recent snapshots are kept, along
+            with those kept by `keep_every` (Default: None, keep every snapshot)
+
+        keep_every : int, optional
+            Also keep every Nth snapshot (Default: None)
+
+        Notes
+        -----
+        Snapshots are only deleted if `keep_last` is given. The snapshot marked as
+        the best one is always kept, and blobs that are no longer referenced by any
+        snapshot are deleted.
+        """
+        assert keep_last is None or keep_last >= 1, "keep_last must be at least 1"
+
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'snapshots'), exist_ok=True)
+
+        # manifests of the stored snapshots, by iteration
+        self.manifests = {}
+        for filename in os.listdir(os.path.join(directory, 'snapshots')):
+            if filename.endswith('.json'):
+                with open(os.path.join(directory, 'snapshots', filename), 'r') as f:
+                    manifest = json.load(f)
+                self.manifests[manifest['iteration']] = manifest
+
+        self.best = max((m['iteration'] for m in self.manifests.values() if m.get('best')), default=None)
+        self.count = max((m['index'] + 1 for m in self.manifests.values()), default=0)
+
+    def iterations(self):
+        """The iterations of the stored snapshots, in order"""
+        return sorted(self.manifests.keys())
+
+    def save(self, weights, epoch, iteration, best=False):
+        """Stores a snapshot of the given weights (see utils.get_weights)
+
+        Parameters
+        ----------
+        weights : list or dict of arrays
+            The weights of a Keras model (list) or GLM (dict)
+
+        epoch, iteration : int
+            The epoch and iteration of this snapshot
+
+        best : boolean, optional
+            Whether this is the best snapshot so far, which is always kept (Default: False)
+        """
+        names = sorted(weights.keys()) if isinstance(weights, dict) else None
+        arrays = [weights[name] for name in names] if names is not None else list(weights)
+
+        manifest = {
+            'epoch': int(epoch),
+            'iteration': int(iteration),
+            'index': self.count,
+            'best': bool(best),
+            'names': names,
+            'blobs': [self._store_blob(np.asarray(array)) for array in arrays],
+        }
+        self._write(os.path.join(self.directory, 'snapshots', 'iter{:08d}.json'.format(iteration)),
+                    json.dumps(manifest).encode('ascii'))
+        self.manifests[manifest['iteration']] = manifest
+        self.count += 1
+
+        if best:
+            if self.best is not None and self.best != manifest['iteration'] and self.best in self.manifests:
+                self._update_manifest(self.best, best=False)
+            self.best = manifest['iteration']
+
+        self.prune()
+
+    def load(self, iteration=None):
+        """Loads the weights of a snapshot
+
+        Parameters
+        ----------
+        iteration : int or 'best', optional
+            Which snapshot to load (Default: the most recent one)
+
+        Returns
+        -------
+        weights : list or dict of arrays
+            In the format that was saved (see utils.set_weights)
+        """
+        if iteration is None:
+            iteration = self.iterations()[-1]
+        elif iteration == 'best':
+            iteration = self.best
+        assert iteration in self.manifests, "no snapshot for iteration {}".format(iteration)
+
+        manifest = self.manifests[iteration]
+        arrays = [self._load_blob(key) for key in manifest['blobs']]
+        if manifest['names'] is not None:
+            return dict(zip(manifest['names'], arrays))
+        return arrays
+
+    def restore(self, model, iteration=None):
+        """Sets the weights of a Keras or GLM model to those of a snapshot (see `load`)"""
+        set_weights(model, self.load(iteration))
+
+    def prune(self):
+        """Deletes the snapshots that fall outside of the retention policy, and unreferenced blobs"""
+        # without a limit on the number of snapshots, everything is kept
+        if self.keep_last is None:
+            return
+
+        iterations = self.iterations()
+        keep = set(iterations[-self.keep_last:])
+        if self.best is not None:
+            keep.add(self.best)
+        if self.keep_every:
+            keep.update(i for i in iterations if self.manifests[i]['index'] % self.keep_every == 0)
+
+        for iteration in iterations:
+            if iteration not in keep:
+                os.remove(os.path.join(self.directory, 'snapshots', 'iter{:08d}.json'.format(iteration)))
+                del self.manifests[iteration]
+
+        # garbage collect blobs
+        referenced = set(key for manifest in self.manifests.values() for key in manifest['blobs'])
+        for filename in os.listdir(os.path.join(self.directory, 'blobs')):
+            if filename.endswith('.npz') and filename[:-4] not in referenced:
+                os.remove(os.path.join(self.directory, 'blobs', filename))
+
+    def _store_blob(self, array):
+        """Stores a compressed array, unless an identical one is already stored, and returns its key"""
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha1()
+        digest.update(str((array.shape, array.dtype.str)).encode('ascii'))
+        digest.update(array.data)
+        key = digest.hexdigest()
+
+        filepath = os.path.join(self.directory, 'blobs', key + '.npz')
+        if not os.path.exists(filepath):
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, array=array)
+            self._write(filepath, buffer.getvalue())
+
+        return key
+
+    def _load_blob(self, key):
+        with np.load(os.path.join(self.directory, 'blobs', key + '.npz')) as data:
+            return data['array']
+
+    def _update_manifest(self, iteration, **changes):
+        self.manifests[iteration].update(changes)
+        self._write(os.path.join(self.directory, 'snapshots', 'iter{:08d}.json'.format(iteration)),
+                    json.dumps(self.manifests[iteration]).encode('ascii'))
+
+    @staticmethod
+    def _write(filepath, contents):
+        """Writes a file atomically"""
+        with open(filepath + '.tmp', 'wb') as f:
+            f.write(contents)
+        os.replace(filepath + '.tmp', filepath)
+
+
+def _save_arrays(group, arrays):
+    """Stores a list or dictionary of arrays in an hdf5 group"""
+    group.attrs['type'] = 'dict' if isinstance(arrays, dict) else 'list'
+    items = arrays.items() if isinstance(arrays, dict) else (('{:04d}'.format(i), a) for i, a in enumerate(arrays))
+    for key, value in items:
+        group[key] = value
+
+
+def _save_attributes(group, obj):
+    """Stores the array and scalar attributes of an object (e.g. a descent optimizer) in an hdf5 group"""
+    for key, value in vars(obj).items():
+        if isinstance(value, np.ndarray):
+            group[key] = value
+        elif isinstance(value, (bool, int, float, np.number, np.bool_)):
+            group.attrs[key] = value
+
+
+def _load_attributes(group, obj):
+    """Sets the attributes of an object stored with `_save_attributes`"""
+    for key, value in group.items():
+        setattr(obj, key, np.array(value))
+    for key, value in group.attrs.items():
+        setattr(obj, key, value.item() if isinstance(value, np.generic) else value)
+
+
+def _load_arrays(group):
+    """Loads a list or dictionary of arrays stored with `_save_arrays`"""
+    arrays = {key: np.array(value) for key, value in group.items()}
+    if group.attrs['type'] == 'dict':
+        return arrays
+    return [arrays[key] for key in sorted(arrays.keys())]
+
+
+def _tuplify(key):
+    """JSON turns tuples (e.g. shard keys) into lists"""
+    return tuple(key) if isinstance(key, list) else key
@@ -0,0 +1,126 @@
+"""
+Export experiments to a compact, memory-mappable training format
+
+Each experiment (e.g. '15-10-07/whitenoise') is converted into a directory in
+`experiments.COMPACT_DIR` containing, for each of the 'train' and 'test' splits:
+
+- `<split>_stimulus.npy`: stimulus frames, quantized to uint8 or float16
+- `<split>_rates.npy`: float32 firing rates, with shape (# of samples, # of cells)
+- `<split>_blocks.npy`: (start, stop) frame indices of each stimulus block
+
+as well as the training stimulus statistics (`mean.npy`, `std.npy`) and an
+`info.json` file with the quantization parameters. These files are read by
+`experiments.loadcompact`, e.g. through `Experiment(..., compact=True)`.
+
+Usage
+-----
+$ python -m deepretina.compact 15-10-07 whitenoise naturalscene --dtype uint8
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import argparse
+import numpy as np
+import h5py
+from .experiments import COMPACT_DIR, CHUNKSIZE, stimulus_stats, _datapath, _num_blocks, _quantization, _quantize
+from .utils import notify
+
+__all__ = ['export']
+
+
+def export(expt, filename, dtype='uint8', num_blocks=None, chunksize=CHUNKSIZE):
+    """Converts an experiment hdf5 file into the compact format
+
+    Parameters
+    ----------
+    expt : str
+        The date of the experiment to load in YY-MM-DD format (e.g. '15-10-07')
+
+    filename : string
+        Name of the hdf5 file to load (e.g. 'whitenoise' or 'naturalscene')
+
+    dtype : string, optional
+        Storage type of the stimulus frames, 'uint8' or 'float16' (Default: 'uint8').
+        Frames are stored as uint8 with an affine (offset, scale) quantization, which
+        is lossless for stimuli with at most 256 evenly spaced levels, such as binary
+        white noise or 8-bit natural scenes.
+
+    num_blocks : int, optional
+        Number of stimulus blocks in the training data (Default: look up the
+        experiment in NUM_BLOCKS)
+
+    chunksize : int, optional
+        Number of frames to convert at a time (Default: 1000)
+
+    Returns
+    -------
+    directory : string
+        The directory the compact experiment was written to
+    """
+    assert dtype in ('uint8', 'float16'), "dtype must be 'uint8' or 'float16'"
+
+    filepath = _datapath(expt, filename)
+    directory = os.path.join(COMPACT_DIR, expt, filename)
+    os.makedirs(directory, exist_ok=True)
+
+    with notify('Exporting {}/{} to {}'.format(expt, filename, directory)):
+
+        # z-scoring statistics of the training stimulus, in the original units
+        mean, std = stimulus_stats(filepath)
+        np.save(os.path.join(directory, 'mean.npy'), mean)
+        np.save(os.path.join(directory, 'std.npy'), std)
+
+        with h5py.File(filepath, mode='r') as f:
+            offset, scale = _quantization([f['train']['stimulus'], f['test']['stimulus']], dtype, chunksize)
+
+            for split in ('train', 'test'):
+                group = f[split]
+                stim = group['stimulus']
+                nframes = group['time'].size
+
+                # quantize the stimulus, one chunk at a time
+                out = np.lib.format.open_memmap(os.path.join(directory, '{}_stimulus.npy'.format(split)),
+                                                mode='w+', dtype=dtype, shape=stim.shape)
+                for start in range(0, stim.shape[0], chunksize):
+                    out[start:(start + chunksize)] = _quantize(stim[start:(start + chunksize)], dtype, offset, scale)
+                out.flush()
+                del out
+
+                # firing rates, stored with one column per cell
+                rates = np.array(group['response/firing_rate_10ms'], dtype='float32').T
+                np.save(os.path.join(directory, '{}_rates.npy'.format(split)), np.ascontiguousarray(rates))
+
+                # block table
+                nblocks = (num_blocks or _num_blocks(expt, split)) if split == 'train' else 1
+                edges = np.arange(nblocks + 1) * (nframes // nblocks)
+                np.save(os.path.join(directory, '{}_blocks.npy'.format(split)),
+                        np.stack((edges[:-1], edges[1:]), axis=1))
+
+            frame_shape = f['train']['stimulus'].shape[1:]
+
+        info = {
+            'expt': expt,
+            'filename': filename,
+            'dtype': dtype,
+            'offset': offset,
+            'scale': scale,
+            'frame_shape': frame_shape,
+            'source_mtime': os.path.getmtime(filepath),
+        }
+        with open(os.path.join(directory, 'info.json'), 'w') as f:
+            f.write(json.dumps(info))
+
+    return directory
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Export experiments to the compact deep-retina training format')
+    parser.add_argument('expt', help='experiment date (e.g. 15-10-07)')
+    parser.add_argument('filenames', nargs='+', help='stimulus files to export (e.g. whitenoise naturalscene)')
+    parser.add_argument('--dtype', default='uint8', choices=('uint8', 'float16'), help='stimulus storage type')
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        export(args.expt, filename, dtype=args.dtype)
@@ -3,74 +3,176 @@ Core tools for training models
 """
 from keras.models import Model
 from .glms import GLM
+from .experiments import BatchBuilder
+from .loaders import prefetch
+from .utils import notify, get_learning_rate, set_learning_rate
+from .profiling import Profiler, Progress, phase, timed
+from .parallel import DataParallel
+from .checkpoints import TrainingState, save_checkpoint, load_checkpoint
 from time import time
+import os
 import tableprint as tp
 
 __all__ = ['train']
 
 
-def train(model, experiment, monitor, num_epochs, augment=False):
+def train(model, experiment, monitor, num_epochs, augment=False, prefetch_depth=0, profiler=None,
+          checkpoint=None, checkpoint_every=100, plateau=None, progress=None):
     """Train the given network against the given data
 
     Parameters
     ----------
-    model : keras.models.Model or glms.GLM
-        A GLM or Keras Model object
+    model : keras.models.Model, glms.GLM or parallel.DataParallel
+        A GLM or Keras Model object (wrap it in a parallel.DataParallel to split
+        each batch across worker processes)
 
     experiment : experiments.Experiment
         An Experiment object
 
     monitor : io.Monitor
         Saves the model parameters and plots of performance progress
+        (wrap it in an io.AsyncMonitor to save in a background thread)
 
     num_epochs : int
         Number of epochs to train for
 
-    reduce_lr_every : int
-        How often to reduce the learning rate
+    prefetch_depth : int, optional
+        If positive, up to this many batches are assembled in a background thread
+        while the model trains on the current batch (Default: 0)
 
-    reduce_rate : float
-        A fraction (constant) to multiply the learning rate by
+    profiler : profiling.Profiler, optional
+        If given, records the time spent fetching data, training and monitoring
+        (including the stages of monitor.save) at every iteration, and prints a
+        summary at the end of training
 
-    """
-    assert isinstance(model, (Model, GLM)), "'model' must be a GLM or Keras model"
+    checkpoint : string, optional
+        Path to a full-state checkpoint (see checkpoints.save_checkpoint). If the
+        file exists, training resumes from it, mid-epoch if need be, along with the
+        monitor (saving to the original run's directory) and plateau schedule. The
+        checkpoint is updated every `checkpoint_every` iterations and when training
+        is interrupted.
 
-    # initialize training iteration
-    iteration = 0
-    train_start = time()
+    checkpoint_every : int, optional
+        How often to update the checkpoint, in iterations (Default: 100)
 
-    # loop over epochs
-    try:
-        for epoch in range(num_epochs):
-            tp.banner('Epoch #{} of {}'.format(epoch + 1, num_epochs))
-            print(tp.header(["Iteration", "Loss", "Runtime"]), flush=True)
+    plateau : schedules.Plateau, optional
+        If given, reduces the learning rate and stops training early when the best
+        validation log-likelihood tracked by the monitor stops improving
 
-            # loop over data batches for this epoch
-            for X, y in experiment.train(shuffle=True):
+    progress : profiling.Progress, optional
+        Reports the loss and throughput, aggregated over windows of iterations
+        (Default: a report every 10 seconds, printed to stdout)
 
-                # update on save_every, assuming it is positive
-                if (monitor is not None) and (iteration % monitor.save_every == 0):
+    """
+    assert isinstance(model, (Model, GLM, DataParallel)), "'model' must be a GLM or Keras model"
+    assert plateau is None or monitor is not None, "a monitor is required to detect plateaus"
+
+    # checkpoints store the state of the wrapped model
+    base_model = model.model if isinstance(model, DataParallel) else model
 
-                    # performs validation, updates performance plots, saves results to dropbox
-                    monitor.save(epoch, iteration, X, y, model.predict)
+    # batches are assembled into reusable buffers
+    builder = BatchBuilder()
 
-                # train on the batch
-                tstart = time()
-                loss = model.train_on_batch({'stim':X, 'loss':y})[0]
-                elapsed_time = time() - tstart
+    # initialize training iteration, or resume from a checkpoint
+    state = TrainingState(epoch=0, iteration=0, order=None, position=0, stopped=False)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with notify('Resuming from {}'.format(checkpoint)):
+            state = load_checkpoint(checkpoint, base_model, experiment, monitor, plateau)
 
-                # update
-                iteration += 1
-                print(tp.row([iteration, float(loss), tp.humantime(elapsed_time)]), flush=True)
+        # an empty or exhausted order means the checkpoint was saved between epochs
+        if state.position >= len(state.order):
+            state = state._replace(epoch=state.epoch + int(len(state.order) > 0), order=None, position=0)
+    iteration = state.iteration
+    train_start = time()
 
-            print(tp.bottom(3))
+    # per-phase timings are only recorded if a profiler is given
+    profiler = profiler or Profiler(enabled=False)
+    progress = progress or Progress()
+
+    # set when the plateau schedule stops training early (and stays set when resuming)
+    stopped = state.stopped
+    if stopped:
+        print('Training was stopped early at iteration {}, not resuming'.format(iteration), flush=True)
+
+    # loop over epochs
+    try:
+        with profiler:
+            for epoch in range(state.epoch, num_epochs if not stopped else state.epoch):
+                tp.banner('Epoch #{} of {}'.format(epoch + 1, num_epochs))
+                progress.header()
+
+                # the order of the batches is drawn up front, so that it can be checkpointed
+                if state.order is None:
+                    state = state._replace(epoch=epoch, order=experiment.batch_order(shuffle=True), position=0)
+                remaining = state.order[state.position:]
+
+                # loop over data batches for this epoch
+                if prefetch_depth > 0:
+                    batches = prefetch(experiment, shuffle=True, depth=prefetch_depth, order=remaining)
+                else:
+                    batches = (experiment.batch(ix, builder) for ix in remaining)
+
+                for X, y in timed(batches, 'fetch'):
+                    with profiler.iteration(iteration):
+
+                        # update whenever the monitor's save schedule says so
+                        if (monitor is not None) and monitor.should_save(iteration):
+
+                            # performs validation, updates performance plots, saves results to dropbox
+                            with phase('monitor'):
+                                monitor.save(epoch, iteration, X, y, model.predict)
+
+                            # adapt to the validation performance
+                            if plateau is not None:
+                                lr = get_learning_rate(model)
+                                action = plateau(iteration, monitor.best, lr)
+                                if action == 'reduce':
+                                    set_learning_rate(model, lr * plateau.factor)
+                                    print('Validation plateaued, reducing the learning rate to {:g}'
+                                          .format(lr * plateau.factor), flush=True)
+                                elif action == 'stop':
+                                    print('Validation plateaued, stopping early', flush=True)
+                                    stopped = True
+                                    break
+
+                        # train on the batch
+                        tstart = time()
+                        loss = model.train_on_batch({'stim':X, 'loss':y})[0]
+                        elapsed_time = time() - tstart
+                        profiler.record('train_on_batch', elapsed_time)
+
+                        # update
+                        iteration += 1
+                        state = state._replace(iteration=iteration, position=state.position + 1)
+                        progress.update(iteration, float(loss), X.shape[0], elapsed_time)
+
+                        if checkpoint is not None and iteration % checkpoint_every == 0:
+                            with phase('checkpoint'):
+                                save_checkpoint(checkpoint, base_model, experiment, state, monitor, plateau)
+
+                progress.bottom(iteration)
+                if stopped:
+                    break
+
+                # the next epoch starts with a fresh order
+                state = state._replace(epoch=epoch + 1, order=None, position=0)
 
     except KeyboardInterrupt:
         print('\nCleaning up')
 
+    # save where training stopped, so that it can be resumed
+    if checkpoint is not None:
+        save_checkpoint(checkpoint, base_model, experiment, state._replace(
+            order=state.order if state.order is not None else [], iteration=iteration, stopped=stopped),
+            monitor, plateau)
+
     # allows the monitor to perform any post-training visualization
     if monitor is not None:
         elapsed_time = time() - train_start
         monitor.cleanup(iteration, elapsed_time)
 
+    progress.close()
     tp.banner('Training complete!')
+
+    if profiler.enabled:
+        profiler.report()
@@ -4,22 +4,168 @@ Preprocessing utility functions for loading and formatting experimental data
 
 from __future__ import absolute_import, division, print_function
 import os
+import json
 from functools import partial
 from itertools import repeat
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from threading import Lock
 import numpy as np
 import h5py
-from scipy.stats import zscore
+from warnings import warn
+from time import time
 from .utils import notify, allmetrics
+from .metrics import StreamingMetrics
+from .cache import cachekey, load_cached, store_cached
 Exptdata = namedtuple('Exptdata', ['X', 'y'])
 dt = 1e-2
-__all__ = ['Experiment', 'loadexpt']
+CHUNKSIZE = 1000
+COMPACT_DIR = os.path.expanduser('~/experiments/compact')
 
+# number of stimulus blocks (separated by transitions) in the training data of each experiment
+NUM_BLOCKS = {}
+__all__ = ['Experiment', 'ShardedExperiment', 'validate_all', 'predict_all', 'loadexpt', 'loadcompact', 'precision_check',
+           'ToeplitzStimulus', 'BatchBuilder', 'stimulus_stats']
 
-class Experiment(object):
+
+class _BaseExperiment(object):
+    """The train / validation split, batching and evaluation shared by Experiment and ShardedExperiment
+
+    Subclasses hold the data, and provide it through `_training_data` (the data to
+    draw training batches from), `_validation_data` (the data to draw held out
+    batches from) and the `_test_data` dictionary of Exptdata tuples.
+    """
+
+    def _training_data(self, key):
+        raise NotImplementedError
+
+    def _validation_data(self, key):
+        raise NotImplementedError
+
+    def _add_split(self, key, length, holdout):
+        """Splits the samples of a dataset into training and validation batches"""
+        train, val = _train_val_split(length, self.batchsize, holdout)
+        self._train_batches.extend(zip(repeat(key), train))
+        self._validation_batches.extend(zip(repeat(key), val))
+
+    def get_split(self):
+        """Returns the (train, validation) batches, as lists of (dataset, indices) tuples"""
+        return list(self._train_batches), list(self._validation_batches)
+
+    def set_split(self, train_batches, validation_batches):
+        """Restores a train / validation split returned by `get_split` (e.g. when resuming training)"""
+        self._train_batches = list(train_batches)
+        self._validation_batches = list(validation_batches)
+        self.batches_per_epoch = len(self._train_batches)
+
+    def train(self, shuffle, builder=None, seed=None):
+        """Returns a generator that yields batches of *training* data
+
+        Parameters
+        ----------
+        shuffle : boolean
+            Whether or not to shuffle the time points before making batches
+
+        builder : BatchBuilder, optional
+            If given, batches are assembled in the builder's preallocated buffers
+            instead of being gathered into new arrays. Each yielded batch is then
+            overwritten by the next one.
+
+        seed : int, optional
+            Seed for shuffling the batches (Default: use the global numpy random state)
+        """
+        # yield training data, one batch at a time
+        for ix in self.batch_order(shuffle, seed):
+            yield self.batch(ix, builder)
+
+    def batch_order(self, shuffle, seed=None):
+        """Returns the order in which to go through the training batches (see `train`)"""
+        indices = np.arange(len(self._train_batches))
+        if shuffle:
+            rng = np.random if seed is None else np.random.RandomState(seed)
+            rng.shuffle(indices)
+        return indices
+
+    def batch(self, ix, builder=None):
+        """Loads the stimulus and response for the training batch with the given index (see `train`)"""
+        key, inds = self._train_batches[ix]
+        data = self._training_data(key)
+        if builder is None:
+            return data.X[inds], data.y[inds]
+        else:
+            return builder(inds, data.X, data.y)
+
+    def validate(self, modelrate, metrics, full=False, chunksize=None):
+        """Evaluates the model on the validation set
+
+        Parameters
+        ----------
+        modelrate : function
+            A function that takes a spatiotemporal stimulus and predicts a firing rate
+
+        metrics : list of strings
+            Which functions from the metrics module to evaluate on
+
+        full : boolean, optional
+            If True, evaluates every held out batch instead of a single random one
+            (see `validate_all`). (Default: False)
+
+        chunksize : int, optional
+            Number of samples per model call when full is True (Default: batchsize)
+        """
+        if full:
+            return validate_all(self._validation_batches, self._validation_data, modelrate, metrics,
+                                chunksize or self.batchsize, self.validation_throughput)
+
+        # choose a random validation batch
+        key, inds = self._validation_batches[np.random.randint(len(self._validation_batches))]
+
+        # load the stimulus and response on this batch
+        data = self._validation_data(key)
+        X = data.X[inds]
+        r = data.y[inds]
+
+        # make predictions
+        rhat = modelrate({'stim': X})
+
+        # evaluate using the given metrics
+        return allmetrics(r, rhat, metrics), r, rhat
+
+    def test(self, modelrate, metrics, key=None, chunksize=None):
+        """Tests model predictions on the repeat stimuli
+
+        Parameters
+        ----------
+        modelrate : function
+            A function that takes a spatiotemporal stimulus and predicts a firing rate
+
+        metrics : list of strings
+            Which functions from the metrics module to evaluate on
+
+        key : string, optional
+            Identifies the model parameters (e.g. utils.weights_digest(model)). If the
+            key matches that of the previous call, the cached predictions are reused.
+
+        chunksize : int, optional
+            Number of samples per model call (Default: batchsize)
+        """
+        # get model firing rates
+        rhats = predict_all(self._test_data, modelrate, chunksize or self.batchsize, self._test_predictions, key)
+
+        avg_scores = {}
+        all_scores = {}
+        for fname, exptdata in self._test_data.items():
+
+            # evaluate
+            avg_scores[fname], all_scores[fname] = allmetrics(exptdata.y, rhats[fname], metrics)
+
+        return avg_scores, all_scores
+
+
+class Experiment(_BaseExperiment):
     """Class to keep track of loaded experiment data"""
 
-    def __init__(self, expt, cells, train_filenames, test_filenames, history, batchsize, holdout=0.1, nskip=6000, zscore_flag=True):
+    def __init__(self, expt, cells, train_filenames, test_filenames, history, batchsize, holdout=0.1, nskip=6000, zscore_flag=True, lazy=False, cache=False, compact=False,
+                 stim_dtype='float32'):
         """Keeps track of experimental data
 
         Parameters
@@ -54,6 +200,27 @@ class Experiment(object):
 
         zscore_flag : bool
             Whether stimulus should be zscored (default: True)
+
+        lazy : bool
+            If True, the stimulus is left on disk and only the frames needed for each
+            batch are read (and z-scored) on the fly, so that memory usage scales with
+            the batch size instead of the length of the recording (default: False)
+
+        cache : bool
+            If True, the preprocessed data is stored in (and memory-mapped from) an
+            on-disk cache, so that later runs on the same data load quickly (default: False)
+
+        compact : bool
+            If True, the data is read from the compact format written by
+            `compact.export` (see `loadcompact`) instead of the original hdf5 files.
+            The stimulus is then always memory-mapped, with the dtype it was exported
+            with, so this can not be combined with lazy, cache or stim_dtype (default: False)
+
+        stim_dtype : string
+            The type of the stimulus kept in memory, 'float32', 'float16' or 'uint8'.
+            Reduced precision stimuli are dequantized and z-scored per batch (default: 'float32')
+
+        Only one of lazy, cache, compact and a reduced precision stim_dtype can be set.
         """
 
         # store experiment variables (for saving later)
@@ -68,12 +235,18 @@ class Experiment(object):
         }
 
         assert holdout >= 0 and holdout < 1, "holdout must be between 0 and 1"
+        assert sum((bool(lazy), bool(cache), bool(compact), stim_dtype != 'float32')) <= 1, \
+            "Only one of lazy, cache, compact and a reduced precision stim_dtype can be set"
         self.batchsize = batchsize
         self.dt = dt
         self.holdout = holdout
 
         # partially apply function arguments to the loadexpt function
-        load_data = partial(loadexpt, expt, cells, history=history, zscore_flag=zscore_flag)
+        if compact:
+            load_data = partial(loadcompact, expt, cells, history=history, zscore_flag=zscore_flag)
+        else:
+            load_data = partial(loadexpt, expt, cells, history=history, zscore_flag=zscore_flag, lazy=lazy, cache=cache,
+                                stim_dtype=stim_dtype)
 
         # load training data, and generate the train/validation split, for each filename
         self._train_data = {}
@@ -84,13 +257,8 @@ class Experiment(object):
             # load the training experiment as an Exptdata tuple
             self._train_data[filename] = load_data(filename, 'train', nskip=nskip)
 
-            # generate the train/validation split
-            length = self._train_data[filename].X.shape[0]
-            train, val = _train_val_split(length, self.batchsize, holdout)
-
-            # append these train/validation batches to the master list
-            self._train_batches.extend(zip(repeat(filename), train))
-            self._validation_batches.extend(zip(repeat(filename), val))
+            # generate the train/validation split, and append its batches to the master lists
+            self._add_split(filename, self._train_data[filename].X.shape[0], holdout)
 
         # load the data for each experiment, store as a list of Exptdata tuple
         self._test_data = {filename: load_data(filename, 'test', nskip=0) for filename in test_filenames}
@@ -98,75 +266,406 @@ class Experiment(object):
         # save batches_per_epoch for calculating # epochs later
         self.batches_per_epoch = len(self._train_batches)
 
-    def train(self, shuffle):
-        """Returns a generator that yields batches of *training* data
+        # throughput of the most recent full validation pass
+        self.validation_throughput = {}
 
-        Parameters
-        ----------
-        shuffle : boolean
-            Whether or not to shuffle the time points before making batches
-        """
-        # generate an order in which to go through the batches
-        indices = np.arange(len(self._train_batches))
-        if shuffle:
-            np.random.shuffle(indices)
+        # test set predictions for the most recently tested parameters
+        self._test_predictions = {}
 
-        # yield training data, one batch at a time
-        for ix in indices:
-            expt, inds = self._train_batches[ix]
-            yield self._train_data[expt].X[inds], self._train_data[expt].y[inds]
+    def _training_data(self, key):
+        return self._train_data[key]
 
-    def validate(self, modelrate, metrics):
-        """Evaluates the model on the validation set
+    def _validation_data(self, key):
+        return self._train_data[key]
+
+    def cutout(self, xi, yi):
+        """Cuts out the given slice from the stimuli in this experiment"""
+        self._test_predictions.clear()
+        for stimset in ('_train_data', '_test_data'):
+            stim = self.__dict__[stimset]
+            for key, ex in stim.items():
+                if isinstance(ex.X, ToeplitzStimulus):
+                    stim[key] = Exptdata(ex.X.cutout(xi, yi), ex.y)
+                else:
+                    stim[key] = Exptdata(ex.X[:, :, xi, yi], ex.y)
+
+
+def loadcompact(expt, cells, filename, train_or_test, history, nskip, zscore_flag=True):
+    """Loads an experiment that has been exported to the compact format (see `compact.export`)
+
+    The stimulus frames are memory-mapped and dequantized (and z-scored) as each
+    batch is loaded. The valid indices are computed from the stored block table.
+    A warning is issued if the original hdf5 file has been modified since it was
+    exported.
+
+    Parameters
+    ----------
+    expt, cells, filename, train_or_test, history, nskip, zscore_flag
+        See `loadexpt`
+    """
+    assert history > 0 and type(history) is int, "Temporal history must be a positive integer"
+    assert train_or_test in ('train', 'test'), "train_or_test must be 'train' or 'test'"
+
+    with notify('Loading {}ing data for {}/{} (compact)'.format(train_or_test, expt, filename)):
+
+        directory = os.path.join(COMPACT_DIR, expt, filename)
+        with open(os.path.join(directory, 'info.json'), 'r') as f:
+            info = json.load(f)
+
+        # the export is stale if the original hdf5 file has changed since it was written
+        source = _datapath(expt, filename)
+        if os.path.exists(source) and os.path.getmtime(source) != info.get('source_mtime'):
+            warn('{} has changed since it was exported to {}, re-export it with '
+                 '`python -m deepretina.compact {} {} --dtype {}`'.format(source, directory, expt, filename, info['dtype']))
+
+        # apply clipping to remove the stimulus just after transitions
+        blocks = np.load(os.path.join(directory, '{}_blocks.npy'.format(train_or_test)))
+        valid_indices = np.concatenate([np.arange(start + nskip, stop) for start, stop in blocks])
+
+        # frames are dequantized and z-scored as they are loaded
+        if zscore_flag:
+            mean, std = np.load(os.path.join(directory, 'mean.npy')), np.load(os.path.join(directory, 'std.npy'))
+        else:
+            mean, std = None, None
+        mean, std = _dequantization(mean, std, info['offset'], info['scale'], tuple(info['frame_shape']))
+
+        stim = ToeplitzStimulus(os.path.join(directory, '{}_stimulus.npy'.format(train_or_test)), None,
+                                valid_indices, history, mean=mean, std=std)
+
+        # get the response for this cell (nsamples, ncells)
+        rates = np.load(os.path.join(directory, '{}_rates.npy'.format(train_or_test)), mmap_mode='r')
+        resp = np.array(rates[:, cells])[valid_indices]
+
+    return Exptdata(stim, resp[history:])
+
+
+def precision_check(modelrate, expt, cells, filename, history, stim_dtype, train_or_test='test', nskip=0,
+                    metrics=('cc', 'fev')):
+    """Compares model performance on a reduced precision stimulus to the float32 stimulus
+
+    Parameters
+    ----------
+    modelrate : function
+        A function that takes a spatiotemporal stimulus and predicts a firing rate
+
+    expt, cells, filename, history, train_or_test, nskip
+        See `loadexpt`
+
+    stim_dtype : string
+        The reduced precision stimulus type to check ('float16' or 'uint8')
+
+    metrics : list of strings, optional
+        Which functions from the metrics module to compare (Default: ('cc', 'fev'))
+
+    Returns
+    -------
+    scores : dict
+        The (float32, reduced precision) average scores for each metric
+
+    max_error : float
+        The largest absolute difference between the two (z-scored) stimuli
+    """
+    # both stimuli are evaluated per chunk, so the full Toeplitz arrays are never in memory
+    reference = loadexpt(expt, cells, filename, train_or_test, history, nskip, lazy=True)
+    reduced = loadexpt(expt, cells, filename, train_or_test, history, nskip, stim_dtype=stim_dtype)
+
+    max_error = 0.
+    for start in range(0, len(reference.X), CHUNKSIZE):
+        inds = slice(start, start + CHUNKSIZE)
+        max_error = max(max_error, float(np.abs(reference.X[inds] - reduced.X[inds]).max()))
+
+    rhats = predict_all({'reference': reference, 'reduced': reduced}, modelrate, CHUNKSIZE)
+    avg_reference, _ = allmetrics(reference.y, rhats['reference'], metrics)
+    avg_reduced, _ = allmetrics(reduced.y, rhats['reduced'], metrics)
+    scores = {metric: (avg_reference[metric], avg_reduced[metric]) for metric in metrics}
+
+    return scores, max_error
+
+
+class ShardedExperiment(_BaseExperiment):
+    """Training data spread over many (experiment, stimulus) shards
+
+    Only a working set of the most recently used training shards is kept in
+    memory at any time. Held out (validation) samples are read from lazily loaded
+    copies of the shards, outside of the working set. Exposes the same
+    train / validate / test interface as Experiment.
+    """
+
+    def __init__(self, shards, cells, test_shards, history, batchsize, holdout=0.1, nskip=6000,
+                 zscore_flag=True, max_resident=4, mixing='window', lazy=False, cache=False):
+        """Keeps track of experimental data spread across many recordings
 
         Parameters
         ----------
-        modelrate : function
-            A function that takes a spatiotemporal stimulus and predicts a firing rate
+        shards : list of tuples
+            The (expt, filename) pairs to train on, e.g. [('15-10-07', 'whitenoise'), ...]
+
+        cells : list or dict
+            Which cells to train on. Either a list (the same cells for every
+            experiment), or a dictionary mapping each experiment to a list of cells.
+            Every experiment must have the same number of cells.
+
+        test_shards : list of tuples
+            The (expt, filename) pairs to test on
+
+        history : int
+            Temporal history, in samples, for the rolling window (Toeplitz stimulus)
+
+        batchsize : int
+            How many samples to include in each training batch
+
+        holdout : float
+            How much data to holdout (fraction of batches) (must be between 0 and 1)
+
+        nskip : int
+            The number of stimulus frames to skip at the beginning of each stimulus block.
+            (Default: 6000)
+
+        zscore_flag : bool
+            Whether stimulus should be zscored (default: True)
+
+        max_resident : int
+            The maximum number of training shards to keep loaded at once (default: 4)
+
+        mixing : string
+            How batches are drawn from the shards when shuffling (default: 'window')
+            - 'sequential': go through the shards one at a time, in random order
+            - 'window': shuffle batches across groups of `max_resident` shards, so
+              that every group only needs to be loaded once per epoch
+            - 'random': shuffle batches across all shards (shards are reloaded often,
+              unless all of them fit in the working set)
+
+        lazy, cache : bool
+            Passed to `loadexpt` when loading each training shard, at most one can be set (default: False).
+            Test shards are always loaded lazily.
         """
-        # choose a random validation batch
-        expt, inds = self._validation_batches[np.random.randint(len(self._validation_batches))]
+        assert holdout >= 0 and holdout < 1, "holdout must be between 0 and 1"
+        assert max_resident >= 1, "max_resident must be at least 1"
+        assert mixing in ('sequential', 'window', 'random'), "mixing must be 'sequential', 'window' or 'random'"
+        assert not (lazy and cache), "lazy and cache can not be combined (cached data is always memory-mapped)"
 
-        # load the stimulus and response on this batch
-        X = self._train_data[expt].X[inds]
-        r = self._train_data[expt].y[inds]
+        if not isinstance(cells, dict):
+            cells = {expt: cells for expt, _ in list(shards) + list(test_shards)}
+        assert len(set(np.array(c).size for c in cells.values())) == 1, \
+            "Every experiment must have the same number of cells"
 
-        # make predictions
-        rhat = modelrate({'stim': X})
+        # store experiment variables (for saving later)
+        self.info = {
+            'date': ' + '.join(sorted(set(expt for expt, _ in shards))),
+            'cells': cells[shards[0][0]],
+            'train_datasets': ' + '.join('/'.join(shard) for shard in shards),
+            'test_datasets': ' + '.join('/'.join(shard) for shard in test_shards),
+            'history': history,
+            'batchsize': batchsize,
+            'clipped': nskip * dt,
+        }
 
-        # evaluate using the given metrics
-        return allmetrics(r, rhat, metrics), r, rhat
+        self.batchsize = batchsize
+        self.dt = dt
+        self.holdout = holdout
+        self.mixing = mixing
+        self.max_resident = max_resident
+        self._cells = cells
+        self._load_data = partial(loadexpt, history=history, zscore_flag=zscore_flag)
+        self._load_kwargs = {'nskip': nskip, 'lazy': lazy, 'cache': cache}
+
+        # generate the train/validation split for each shard, without loading the data
+        self._shards = [tuple(shard) for shard in shards]
+        self._train_batches = list()
+        self._validation_batches = list()
+        for shard in self._shards:
+            self._add_split(shard, _num_samples(shard[0], shard[1], 'train', history, nskip), holdout)
+        self._batch_shards = np.array([self._shards.index(shard) for shard, _ in self._train_batches])
 
-    def test(self, modelrate, metrics):
-        """Tests model predictions on the repeat stimuli
+        # the working set of loaded training shards, in order of use
+        self._resident = OrderedDict()
+        self._lock = Lock()
 
-        Parameters
-        ----------
-        modelrate : function
-            A function that takes a spatiotemporal stimulus and predicts a firing rate
+        # held out samples are read from lazily loaded shards, kept apart from the working set
+        self._holdout = {}
+
+        # test stimuli are small when loaded lazily, so they are always resident
+        self._test_data = {'/'.join((expt, filename)): loadexpt(expt, cells[expt], filename, 'test', history,
+                                                              nskip=0, zscore_flag=zscore_flag, lazy=True)
+                           for expt, filename in test_shards}
+
+        # save batches_per_epoch for calculating # epochs later
+        self.batches_per_epoch = len(self._train_batches)
+
+        # throughput of the most recent full validation pass
+        self.validation_throughput = {}
+
+        # test set predictions for the most recently tested parameters
+        self._test_predictions = {}
+
+    def shard(self, expt, filename):
+        """Gets the training data for the given shard, loading it if it is not resident"""
+        key = (expt, filename)
+        with self._lock:
+            if key in self._resident:
+                self._resident.move_to_end(key)
+            else:
+                # evict the least recently used shards
+                while len(self._resident) >= self.max_resident:
+                    self._resident.popitem(last=False)
+                self._resident[key] = self._load_data(expt, self._cells[expt], filename, 'train',
+                                                      **self._load_kwargs)
+            return self._resident[key]
+
+    def validation_data(self, expt, filename):
+        """Gets the data for validating on the given shard
+
+        The shard is loaded lazily (only the responses are kept in memory, and the
+        stimulus frames of each validation batch are read from disk), once, and
+        outside of the working set of training shards, so validation never evicts
+        the shards that training is using.
         """
-        avg_scores = {}
-        all_scores = {}
-        for fname, exptdata in self._test_data.items():
+        key = (expt, filename)
+        with self._lock:
+            if key not in self._holdout:
+                self._holdout[key] = self._load_data(expt, self._cells[expt], filename, 'train',
+                                                     nskip=self._load_kwargs['nskip'], lazy=True)
+            return self._holdout[key]
+
+    def _training_data(self, shard):
+        return self.shard(*shard)
+
+    def _validation_data(self, shard):
+        return self.validation_data(*shard)
+
+    def set_split(self, train_batches, validation_batches):
+        """Restores a train / validation split returned by `get_split` (e.g. when resuming training)"""
+        super().set_split([(tuple(shard), inds) for shard, inds in train_batches],
+                          [(tuple(shard), inds) for shard, inds in validation_batches])
+        self._batch_shards = np.array([self._shards.index(shard) for shard, _ in self._train_batches])
+
+    def batch_order(self, shuffle, seed=None):
+        """Returns the order in which to go through the training batches, given the mixing policy"""
+        if not shuffle or self.mixing == 'random':
+            return super().batch_order(shuffle, seed)
+
+        # shuffle batches within groups of shards that are resident at the same time
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        indices = np.arange(len(self._train_batches))
+        groupsize = 1 if self.mixing == 'sequential' else self.max_resident
+        shard_order = rng.permutation(len(self._shards))
+        order = list()
+        for start in range(0, len(shard_order), groupsize):
+            group = indices[np.isin(self._batch_shards, shard_order[start:(start + groupsize)])]
+            rng.shuffle(group)
+            order.append(group)
 
-            # get data and model firing rates
-            r = exptdata.y
-            rhat = modelrate({'stim': exptdata.X})
+        return np.concatenate(order)
 
-            # evaluate
-            avg_scores[fname], all_scores[fname] = allmetrics(r, rhat, metrics)
 
-        return avg_scores, all_scores
+def predict_all(testdata, modelrate, chunksize, cache=None, key=None):
+    """Predicts firing rates for each test dataset, in memory-bounded chunks
 
-    def cutout(self, xi, yi):
-        """Cuts out the given slice from the stimuli in this experiment"""
-        for stimset in ('_train_data', '_test_data'):
-            stim = self.__dict__[stimset]
-            for key, ex in stim.items():
-                stim[key] = Exptdata(ex.X[:, :, xi, yi], ex.y)
+    Parameters
+    ----------
+    testdata : dict
+        Exptdata tuples for each test dataset
+
+    modelrate : function
+        A function that takes a spatiotemporal stimulus and predicts a firing rate
+
+    chunksize : int
+        Number of samples to pass through the model at once
+
+    cache : dict, optional
+        Holds the predictions for the most recent key. If `key` matches the cached
+        key, the cached predictions are returned without running the model.
+
+    key : string, optional
+        Identifies the model parameters (e.g. utils.weights_digest(model))
+
+    Returns
+    -------
+    rhats : dict
+        The model predictions ({'loss': rates}) for each test dataset
+    """
+    if cache is not None and key is not None and cache.get('key') == key:
+        return cache['rhats']
+
+    rhats = {}
+    for name, exptdata in testdata.items():
+
+        # chunks of predictions are written into a single output array
+        out = None
+        for start in range(0, len(exptdata.X), chunksize):
+            rates = modelrate({'stim': exptdata.X[start:(start + chunksize)]})['loss']
+            if out is None:
+                out = np.empty((len(exptdata.X),) + rates.shape[1:], dtype=rates.dtype)
+            out[start:(start + len(rates))] = rates
+        rhats[name] = {'loss': out}
+
+    if cache is not None and key is not None:
+        cache.clear()
+        cache.update(key=key, rhats=rhats)
+
+    return rhats
+
+
+def validate_all(batches, load, modelrate, metrics, chunksize, throughput=None):
+    """Evaluates a model on every one of the given validation batches
 
+    Held out batches from the same dataset are merged, sorted, and passed through
+    the model in chunks of `chunksize` samples (assembled with a BatchBuilder, so
+    contiguous batches are copied as slabs into a reused buffer). The metrics are
+    accumulated incrementally with metrics.StreamingMetrics.
 
-def loadexpt(expt, cells, filename, train_or_test, history, nskip, zscore_flag=True):
+    Parameters
+    ----------
+    batches : list of tuples
+        (key, indices) for each validation batch
+
+    load : function
+        Takes a key and returns the corresponding Exptdata tuple
+
+    modelrate : function
+        A function that takes a spatiotemporal stimulus and predicts a firing rate
+
+    metrics : list of strings
+        Which functions from the metrics module to evaluate on
+
+    chunksize : int
+        Number of samples to pass through the model at once
+
+    throughput : dict, optional
+        If given, updated with the number of samples, elapsed time and samples per second
+
+    Returns
+    -------
+    (avg_scores, all_scores), r, rhat
+        Like `Experiment.validate`, where r and rhat are concatenated across batches
+    """
+    tstart = time()
+    scores = StreamingMetrics(metrics)
+    builder = BatchBuilder()
+    responses, predictions = list(), list()
+
+    keys = list(OrderedDict.fromkeys(key for key, _ in batches))
+    for key in keys:
+        data = load(key)
+        inds = np.sort(np.concatenate([inds for k, inds in batches if k == key]))
+
+        for start in range(0, inds.size, chunksize):
+            X, r = builder(inds[start:(start + chunksize)], data.X, data.y)
+            rhat = modelrate({'stim': X})
+            scores.update(r, rhat['loss'])
+            responses.append(r.copy())
+            predictions.append(rhat['loss'])
+
+    elapsed = time() - tstart
+    if throughput is not None:
+        nsamples = sum(r.shape[0] for r in responses)
+        throughput.update(samples=nsamples, seconds=elapsed, samples_per_second=nsamples / max(elapsed, 1e-12))
+
+    return scores.scores(), np.concatenate(responses), {'loss': np.concatenate(predictions)}
+
+
+def loadexpt(expt, cells, filename, train_or_test, history, nskip, zscore_flag=True, lazy=False, cache=False,
+             stim_dtype='float32'):
     """Loads an experiment from an h5 file on disk
 
     Parameters
@@ -190,40 +689,496 @@ def loadexpt(expt, cells, filename, train_or_test, history, nskip, zscore_flag=T
         Number of samples to skip at the beginning of each repeat (Default: 0)
 
     zscore_flag : bool
-        Whether to zscore the stimulus (Default: True)
+        Whether to zscore the stimulus. Both the train and test stimuli are z-scored
+        using the (cached) statistics of the training stimulus, see `stimulus_stats`
+        (Default: True)
+
+    lazy : bool
+        If True, returns a ToeplitzStimulus that reads frames from the hdf5 file on
+        demand instead of loading the full stimulus into memory (Default: False)
+
+    cache : bool
+        If True, the clipped and z-scored stimulus and response are memory-mapped from
+        the cache in `cache.CACHE_DIR`, and written there if they are not already
+        cached. Can not be combined with `lazy` (Default: False)
+
+    stim_dtype : string
+        The type of the in-memory stimulus: 'float32', 'float16' or 'uint8'. Reduced
+        precision stimuli are returned as a ToeplitzStimulus, which dequantizes and
+        z-scores the frames of each batch as they are loaded. uint8 storage uses an
+        affine quantization, which is lossless for binary white noise and 8-bit
+        natural scenes (see `precision_check`). Can not be combined with `lazy` or
+        `cache` (Default: 'float32')
     """
     assert history > 0 and type(history) is int, "Temporal history must be a positive integer"
     assert train_or_test in ('train', 'test'), "train_or_test must be 'train' or 'test'"
+    assert stim_dtype in ('float32', 'float16', 'uint8'), "stim_dtype must be 'float32', 'float16' or 'uint8'"
+    assert not (lazy and cache), "lazy and cache can not be combined (cached data is always memory-mapped)"
+    assert stim_dtype == 'float32' or not (lazy or cache), \
+        "A reduced precision stim_dtype can not be combined with lazy or cache"
 
     with notify('Loading {}ing data for {}/{}'.format(train_or_test, expt, filename)):
 
         # load the hdf5 file
-        filepath = os.path.join(os.path.expanduser('~/experiments/data'), expt, filename + '.h5')
-        with h5py.File(filepath, mode='r') as f:
+        filepath = _datapath(expt, filename)
 
-            expt_length = f[train_or_test]['time'].size
+        # reuse the preprocessed arrays from a previous load, if they are cached
+        if cache:
+            key = cachekey(expt, filename, train_or_test, cells, nskip, zscore_flag, os.path.getmtime(filepath))
+            cached = load_cached(key)
+            if cached is not None:
+                stim, resp = cached
+                return Exptdata(rolling_window(stim, history, time_axis=0), resp[history:])
+
+        # per-pixel z-scoring statistics of the training stimulus
+        mean, std = stimulus_stats(filepath) if zscore_flag else (None, None)
 
-            # load the stimulus into memory as a numpy array
-            stim = np.array(f[train_or_test]['stimulus']).astype('float32')
+        with h5py.File(filepath, mode='r') as f:
 
-            # z-score the stimulus if desired
-            if zscore_flag:
-                stim = zscore(stim)
+            expt_length = f[train_or_test]['time'].size
 
             # apply clipping to remove the stimulus just after transitions
-            num_blocks = NUM_BLOCKS[expt] if train_or_test == 'train' else 1
+            num_blocks = _num_blocks(expt, train_or_test)
             valid_indices = np.arange(expt_length).reshape(num_blocks, -1)[:, nskip:].ravel()
 
-            # reshape into the Toeplitz matrix (nsamples, history, *stim_dims)
-            stim_reshaped = rolling_window(stim[valid_indices], history, time_axis=0)
-
             # get the response for this cell (nsamples, ncells)
             resp = np.array(f[train_or_test]['response/firing_rate_10ms'][cells]).T[valid_indices]
+
+            if cache:
+
+                # stream the clipped and z-scored stimulus into the cache, and memory-map it
+                frames = ToeplitzStimulus(filepath, '/'.join((train_or_test, 'stimulus')),
+                                          valid_indices, history, mean=mean, std=std)
+                chunks = (frames.frames(start, start + CHUNKSIZE)
+                          for start in range(0, valid_indices.size, CHUNKSIZE))
+                stim, resp = store_cached(key, chunks, (valid_indices.size,) + frames.frame_shape, resp)
+                stim_reshaped = rolling_window(stim, history, time_axis=0)
+
+            elif lazy:
+
+                # the Toeplitz matrix (nsamples, history, *stim_dims) is only evaluated per batch
+                stim_reshaped = ToeplitzStimulus(filepath, '/'.join((train_or_test, 'stimulus')),
+                                                 valid_indices, history, mean=mean, std=std)
+
+            elif stim_dtype != 'float32':
+
+                # keep the quantized stimulus in memory, frames are dequantized per batch
+                dset = f[train_or_test]['stimulus']
+                offset, scale = _quantization([dset], stim_dtype)
+                stim = np.empty(dset.shape, dtype=stim_dtype)
+                for start in range(0, dset.shape[0], CHUNKSIZE):
+                    stim[start:(start + CHUNKSIZE)] = _quantize(dset[start:(start + CHUNKSIZE)], stim_dtype, offset, scale)
+
+                mean, std = _dequantization(mean, std, offset, scale, dset.shape[1:])
+                stim_reshaped = ToeplitzStimulus(None, None, valid_indices, history, mean=mean, std=std, frames=stim)
+
+            else:
+
+                # load the stimulus into memory as a float32 numpy array (converted while reading)
+                stim = np.empty(f[train_or_test]['stimulus'].shape, dtype='float32')
+                f[train_or_test]['stimulus'].read_direct(stim)
+
+                # z-score the stimulus in place if desired
+                if zscore_flag:
+                    stim -= mean
+                    stim /= std
+
+                # reshape into the Toeplitz matrix (nsamples, history, *stim_dims)
+                stim_reshaped = rolling_window(stim[valid_indices], history, time_axis=0)
+
             resp = resp[history:]
 
     return Exptdata(stim_reshaped, resp)
 
 
+def _datapath(expt, filename):
+    """Path to the hdf5 file for the given experiment and stimulus"""
+    return os.path.join(os.path.expanduser('~/experiments/data'), expt, filename + '.h5')
+
+
+def _num_blocks(expt, train_or_test):
+    """Number of stimulus blocks (separated by transitions) in the given experiment"""
+    return NUM_BLOCKS[expt] if train_or_test == 'train' else 1
+
+
+def _num_samples(expt, filename, train_or_test, history, nskip):
+    """Number of samples that `loadexpt` would return, computed without loading any data"""
+    with h5py.File(_datapath(expt, filename), mode='r') as f:
+        expt_length = f[train_or_test]['time'].size
+    num_blocks = _num_blocks(expt, train_or_test)
+    return num_blocks * (expt_length // num_blocks - nskip) - history
+
+
+def _quantization(datasets, dtype, chunksize=CHUNKSIZE):
+    """Computes the (offset, scale) used to store the given stimulus datasets as dtype
+
+    Frames are stored as (x - offset) / scale. For uint8, the range of the stimulus
+    is mapped onto [0, 255], unless the stimulus is already stored as uint8.
+    """
+    if dtype != 'uint8' or all(dset.dtype == np.uint8 for dset in datasets):
+        return 0., 1.
+
+    vmin, vmax = np.inf, -np.inf
+    for dset in datasets:
+        for start in range(0, dset.shape[0], chunksize):
+            chunk = dset[start:(start + chunksize)]
+            vmin, vmax = min(vmin, float(chunk.min())), max(vmax, float(chunk.max()))
+
+    return vmin, max(vmax - vmin, np.finfo('float32').tiny) / 255.
+
+
+def _quantize(chunk, dtype, offset, scale):
+    """Quantizes a chunk of stimulus frames (see `_quantization`)"""
+    chunk = (chunk.astype('float64') - offset) / scale
+    if dtype == 'uint8':
+        chunk = np.clip(np.round(chunk), 0, 255)
+    return chunk.astype(dtype)
+
+
+def _dequantization(mean, std, offset, scale, frame_shape):
+    """Converts z-scoring statistics into the units of a quantized stimulus
+
+    Since quantized frames are q = (x - offset) / scale, z-scoring q with the returned
+    statistics gives (x - mean) / std. If mean and std are None, the returned
+    statistics only undo the quantization.
+    """
+    if mean is None:
+        mean, std = np.zeros(frame_shape), np.ones(frame_shape)
+    return ((mean - offset) / scale).astype('float32'), (std / scale).astype('float32')
+
+
+class ToeplitzStimulus(object):
+    """A rolling window (Toeplitz) view of a stimulus that is kept on disk
+
+    Indexing a ToeplitzStimulus gives the same values as indexing
+    `rolling_window(((stim - mean) / std)[valid_indices], history)`, but only the frames
+    needed for the requested samples are read from disk. Contiguous (uncompressed)
+    hdf5 datasets and .npy files are memory-mapped, other datasets are read through h5py.
+    """
+
+    def __init__(self, filepath, key, valid_indices, history, mean=None, std=None, cutout=None, frames=None):
+        """Builds a lazily evaluated Toeplitz stimulus
+
+        Parameters
+        ----------
+        filepath : string
+            Path to the hdf5 (or .npy) file containing the stimulus, or None if `frames` is given
+
+        key : string
+            The name of the stimulus dataset in the hdf5 file (e.g. 'train/stimulus'),
+            or None if the stimulus is stored in a .npy file (or given as `frames`)
+
+        valid_indices : array_like
+            Indices of the stimulus frames to keep (after clipping)
+
+        history : int
+            Number of samples of history to include in the toeplitz stimulus
+
+        mean, std : array_like, optional
+            If given, frames are z-scored using these statistics as they are loaded
+
+        cutout : tuple of slices, optional
+            Spatial region of each frame to keep (Default: the full frame)
+
+        frames : array_like, optional
+            An in-memory (e.g. quantized) array of stimulus frames, used instead of a file
+        """
+        assert (filepath is None) != (frames is None), "Exactly one of filepath or frames must be given"
+
+        self.filepath = filepath
+        self.key = key
+        self.valid_indices = np.asarray(valid_indices)
+        self.history = history
+        self.mean = mean
+        self.std = std
+        self._cutout = (slice(None),) + tuple(cutout or ())
+        self._frames = frames
+        self._file = None
+        self._data = None
+
+        if frames is not None:
+            frame_shape = frames.shape[1:]
+        elif key is None:
+            frame_shape = np.load(filepath, mmap_mode='r').shape[1:]
+        else:
+            with h5py.File(filepath, mode='r') as f:
+                frame_shape = f[key].shape[1:]
+
+        self.frame_shape = np.empty(frame_shape, dtype=bool)[self._cutout[1:]].shape
+        self.dtype = np.dtype('float32')
+
+        assert self.valid_indices.size > history, "`history` is too long."
+
+    def __len__(self):
+        return self.valid_indices.size - self.history
+
+    @property
+    def shape(self):
+        return (len(self), self.history) + self.frame_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def data(self):
+        """The raw stimulus frames (an array, a memory map, or an open hdf5 dataset)"""
+        if self._data is None and self._frames is not None:
+            self._data = self._frames
+
+        elif self._data is None and self.key is None:
+            self._data = np.load(self.filepath, mmap_mode='r')
+
+        elif self._data is None:
+            self._file = h5py.File(self.filepath, mode='r')
+            dset = self._file[self.key]
+            offset = dset.id.get_offset()
+
+            # memory-map the dataset if it is stored contiguously
+            if offset is not None and dset.chunks is None and dset.compression is None:
+                self._data = np.memmap(self.filepath, mode='r', dtype=dset.dtype,
+                                       offset=offset, shape=dset.shape)
+            else:
+                self._data = dset
+
+        return self._data
+
+    def __getstate__(self):
+        # open file handles can not be pickled, they are reopened on first access
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_data'] = None
+        return state
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            if len(key) == 0 or key[0] is Ellipsis or key[0] is None:
+                return self[:][key]
+
+            # an integer drops the sample axis, so the rest of the key applies to what is left
+            samples = self[key[0]]
+            if not isinstance(key[0], slice) and np.ndim(key[0]) == 0:
+                return samples[key[1:]]
+            return samples[(slice(None),) + key[1:]]
+
+        if isinstance(key, slice):
+            inds = np.arange(*key.indices(len(self)))
+
+        else:
+            inds = np.asarray(key)
+            if inds.dtype == bool:
+                inds = np.flatnonzero(inds)
+
+            inds = np.where(inds < 0, inds + len(self), inds)
+
+            # a single sample
+            if inds.ndim == 0:
+                return self[inds:inds + 1][0]
+
+        return self.take(inds)
+
+    def take(self, inds, out=None):
+        """Loads the samples at the given (non-negative) indices
+
+        Parameters
+        ----------
+        inds : array_like
+            Indices of the samples to load
+
+        out : array_like, optional
+            Preallocated array with shape (len(inds), history, *frame_shape) to store the samples in
+        """
+        inds = np.asarray(inds)
+        assert np.all((inds >= 0) & (inds < len(self))), "Index out of range"
+
+        if out is None:
+            out = np.empty((inds.size,) + self.shape[1:], dtype=self.dtype)
+
+        # load one block of frames per contiguous run of sample indices
+        for start, stop, offset in _index_runs(inds):
+            out[offset:offset + stop - start] = rolling_window(self.frames(start, stop + self.history), self.history)
+
+        return out
+
+    def frames(self, start, stop):
+        """Loads the (z-scored) stimulus frames at the valid positions [start, stop)"""
+        raw = self.valid_indices[start:stop]
+        frames = np.empty((raw.size,) + self.frame_shape, dtype=self.dtype)
+
+        # clipping splits the valid frames into blocks that are contiguous on disk
+        offset = 0
+        for block in np.split(raw, np.flatnonzero(np.diff(raw) != 1) + 1):
+            sel = (slice(block[0], block[-1] + 1),) + self._cutout[1:]
+            frames[offset:offset + block.size] = self.data[sel]
+            offset += block.size
+
+        if self.mean is not None:
+            frames -= self.mean
+            frames /= self.std
+
+        return frames
+
+    def cutout(self, xi, yi):
+        """Returns a new ToeplitzStimulus restricted to the given spatial slice"""
+        assert self._cutout == (slice(None),), "This stimulus has already been cut out"
+        select = lambda stat: None if stat is None else stat[xi, yi]
+        return ToeplitzStimulus(self.filepath, self.key, self.valid_indices, self.history,
+                                mean=select(self.mean), std=select(self.std), cutout=(xi, yi), frames=self._frames)
+
+
+class BatchBuilder(object):
+    """Assembles batches of samples into preallocated, reusable buffers
+
+    Contiguous runs of indices (e.g. the batches generated by `_train_val_split`)
+    are copied as slabs instead of being gathered sample by sample, and the output
+    buffers are only allocated once. Since each batch is overwritten by the next,
+    every worker that assembles batches should own its own BatchBuilder.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+        # number of bytes copied for the most recent batch, and in total
+        self.bytes_copied = 0
+        self.total_bytes_copied = 0
+
+    def __call__(self, inds, *arrays):
+        """Returns the given samples (rows) of each array, as views into the reusable buffers
+
+        Parameters
+        ----------
+        inds : array_like
+            Indices of the samples in this batch
+
+        arrays : array_like
+            Arrays (or ToeplitzStimulus objects) to take samples from along the first axis
+        """
+        inds = np.asarray(inds)
+        runs = _index_runs(inds)
+
+        batch = []
+        self.bytes_copied = 0
+        for key, array in enumerate(arrays):
+            out = self._buffer(key, (inds.size,) + array.shape[1:], array.dtype)
+
+            if isinstance(array, ToeplitzStimulus):
+                array.take(inds, out=out)
+            else:
+                for start, stop, offset in runs:
+                    out[offset:offset + stop - start] = array[start:stop]
+
+            self.bytes_copied += out.nbytes
+            batch.append(out)
+
+        self.total_bytes_copied += self.bytes_copied
+        return tuple(batch)
+
+    def _buffer(self, key, shape, dtype):
+        """Gets a buffer with the given shape, reallocating only if it does not fit"""
+        buf = self._buffers.get(key)
+        if buf is None or buf.shape[0] < shape[0] or buf.shape[1:] != shape[1:] or buf.dtype != dtype:
+            buf = self._buffers[key] = np.empty(shape, dtype=dtype)
+        return buf[:shape[0]]
+
+
+def _index_runs(inds):
+    """Splits an array of indices into contiguous runs
+
+    Returns
+    -------
+    runs : list of tuples
+        (start, stop, offset) for each run, such that inds[offset:offset + stop - start] == range(start, stop)
+    """
+    if inds.size == 0:
+        return []
+    offsets = np.concatenate(([0], np.flatnonzero(np.diff(inds) != 1) + 1, [inds.size]))
+    return [(int(inds[i]), int(inds[j - 1]) + 1, int(i)) for i, j in zip(offsets[:-1], offsets[1:])]
+
+
+def stimulus_stats(filepath, key='train/stimulus', chunksize=CHUNKSIZE, cache=True):
+    """Computes the mean and standard deviation across time of each stimulus pixel
+
+    The statistics are computed in a single streaming pass over chunks of the hdf5
+    dataset, and are cached in a `<filename>.zscore.h5` file next to the experiment
+    file, so that reloading the experiment skips this pass entirely. The cache is
+    recomputed whenever the experiment file is modified.
+
+    Parameters
+    ----------
+    filepath : string
+        Path to the experiment hdf5 file
+
+    key : string, optional
+        The stimulus dataset to compute statistics over (Default: 'train/stimulus')
+
+    chunksize : int, optional
+        Number of frames to load at a time (Default: 1000)
+
+    cache : bool, optional
+        Whether to read and write the cached statistics (Default: True)
+
+    Returns
+    -------
+    mean, std : array_like
+        float32 arrays with the spatial dimensions of the stimulus
+    """
+    cachepath = os.path.splitext(filepath)[0] + '.zscore.h5'
+    mtime = os.path.getmtime(filepath)
+
+    # load cached statistics, if they are up to date
+    if cache and os.path.isfile(cachepath):
+        with h5py.File(cachepath, mode='r') as f:
+            if key in f and f[key].attrs['mtime'] == mtime:
+                return np.array(f[key]['mean']), np.array(f[key]['std'])
+
+    with h5py.File(filepath, mode='r') as f:
+        mean, var, count = _streaming_moments(f[key], chunksize)
+    mean, std = mean.astype('float32'), np.sqrt(var).astype('float32')
+
+    if cache:
+        try:
+            with h5py.File(cachepath, mode='a') as f:
+                if key in f:
+                    del f[key]
+                group = f.create_group(key)
+                group['mean'] = mean
+                group['std'] = std
+                group.attrs['count'] = count
+                group.attrs['mtime'] = mtime
+        except OSError:
+            warn('Could not cache the stimulus statistics in {}'.format(cachepath))
+
+    return mean, std
+
+
+def _streaming_moments(dset, chunksize):
+    """Welford-style mean and (population) variance along the first axis of a dataset
+
+    Statistics of each chunk are merged into the running totals using the pairwise
+    update of Chan et. al. (1979), which is numerically stable for long recordings.
+    """
+    count = 0
+    mean = np.zeros(dset.shape[1:])
+    m2 = np.zeros(dset.shape[1:])
+
+    for start in range(0, dset.shape[0], chunksize):
+        chunk = dset[start:(start + chunksize)].astype('float64')
+        n = chunk.shape[0]
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+
+        delta = chunk_mean - mean
+        total = count + n
+        mean += delta * (n / total)
+        m2 += chunk_m2 + delta ** 2 * (count * n / total)
+        count = total
+
+    return mean, m2 / count, count
+
+
 def rolling_window(array, window, time_axis=0):
     """
     Make an ndarray with a rolling window of the last dimension
@@ -112,6 +112,14 @@ class GLM:
         # compute the objective and gradient
         objective, gradient = self.loss(X, y)
 
+        return self.update(objective, gradient)
+
+    def update(self, objective, gradient):
+        """Takes an optimizer step given the (unregularized) objective and gradient
+
+        Adds the l2 regularization penalties, and returns the regularized
+        objective and gradient
+        """
         # update objective and gradient with the l2 penalty
         for key in gradient.keys():
             objective += 0.5 * self.l2[key] * np.linalg.norm(self.theta[key].ravel(), 2) ** 2
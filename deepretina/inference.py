@@ -0,0 +1,108 @@
+"""
+Memory-bounded, deduplicated model inference
+"""
+
+from __future__ import absolute_import, division, print_function
+import numpy as np
+from .experiments import BatchBuilder
+
+__all__ = ['Predictor']
+
+# default upper bound on the size of the stimulus passed to the model at once
+MAX_CHUNK_BYTES = 2 ** 28
+
+
+class Predictor(object):
+    def __init__(self, model_predict, chunksize=None, max_bytes=MAX_CHUNK_BYTES, memory=4):
+        """Wraps a model's predict function ({'stim': X} -> {'loss': rates})
+
+        - Repeated calls with the same stimulus array return the previous
+          predictions instead of running the model again.
+        - Large stimuli are passed through the model in chunks, which are written
+          into a single preallocated output array.
+        - Stimuli that are not numpy arrays (e.g. a lazily loaded ToeplitzStimulus)
+          are assembled chunk by chunk into a reused buffer.
+
+        Since a stimulus is identified by the array object, and not by its
+        contents, a Predictor should only live as long as the arrays it is
+        called with are not modified (e.g. for a single `Monitor.save`).
+
+        Parameters
+        ----------
+        model_predict : function
+            Takes a dictionary {'stim': X} and returns a dictionary {'loss': rates}
+            (e.g. the predict method of a Keras graph model)
+
+        chunksize : int, optional
+            Number of samples to pass through the model at once (Default: as many as
+            fit in max_bytes)
+
+        max_bytes : int, optional
+            Maximum size (in bytes) of a chunk of the stimulus, if no chunksize is given
+            (Default: 256MB)
+
+        memory : int, optional
+            Number of recent predictions to remember (Default: 4)
+        """
+        self.model_predict = model_predict
+        self.chunksize = chunksize
+        self.max_bytes = max_bytes
+        self.memory = memory
+
+        # number of calls that ran the model, and that were answered from memory
+        self.calls = 0
+        self.hits = 0
+
+        self._recent = []
+        self._builder = BatchBuilder()
+
+    def __call__(self, data):
+        X = data['stim']
+        key = _identity(X)
+
+        for previous, _, rhat in self._recent:
+            if previous == key:
+                self.hits += 1
+                return rhat
+
+        rhat = {'loss': self._predict(X)}
+        self.calls += 1
+
+        # the stimulus is kept alive along with its key, so that its id is not reused
+        self._recent = [(key, X, rhat)] + self._recent[:(self.memory - 1)]
+        return rhat
+
+    def _predict(self, X):
+        """Runs the model on the stimulus, in chunks"""
+        nsamples = len(X)
+        chunksize = self.chunksize or max(1, self.max_bytes // max(1, _sample_bytes(X)))
+
+        if nsamples <= chunksize:
+            return self.model_predict({'stim': X if isinstance(X, np.ndarray) else np.asarray(X)})['loss']
+
+        out = None
+        for start in range(0, nsamples, chunksize):
+            stop = min(start + chunksize, nsamples)
+            if isinstance(X, np.ndarray):
+                chunk = X[start:stop]
+            else:
+                chunk, = self._builder(np.arange(start, stop), X)
+
+            rates = self.model_predict({'stim': chunk})['loss']
+            if out is None:
+                out = np.empty((nsamples,) + rates.shape[1:], dtype=rates.dtype)
+            out[start:stop] = rates
+
+        return out
+
+
+def _identity(X):
+    """Identifies an array by its object, memory location, shape and strides"""
+    if isinstance(X, np.ndarray):
+        return (id(X), X.__array_interface__['data'][0], X.shape, X.strides, X.dtype.str)
+    return (id(X), len(X))
+
+
+def _sample_bytes(X):
+    """Size of a single sample of the stimulus, as float32"""
+    return int(np.prod(X.shape[1:])) * 4
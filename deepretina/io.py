@@ -8,8 +8,18 @@ from json import dumps
 from collections import namedtuple
 from itertools import product
 from functools import wraps
-from .utils import notify, allmetrics
-from warnings import warn
+from threading import Thread, Condition
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+from collections import deque
+import copy
+from .utils import notify, allmetrics, weights_digest, get_weights, set_weights
+from .profiling import phase, attributed
+from .inference import Predictor
+from .checkpoints import WeightStore
+from .mirror import Mirror
+from .schedules import Schedule, Every
+from warnings import catch_warnings, simplefilter
 import numpy as np
 import inspect
 import subprocess
@@ -24,8 +34,11 @@ import h5py
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
 
-__all__ = ['Monitor', 'KerasMonitor', 'main_wrapper']
+__all__ = ['Monitor', 'KerasMonitor', 'AsyncMonitor', 'ResultsWriter', 'PerformancePlot', 'main_wrapper']
 
 directories = {
     'dropbox': path.expanduser('~/Dropbox/deep-retina/saved/'),
@@ -34,7 +47,9 @@ directories = {
 
 
 class Monitor:
-    def __init__(self, name, model, experiment, readme, save_every):
+    def __init__(self, name, model, experiment, readme, save_every, full_validation=False, plot_every=1,
+                 figure_format='png', max_cell_plots=None, plot_workers=0, multipanel=False, keep_last=None,
+                 keep_every=None, mirror_interval=10.0, mirror_bandwidth=None):
         """Monitor base class
 
         Parameters
@@ -51,15 +66,75 @@ class Monitor:
         readme : str
             Saves this string as README.md
 
-        save_every : int
-            Parameters are saved only every save_every iterations
+        save_every : int or schedules.Schedule
+            Parameters are saved only every save_every iterations, or whenever the
+            given schedule says so (e.g. schedules.Adaptive, which limits the fraction
+            of the training time spent monitoring)
+
+        full_validation : bool, optional
+            If True, every save evaluates all held out batches instead of a single
+            random one (see `Experiment.validate`). (Default: False)
+
+        plot_every : int, optional
+            The performance plots are updated every plot_every saves, while metrics
+            are logged at every save (Default: 1)
+
+        figure_format : string, optional
+            File format of the saved figures, e.g. 'png' or 'svg' (Default: 'png')
+
+        max_cell_plots : int, optional
+            If given, at most this many cells have their firing rates plotted at each
+            save, rotating through the cells from one save to the next (Default: None)
+
+        plot_workers : int, optional
+            If positive, the firing rate figures are rendered in this many worker
+            processes (Default: 0). The workers are started with the 'spawn' method
+            (not forked from this process and its threads), so the script creating
+            the monitor must guard its entry point with `if __name__ == '__main__'`.
+
+        multipanel : bool, optional
+            If True, the firing rates of all plotted cells are saved as a single
+            figure (rates.png) instead of one figure per cell (Default: False)
+
+        keep_last : int, optional
+            If given, only this many of the most recent weight snapshots are kept
+            in the weight store (Default: None, keep every snapshot)
+
+        keep_every : int, optional
+            Also keep the weights of every Nth save (Default: None). The weights of
+            the best iteration are always kept.
+
+        mirror_interval : float, optional
+            Minimum number of seconds between two copies of the same file to
+            Dropbox (Default: 10.0)
+
+        mirror_bandwidth : int, optional
+            Maximum number of bytes per second copied to Dropbox (Default: no limit)
         """
         self.name = name
         self.model = model
         self.experiment = experiment
         self.save_every = save_every
+        self.schedule = save_every if isinstance(save_every, Schedule) else Every(save_every)
+        self.full_validation = full_validation
+        self.plot_every = plot_every
+        self.figure_format = figure_format
+        self.max_cell_plots = max_cell_plots
+        self.plot_workers = plot_workers
+        self.multipanel = multipanel
         self.metrics = ('cc', 'lli', 'rmse', 'fev')
 
+        # performance figures are kept alive and updated in place
+        self.num_saves = 0
+        self._performance_plots = {}
+
+        # firing rate figures are rendered in a pool of fresh (spawned) processes, which
+        # do not inherit the locks held by this process's threads or its open hdf5 files
+        self._cell_offset = 0
+        self._plot_pool = None
+        if plot_workers > 0 and not multipanel:
+            self._plot_pool = ProcessPoolExecutor(plot_workers, mp_context=mp.get_context('spawn'))
+
         # information about the machine this is running on
         machine = {
             'machine': uname()[1],
@@ -84,15 +159,22 @@ class Monitor:
             for _, d in directories.items():
                 mkdir(path.join(d, self.directory))
 
+            # files are copied to dropbox in the background
+            self.mirror = Mirror(path.join(directories['dropbox'], self.directory), min_interval=mirror_interval,
+                                 max_bytes_per_second=mirror_bandwidth, profile_as='monitor.copy_to_dropbox')
+
             # write some generic data to the file
             self._save_text('metadata.json', dumps(machine))
             self._save_text('experiment.json', dumps(self.experiment.info))
             self._save_text('README.md', readme)
 
             # start CSV files for train and validation performance
-            headers = ','.join(('Epoch', 'Iteration') + tuple(map(str.upper, self.metrics))) + '\n'
-            self._save_text('train.csv', headers)
-            self._save_text('validation.csv', headers)
+            headers = ','.join(('Epoch', 'Iteration') + tuple(map(str.upper, self.metrics)))
+            self._save_text('train.csv', headers + '\n')
+            self._save_text('validation.csv', headers + ',SAMPLES_PER_SECOND\n')
+
+            # compressed, deduplicated weight snapshots (see checkpoints.WeightStore)
+            self.weights = WeightStore(self._dbpath('weights'), keep_last=keep_last, keep_every=keep_every)
 
             # store results in a (new) h5 file
             with h5py.File(self._dbpath('results.h5'), 'x') as f:
@@ -107,14 +189,22 @@ class Monitor:
 
                 # initialize some datasets
                 N = np.array(self.experiment.info['cells']).size
-                f.create_dataset('iter', (0,), maxshape=(None,))
-                f.create_dataset('epoch', (0,), maxshape=(None,))
+                f.create_dataset('iter', (0,), maxshape=(None,), chunks=(64,), fillvalue=np.nan)
+                f.create_dataset('epoch', (0,), maxshape=(None,), chunks=(64,), fillvalue=np.nan)
+
+                # throughput (samples per second) of each validation pass, which makes its cost visible
+                f.create_dataset('validation_throughput', (0,), maxshape=(None,), chunks=(64,), fillvalue=np.nan)
 
                 for k, m in product(('train', 'validation'), self.metrics):
-                    f.create_dataset('/'.join((k, m)), (0, N), maxshape=(None, N))
+                    f.create_dataset('/'.join((k, m)), (0, N), maxshape=(None, N), chunks=(64, N),
+                                     fillvalue=np.nan)
 
                 for fname, m in product(self.experiment._test_data.keys(), self.metrics):
-                    f.create_dataset('/'.join(('test', fname, m)), (0, N), maxshape=(None, N))
+                    f.create_dataset('/'.join(('test', fname, m)), (0, N), maxshape=(None, N), chunks=(64, N),
+                                     fillvalue=np.nan)
+
+        # rows of results.h5 are buffered, and written (opening the file only briefly) in batches
+        self.results = ResultsWriter(self._dbpath('results.h5'))
 
     def _update_best(self, epoch, iteration):
         """Called when there is a new best iteration"""
@@ -122,16 +212,84 @@ class Monitor:
 
     def cleanup(self, iteration, elapsed_time):
         """Called when the model has finished training"""
+        self.results.close()
+        if self._plot_pool is not None:
+            self._plot_pool.shutdown()
+        with phase('monitor.flush_dropbox'):
+            self.mirror.close()
         print('Finished training model {} after {} iterations and {} hours.'
               .format(self.hashkey, iteration, elapsed_time / 3600.))
 
+    def should_save(self, iteration):
+        """Whether to save at the given iteration (see save_every)
+
+        A save that is due is submitted to the schedule right away, so that the
+        schedule moves on even if the save runs (or is dropped) in the background
+        """
+        due = self.schedule(iteration)
+        if due:
+            self.schedule.submit(iteration)
+        return due
+
+    def get_state(self):
+        """The state of the monitor, as a JSON serializable dictionary (see checkpoints.save_checkpoint)"""
+        self.results.flush()
+        return {
+            'hashkey': self.hashkey,
+            'directory': self.directory,
+            'best': [int(self.best.iteration), float(self.best.lli)],
+            'num_saves': self.num_saves,
+            'rows': self.results.count,
+            'cell_offset': self._cell_offset,
+            'schedule': self.schedule.get_state(),
+        }
+
+    def set_state(self, state):
+        """Resumes the monitoring of a previous run, saved with `get_state`
+
+        Results are saved to the directories of the previous run (the directories
+        created by this monitor are removed), and any results that were saved after
+        the state was taken are discarded.
+        """
+        assert self.num_saves == 0, "the state of a monitor can only be restored before it saves"
+
+        if state['directory'] != self.directory:
+            self.results.close()
+            self.mirror.close()
+            for d in directories.values():
+                shutil.rmtree(path.join(d, self.directory))
+
+            self.hashkey = state['hashkey']
+            self.directory = state['directory']
+            self.results = ResultsWriter(self._dbpath('results.h5'))
+            self.mirror = Mirror(path.join(directories['dropbox'], self.directory),
+                                 min_interval=self.mirror.min_interval,
+                                 max_bytes_per_second=self.mirror.max_bytes_per_second,
+                                 profile_as=self.mirror.profile_as)
+            self.weights = WeightStore(self._dbpath('weights'), keep_last=self.weights.keep_last,
+                                       keep_every=self.weights.keep_every)
+
+        # discard results saved after the state was taken (one CSV line per row, after the header)
+        self.results.truncate(state['rows'])
+        for filename in ('train.csv', 'validation.csv'):
+            with open(self._dbpath(filename), 'r') as f:
+                lines = f.readlines()[:state['rows'] + 1]
+            with open(self._dbpath(filename), 'w') as f:
+                f.writelines(lines)
+            self._copy_to_dropbox(filename)
+
+        self.best = namedtuple('Best', ('iteration', 'lli'))(*state['best'])
+        self.num_saves = state['num_saves']
+        self._cell_offset = state['cell_offset']
+        self.schedule.set_state(state['schedule'])
+
     def save(self, epoch, iteration, X_train, r_train, model_predict):
         """Saves relevant information for this epoch/iteration of training
 
         Saves the:
-        - Model weights (as an hdf5 file)
+        - Model weights (in the weight store)
         - Updated performance plots
-        - Updated performance.csv file
+        - Updated performance CSV files (validation.csv includes the validation throughput)
         - Best performance and weights in a separate file
 
         Parameters
@@ -142,62 +300,111 @@ class Monitor:
         iteration : int
             Current iteration of training
         """
-        #rhat_train = model_predict(X_train)
-        #print(X_train.shape)
-        rhat_train = model_predict({'stim': X_train}) #only updating this for graph model
-        #print(rhat_train['loss'].shape)
+        tstart = time.time()
+
+        # identical predictions (e.g. of the training batch) are only computed once per save
+        predict = Predictor(model_predict)
+
+        with phase('monitor.predict'):
+            rhat_train = predict({'stim': X_train})
 
         # training performance
-        avg_train, all_train = allmetrics(r_train, model_predict({'stim': X_train}), self.metrics)
+        with phase('monitor.allmetrics'):
+            avg_train, all_train = allmetrics(r_train, rhat_train, self.metrics)
         data_row = [epoch, iteration] + [avg_train[metric] for metric in self.metrics]
         self._append_csv('train.csv', data_row)
 
         # validation performance
-        (avg_val, all_val), r_val, rhat_val = self.experiment.validate(model_predict, self.metrics)
-        data_row = [epoch, iteration] + [avg_val[metric] for metric in self.metrics]
+        with phase('monitor.validate'):
+            tval = time.time()
+            (avg_val, all_val), r_val, rhat_val = self.experiment.validate(predict, self.metrics,
+                                                                           full=self.full_validation)
+            throughput = r_val.shape[0] / max(time.time() - tval, 1e-12)
+
+        # a full validation pass measures its own throughput (see experiments.validate_all)
+        if self.full_validation and self.experiment.validation_throughput:
+            throughput = self.experiment.validation_throughput['samples_per_second']
+        data_row = [epoch, iteration] + [avg_val[metric] for metric in self.metrics] + [throughput]
         self._append_csv('validation.csv', data_row)
 
         # update the 'best' iteration we have seen, based on the validation log-likelihood
-        if avg_val['lli'] > self.best.lli:
+        improved = avg_val['lli'] > self.best.lli
+        if improved:
             self.best = namedtuple('Best', ('iteration', 'lli'))(iteration, avg_val['lli'])
-            self._update_best(epoch, iteration)
+            with phase('monitor.update_best'):
+                self._update_best(epoch, iteration)
 
-        # evaluate test performance
-        _, all_test = self.experiment.test(model_predict, self.metrics)
+        # evaluate test performance (reusing the predictions if the weights have not changed)
+        with phase('monitor.test'):
+            _, all_test = self.experiment.test(predict, self.metrics, key=weights_digest(self.model))
 
         # update h5 file
-        self._save_h5(epoch, iteration, all_train, all_val, all_test)
+        with phase('monitor.save_h5'):
+            self._save_h5(epoch, iteration, all_train, all_val, all_test, throughput)
 
         # plot the train / test firing rates
-        cells = self.experiment.info['cells']
-        if np.array(cells).size == 1:
-
-            # for one cell
-            filename = 'cell{}'.format(cells)
-            plot_rates(iteration, self.experiment.dt,
-                       train=(r_train, rhat_train['loss']),
-                       validation=(r_val, rhat_val['loss']))
-            self._save_figure(filename)
-
-        else:
-            # for all cells
-            for ix, cell in enumerate(cells):
-                filename = 'cell{}'.format(cell)
-                plot_rates(iteration, self.experiment.dt,
-                           train=(r_train[:, ix], rhat_train['loss'][:, ix]),
-                           validation=(r_val[:, ix], rhat_val['loss'][:, ix]))
-                self._save_figure(filename)
+        with phase('monitor.plot_rates'):
+            self._plot_rates(iteration, r_train, rhat_train['loss'], r_val, rhat_val['loss'])
 
         # plot the performance curves
-        for plottype in ('summary', 'traces'):
-            filename = 'performance_{}'.format(plottype)
-            with h5py.File(self._dbpath('results.h5'), 'r') as f:
-                plot_performance(self.metrics, f, self.experiment.batches_per_epoch, plottype=plottype)
-            self._save_figure(filename, dpi=100)
+        if self.num_saves % self.plot_every == 0:
+            for plottype in ('summary', 'traces'):
+                filename = 'performance_{}'.format(plottype)
+                with phase('monitor.plot_performance'):
+                    if plottype not in self._performance_plots:
+                        self._performance_plots[plottype] = PerformancePlot(self.metrics,
+                                                                            self.experiment.batches_per_epoch,
+                                                                            plottype=plottype)
+                    self._performance_plots[plottype].update(self.results.rows())
+                self._save_figure(filename, dpi=100, figure=self._performance_plots[plottype].figure)
+        self.num_saves += 1
 
         # save the weights
-        filename = 'epoch{:03d}_iter{:05d}_weights.h5'.format(epoch, iteration)
-        self.model.save_weights(self._dbpath(filename))
+        with phase('monitor.save_weights'):
+            self.weights.save(get_weights(self.model), epoch, iteration, best=improved)
+
+        # let the schedule know how long this save took, and how well we are doing
+        self.schedule.update(iteration, time.time() - tstart, avg_val['lli'])
+
+    def _plot_rates(self, iteration, r_train, rhat_train, r_val, rhat_val):
+        """Plots the train / validation firing rates of the cells (or a rotating subset of them)"""
+        cells = self.experiment.info['cells']
+        if np.array(cells).size == 1:
+            names, columns = ['cell{}'.format(cells)], [slice(None)]
+        else:
+            names, columns = ['cell{}'.format(cell) for cell in cells], list(range(len(cells)))
+
+        # rotate through the cells, if only some of them are plotted at each save
+        selected = range(len(names))
+        if self.max_cell_plots is not None and self.max_cell_plots < len(names):
+            selected = [(self._cell_offset + k) % len(names) for k in range(self.max_cell_plots)]
+            self._cell_offset = (self._cell_offset + self.max_cell_plots) % len(names)
+
+        rates = [{'train': (r_train[:, columns[ix]], rhat_train[:, columns[ix]]),
+                  'validation': (r_val[:, columns[ix]], rhat_val[:, columns[ix]])} for ix in selected]
+        names = [names[ix] for ix in selected]
+
+        # a single figure with a row for each cell
+        if self.multipanel:
+            plot_rates_grid(iteration, self.experiment.dt, names, rates)
+            self._save_figure('rates')
+
+        # one figure per cell, rendered in worker processes (the rates are sent to the workers)
+        elif self._plot_pool is not None:
+            filenames = ['.'.join((name, self.figure_format)) for name in names]
+            futures = [self._plot_pool.submit(_render_rates, self._dbpath(filename), self.figure_format, 100,
+                                              iteration, self.experiment.dt, cell_rates)
+                       for filename, cell_rates in zip(filenames, rates)]
+
+            for filename, future in zip(filenames, futures):
+                future.result()
+                self._copy_to_dropbox(filename)
+
+        # one figure per cell
+        else:
+            for name, cell_rates in zip(names, rates):
+                plot_rates(iteration, self.experiment.dt, **cell_rates)
+                self._save_figure(name)
 
     def _dbpath(self, filename):
         """Generates a full path to save the given file in the database directory"""
@@ -219,63 +426,64 @@ class Monitor:
             Whether or not to copy the file to Dropbox (default: True)
         """
         # write the file, appending if it already exists
-        with open(self._dbpath(filename), 'a') as f:
-            f.write(text)
+        with phase('monitor.save_text'):
+            with open(self._dbpath(filename), 'a') as f:
+                f.write(text)
 
         # copy to dropbox
         if dropbox:
             self._copy_to_dropbox(filename)
 
-    def _save_figure(self, filename, filetype='svg', dpi=100, dropbox=True):
-        """Saves the current figure and copies it to Dropbox"""
+    def _save_figure(self, filename, filetype=None, dpi=100, dropbox=True, figure=None):
+        """Saves the current figure (or the given one) and copies it to Dropbox
+
+        The current pyplot figures are closed afterwards, figures that are passed
+        in are left open so they can be updated and saved again
+        """
 
         # set the file extension
+        filetype = filetype or self.figure_format
         fname, ext = path.splitext(filename)
         filename = '.'.join((fname, filetype))
 
         # save the figure and close all
-        plt.savefig(self._dbpath(filename),
-                    format=filetype,
-                    dpi=dpi,
-                    bbox_inches='tight',
-                    transparent=True)
-        plt.close('all')
+        with phase('monitor.save_figure'):
+            (figure or plt).savefig(self._dbpath(filename),
+                                    format=filetype,
+                                    dpi=dpi,
+                                    bbox_inches='tight',
+                                    transparent=True)
+            if figure is None:
+                plt.close('all')
 
         # copy to dropbox
         if dropbox:
             self._copy_to_dropbox(filename)
 
-    def _save_h5(self, epoch, iteration, all_train, all_val, all_test):
-        """Updates the results.h5 file"""
-        with h5py.File(self._dbpath('results.h5'), 'r+') as f:
-
-            # helper function to extend a dataset along the first dimension
-            def extend(key, value):
-                shape = list(f[key].shape)
-                shape[0] += 1
-                f[key].resize(tuple(shape))
-                f[key][-1] = value
+    def _save_h5(self, epoch, iteration, all_train, all_val, all_test, validation_throughput):
+        """Appends a row to the results.h5 file"""
+        row = {'epoch': epoch, 'iter': iteration, 'validation_throughput': validation_throughput}
+        for metric in self.metrics:
+            row['/'.join(('train', metric))] = all_train[metric]
+            row['/'.join(('validation', metric))] = all_val[metric]
 
-            extend('epoch', epoch)
-            extend('iter', iteration)
+            for fname in all_test.keys():
+                row['/'.join(('test', fname, metric))] = all_test[fname][metric]
 
-            for metric in self.metrics:
-                extend('/'.join(('train', metric)), all_train[metric])
-                extend('/'.join(('validation', metric)), all_val[metric])
-
-                for fname, val in all_test.items():
-                    extend('/'.join(('test', fname, metric)), all_test[fname][metric])
+        self.results.append(row)
 
     def _append_csv(self, filename, row):
         """Appends the list of elements in row as a line in the CSV specified by filename"""
-        self._save_text(filename, ','.join(map(str, row)) + '\n')
+        self._save_text(filename, ','.join(map(str, row)) + '\n', dropbox=False)
+        self._copy_to_dropbox(filename, append=True)
 
-    def _copy_to_dropbox(self, filename):
-        """Copy the given file to Dropbox. Overwrites existing destination files"""
-        try:
-            shutil.copy(self._dbpath(filename), path.join(directories['dropbox'], self.directory))
-        except FileNotFoundError:
-            warn('Could not copy {} to Dropbox.\n'.format(filename))
+    def _copy_to_dropbox(self, filename, append=False):
+        """Queues the given file to be copied to Dropbox in the background (see mirror.Mirror)
+
+        If append is True, only the lines appended since the last copy are copied
+        """
+        with phase('monitor.copy_to_dropbox'):
+            self.mirror.push(self._dbpath(filename), append=append)
 
 
 class KerasMonitor(Monitor):
@@ -296,42 +504,529 @@ class KerasMonitor(Monitor):
         readme : string
             a markdown formatted string to save as the README
 
-        save_every : int
-            how often to save (in terms of the number of batches)
+        save_every : int or schedules.Schedule
+            how often to save (in terms of the number of batches), or a save schedule
+
+        full_validation : bool, optional
+            whether to validate on all held out batches at every save (default: False)
+
+        plot_every : int, optional
+            how often to update the performance plots (in terms of the number of saves)
+
+        figure_format : string, optional
+            file format of the saved figures (default: 'png')
+
+        max_cell_plots : int, optional
+            maximum number of cells to plot firing rates for at each save (default: all)
+
+        plot_workers : int, optional
+            number of processes rendering the firing rate figures (default: 0)
+
+        multipanel : bool, optional
+            whether to plot the firing rates of all cells in a single figure (default: False)
+
+        keep_last : int, optional
+            if given, number of most recent weight snapshots to keep (default: keep all)
+
+        keep_every : int, optional
+            also keep the weights of every Nth save (default: None)
+
+        mirror_interval : float, optional
+            minimum number of seconds between two copies of a file to Dropbox (default: 10.0)
+
+        mirror_bandwidth : int, optional
+            maximum number of bytes per second copied to Dropbox (default: no limit)
         """
         super().__init__(*args, **kwargs)
 
 
+class AsyncMonitor:
+    def __init__(self, monitor, shadow=None, backlog=2, policy='drop_oldest'):
+        """Runs a Monitor in a background thread, so that training never waits on it
+
+        Every call to `save` takes a snapshot of the model weights (and a copy of
+        the current batch) and hands it to a worker thread, which loads the weights
+        into a shadow copy of the model and runs `monitor.save` with it. Metrics,
+        plots and weights are therefore saved for the snapshot, while training
+        continues on the original model.
+
+        Parameters
+        ----------
+        monitor : Monitor
+            The monitor to run in the background
+
+        shadow : object, optional
+            A second model with the same architecture as monitor.model, used for
+            evaluating snapshots (Default: built once from monitor.model, by
+            rebuilding and compiling Keras models from their JSON config, and by
+            copying GLMs). Only weights are copied into it for each snapshot.
+
+        backlog : int, optional
+            The maximum number of snapshots waiting to be saved (Default: 2)
+
+        policy : string, optional
+            What to do when a snapshot arrives and the backlog is full (Default: 'drop_oldest')
+            - 'drop_oldest': discard the oldest (most stale) waiting snapshot
+            - 'drop_newest': discard the new snapshot
+            - 'block': wait for the worker to catch up
+        """
+        assert backlog >= 1, "backlog must be at least 1"
+        assert policy in ('drop_oldest', 'drop_newest', 'block'), \
+            "policy must be 'drop_oldest', 'drop_newest' or 'block'"
+
+        self.monitor = monitor
+        self.model = monitor.model
+        self.shadow = _shadow(monitor.model) if shadow is None else shadow
+        self.backlog = backlog
+        self.policy = policy
+
+        # the wrapped monitor saves the weights of the shadow model
+        self.monitor.model = self.shadow
+
+        # number of snapshots that were dropped because the worker fell behind
+        self.dropped = 0
+
+        self._queue = deque()
+        self._busy = False
+        self._closed = False
+        self._error = None
+        self._condition = Condition()
+        self._worker = Thread(target=self._run, name='AsyncMonitor', daemon=True)
+        self._worker.start()
+
+    @property
+    def save_every(self):
+        return self.monitor.save_every
+
+    @property
+    def best(self):
+        """The best iteration among the snapshots saved so far (see `Monitor.best`)"""
+        return self.monitor.best
+
+    def should_save(self, iteration):
+        """Whether to snapshot the model at the given iteration (see `Monitor.should_save`)"""
+        return self.monitor.should_save(iteration)
+
+    def get_state(self):
+        """Waits for the queued snapshots to be saved, and returns the state of the monitor"""
+        self.flush()
+        return self.monitor.get_state()
+
+    def set_state(self, state):
+        """Restores the state of the monitor (see `Monitor.set_state`)"""
+        self.monitor.set_state(state)
+
+    def save(self, epoch, iteration, X_train, r_train, model_predict):
+        """Snapshots the model and queues the snapshot to be saved (see `Monitor.save`)
+
+        model_predict is ignored, since predictions are made with the shadow model
+        """
+        self._raise_error()
+        snapshot = (epoch, iteration, np.array(X_train), np.array(r_train), get_weights(self.model))
+
+        with self._condition:
+            if len(self._queue) >= self.backlog:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                elif self.policy == 'drop_oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._condition.wait_for(lambda: len(self._queue) < self.backlog or self._error is not None)
+
+            self._queue.append(snapshot)
+            self._condition.notify_all()
+
+    def flush(self):
+        """Waits until every queued snapshot has been saved"""
+        with self._condition:
+            self._condition.wait_for(lambda: not (self._queue or self._busy) or self._error is not None)
+        self._raise_error()
+
+    def cleanup(self, iteration, elapsed_time):
+        """Saves the remaining snapshots and stops the worker (see `Monitor.cleanup`)
+
+        The wrapped monitor is cleaned up (finalizing results.h5 and the Dropbox
+        mirror) even if the worker failed, before its error is raised
+        """
+        try:
+            self.flush()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._worker.join()
+            self.monitor.cleanup(iteration, elapsed_time)
+
+    def _run(self):
+        """Saves snapshots from the queue, in the order they were taken"""
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                epoch, iteration, X, r, weights = self._queue.popleft()
+                self._busy = True
+                self._condition.notify_all()
+
+            try:
+                # phases of the save are profiled as background work of this iteration
+                with attributed(iteration):
+                    set_weights(self.shadow, weights)
+                    self.monitor.save(epoch, iteration, X, r, self.shadow.predict)
+
+            except Exception as error:
+                with self._condition:
+                    self._error = error
+                    self._busy = False
+                    self._queue.clear()
+                    self._condition.notify_all()
+                return
+
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+    def _raise_error(self):
+        """Re-raises an error from the worker thread in the training thread"""
+        if self._error is not None:
+            raise RuntimeError('The background monitor failed') from self._error
+
+
+def _shadow(model):
+    """Builds a second model with the architecture of the given one (its weights are set per snapshot)"""
+    if hasattr(model, 'to_json'):
+        from keras.models import model_from_json
+        return model_from_json(model.to_json())
+    return copy.deepcopy(model)
+
+
+class ResultsWriter:
+    def __init__(self, filepath, flush_every=10):
+        """Appends rows to the resizable datasets of an hdf5 file
+
+        Rows are buffered in memory and written to the file every `flush_every`
+        rows. The file is only open while a batch of rows is written (and is
+        flushed before it is closed), so a crash or kill can at most lose the
+        buffered rows, and other processes can read the file in between. The
+        datasets grow geometrically (doubling their number of rows), so they are
+        only resized O(log n) times; rows beyond the ones written are NaN, and the
+        number of valid rows is stored in the 'rows' attribute of the file. The
+        datasets are trimmed to the valid rows when the writer is closed.
+
+        Parameters
+        ----------
+        filepath : string
+            An hdf5 file, whose datasets all have a resizable first dimension
+
+        flush_every : int, optional
+            Number of rows to buffer before writing them to the file (Default: 10)
+        """
+        self.filepath = filepath
+        self.flush_every = flush_every
+        self.closed = False
+
+        with h5py.File(filepath, 'r') as f:
+            keys = []
+            f.visititems(lambda key, obj: keys.append(key) if isinstance(obj, h5py.Dataset) else None)
+            self.keys = [key for key in keys if f[key].maxshape[0] is None]
+
+            # every row so far, in memory (with room to grow)
+            self.count = self._flushed = int(f.attrs.get('rows', f[self.keys[0]].shape[0]))
+            self._data = {}
+            for key in self.keys:
+                dset = f[key]
+                self._data[key] = np.full((max(64, 2 * self.count),) + dset.shape[1:], np.nan, dtype=dset.dtype)
+                self._data[key][:self.count] = dset[:self.count]
+
+    def append(self, row):
+        """Appends a row, given as a dictionary with a value for each dataset"""
+        if self.count == len(self._data[self.keys[0]]):
+            for key in self.keys:
+                grown = np.full((2 * self.count,) + self._data[key].shape[1:], np.nan, dtype=self._data[key].dtype)
+                grown[:self.count] = self._data[key]
+                self._data[key] = grown
+
+        for key in self.keys:
+            self._data[key][self.count] = row[key]
+        self.count += 1
+
+        if self.count - self._flushed >= self.flush_every:
+            self.flush()
+
+    def rows(self):
+        """The rows so far, as a nested dictionary of arrays (e.g. rows()['train']['cc'])"""
+        results = {}
+        for key in self.keys:
+            *groups, name = key.split('/')
+            node = results
+            for group in groups:
+                node = node.setdefault(group, {})
+            node[name] = self._data[key][:self.count]
+        return results
+
+    def truncate(self, count):
+        """Discards every row after the first count rows"""
+        assert 0 <= count <= self.count, "can only discard existing rows"
+        for key in self.keys:
+            self._data[key][count:self.count] = np.nan
+
+        if not self.closed:
+            with h5py.File(self.filepath, 'r+') as f:
+                for key in self.keys:
+                    end = min(self._flushed, f[key].shape[0])
+                    if count < end:
+                        f[key][count:end] = np.nan
+                f.attrs['rows'] = count
+                f.flush()
+
+        self.count = count
+        self._flushed = min(self._flushed, count)
+
+    def flush(self):
+        """Writes the buffered rows to the file"""
+        if self.closed or self._flushed == self.count:
+            return
+
+        with h5py.File(self.filepath, 'r+') as f:
+            for key in self.keys:
+                dset = f[key]
+                if dset.shape[0] < self.count:
+                    dset.resize((max(self.count, 2 * dset.shape[0]),) + dset.shape[1:])
+                dset[self._flushed:self.count] = self._data[key][self._flushed:self.count]
+
+            f.attrs['rows'] = self.count
+            f.flush()
+        self._flushed = self.count
+
+    def close(self):
+        """Writes the remaining rows and trims the datasets"""
+        if self.closed:
+            return
+
+        self.flush()
+        with h5py.File(self.filepath, 'r+') as f:
+            for key in self.keys:
+                dset = f[key]
+                dset.resize((self.count,) + dset.shape[1:])
+        self.closed = True
+
+
 def plot_rates(iteration, dt, **rates):
     """Plots the given pairs of firing rates"""
 
     # create the figure
     fig, axs = plt.subplots(len(rates), 1, figsize=(16, 10))
 
-    # for now, manually choose indices to plot
-    batchsize = rates['train'][0].shape[0]
-    if batchsize > 3000:
-        i0, i1 = (2000, 3000)
-    else:
-        i0, i1 = (0, batchsize - 1)
-    inds = slice(i0, i1)
-
+    inds = _rate_window(rates['train'][0].shape[0])
     for ax, key in zip(axs, sorted(rates.keys())):
-        t = dt * np.arange(rates[key][0].size)
-        ax.plot(t[inds], rates[key][0][inds], '-', color='powderblue', label='Data')
-        ax.fill_between(t[inds], 0, rates[key][0][inds].ravel(), facecolor='powderblue', alpha=0.8)
-        ax.plot(t[inds], rates[key][1][inds], '-', color='firebrick', label='Model')
-        ax.set_title(str.upper(key) + ' [iter {}]'.format(iteration), fontsize=20)
-        ax.set_xlabel('Time (s)', fontsize=16)
-        ax.set_ylabel('Firing Rate (Hz)', fontsize=16)
-        ax.set_xlim(t[i0], t[i1])
-        despine(ax)
+        _plot_rate(ax, str.upper(key) + ' [iter {}]'.format(iteration), dt, inds, *rates[key])
 
     plt.legend(loc='best', fancybox=True, frameon=True)
     plt.tight_layout()
     return fig
 
 
+def plot_rates_grid(iteration, dt, names, rates):
+    """Plots the firing rates of several cells in a single figure
+
+    Parameters
+    ----------
+    iteration : int
+        The current iteration (shown in the titles)
+
+    dt : float
+        Sampling interval (in seconds)
+
+    names : list of strings
+        The name of each cell (one row of panels per cell)
+
+    rates : list of dicts
+        For each cell, the (data, model) pairs of firing rates to plot (one column
+        of panels per key, see `plot_rates`)
+    """
+    keys = sorted(rates[0].keys())
+    fig, axs = plt.subplots(len(names), len(keys), figsize=(16, 3 * len(names)), squeeze=False)
+
+    for row, name, cell_rates in zip(axs, names, rates):
+        inds = _rate_window(cell_rates['train'][0].shape[0])
+        for ax, key in zip(row, keys):
+            _plot_rate(ax, '{} {} [iter {}]'.format(name, str.upper(key), iteration), dt, inds, *cell_rates[key])
+
+    axs[0][0].legend(loc='best', fancybox=True, frameon=True)
+    plt.tight_layout()
+    return fig
+
+
+def _rate_window(batchsize):
+    """The samples to plot: for now, manually chosen indices"""
+    if batchsize > 3000:
+        return slice(2000, 3000)
+    else:
+        return slice(0, batchsize - 1)
+
+
+def _plot_rate(ax, title, dt, inds, r, rhat):
+    """Plots a single pair of (data, model) firing rates in the given axes"""
+    t = dt * np.arange(r.size)
+    ax.plot(t[inds], r[inds], '-', color='powderblue', label='Data')
+    ax.fill_between(t[inds], 0, r[inds].ravel(), facecolor='powderblue', alpha=0.8)
+    ax.plot(t[inds], rhat[inds], '-', color='firebrick', label='Model')
+    ax.set_title(title, fontsize=20)
+    ax.set_xlabel('Time (s)', fontsize=16)
+    ax.set_ylabel('Firing Rate (Hz)', fontsize=16)
+    ax.set_xlim(t[inds.start], t[inds.stop])
+    despine(ax)
+
+
+def _render_rates(filepath, filetype, dpi, iteration, dt, rates):
+    """Plots and saves a single figure of firing rates (run in a worker process)"""
+    plot_rates(iteration, dt, **rates)
+    plt.savefig(filepath, format=filetype, dpi=dpi, bbox_inches='tight', transparent=True)
+    plt.close('all')
+
+
+class PerformancePlot:
+    def __init__(self, metrics, batches_per_epoch, plottype='summary'):
+        """A performance figure (see `plot_performance`) that is updated in place
+
+        The figure, axes, lines and error bands are created once. The plotted
+        values are kept in arrays that grow in place, and every update only
+        computes the rows added since the last one; the lines are pointed at the
+        (longer) arrays, and the vertices of the existing error bands are replaced,
+        so no artist is recreated. The figure is not managed by pyplot, so it is
+        unaffected by plt.close('all').
+
+        Parameters
+        ----------
+        metrics : list of strings
+            The four metrics to plot
+
+        batches_per_epoch : int
+            Number of training batches per epoch (the x-axis is in epochs)
+
+        plottype : string, optional
+            'summary' (mean + sem across cells) or 'traces' (one curve per cell)
+        """
+        assert len(metrics) == 4, "PerformancePlot assumes there are four metrics to plot"
+        assert plottype in ('summary', 'traces'), "plottype must be 'summary' or 'traces'"
+
+        self.metrics = metrics
+        self.batches_per_epoch = batches_per_epoch
+        self.plottype = plottype
+
+        self.figure = Figure(figsize=(16, 10))
+        FigureCanvasAgg(self.figure)
+        axs = self.figure.subplots(2, 2)
+        self.axes = {metric: axs[inds[0]][inds[1]] for metric, inds in zip(metrics, product((0, 1), repeat=2))}
+
+        # lines (and error bands) for each metric and key, created on the first update
+        self.lines = {}
+        self.bands = {}
+        self._decorated = False
+
+        # the plotted values of the rows so far (with room to grow)
+        self.count = 0
+        self._x = np.full(64, np.nan)
+        self._values = {}
+
+    def update(self, results):
+        """Updates the figure with the rows of the given results (e.g. `ResultsWriter.rows()`) added since the last update"""
+        rows = len(results['iter'])
+
+        # rows were discarded (e.g. when resuming from a checkpoint), so start over
+        if rows < self.count:
+            self.count = 0
+        if rows == self.count:
+            return self.figure
+
+        new = slice(self.count, rows)
+        self._x = self._grow(self._x, rows)
+        self._x[new] = np.asarray(results['iter'][new], dtype='float') / float(self.batches_per_epoch)
+        x = self._x[:rows]
+
+        for metric in self.metrics:
+            ax = self.axes[metric]
+            for key, color, fmt in [('validation', 'lightcoral', '-'), ('train', 'skyblue', '--')]:
+                res = np.asarray(results[key][metric][new])
+
+                if self.plottype == 'summary':
+                    with catch_warnings():
+                        simplefilter('ignore', RuntimeWarning)
+                        y, ye = self._append(metric, key, rows, np.nanmean(res, axis=1),
+                                             np.nanstd(res, axis=1) / np.sqrt(res.shape[1]))
+
+                    if (metric, key) not in self.lines:
+                        self.lines[metric, key], = ax.plot(x, y, '-', color=color, label=key)
+                        self.bands[metric, key] = ax.add_collection(
+                            PolyCollection(_band_polygons(x, y - ye, y + ye), alpha=0.2, color=color),
+                            autolim=False)
+                    else:
+                        self.lines[metric, key].set_data(x, y)
+                        self.bands[metric, key].set_verts(_band_polygons(x, y - ye, y + ye))
+
+                else:
+                    traces, = self._append(metric, key, rows, res)
+                    if (metric, key) not in self.lines:
+                        self.lines[metric, key] = ax.plot(x, traces, fmt, alpha=0.5)
+                    else:
+                        for line, trace in zip(self.lines[metric, key], traces.T):
+                            line.set_data(x, trace)
+
+            ax.relim()
+            ax.autoscale_view()
+
+        self.count = rows
+
+        # labels, limits and layout are only set once
+        if not self._decorated:
+            for metric in self.metrics:
+                ax = self.axes[metric]
+
+                # hard-coded y-scale for certain metrics
+                if metric == 'fev':
+                    ax.set_ylim(-0.5, 0.5)
+                    ax.set_autoscaley_on(False)
+
+                ax.set_title(str.upper(metric), fontsize=20)
+                ax.set_xlabel('Epoch', fontsize=16)
+                despine(ax)
+
+            if self.plottype == 'summary':
+                self.axes[self.metrics[0]].legend(loc='best', frameon=True, fancybox=True)
+            self.figure.tight_layout()
+            self._decorated = True
+
+        return self.figure
+
+    def _append(self, metric, key, rows, *values):
+        """Stores the values of the new rows for the given metric and key, and returns the values of all rows"""
+        buffers = self._values.get((metric, key), [np.full((64,) + v.shape[1:], np.nan) for v in values])
+        self._values[metric, key] = [self._grow(buf, rows) for buf in buffers]
+        for buf, v in zip(self._values[metric, key], values):
+            buf[self.count:rows] = v
+        return [buf[:rows] for buf in self._values[metric, key]]
+
+    @staticmethod
+    def _grow(buf, rows):
+        """Doubles the number of rows of the array until it holds the given number of rows"""
+        if rows <= len(buf):
+            return buf
+        grown = np.full((max(rows, 2 * len(buf)),) + buf.shape[1:], np.nan)
+        grown[:len(buf)] = buf
+        return grown
+
+
+def _band_polygons(x, lower, upper):
+    """The polygons of an error band between lower and upper (one for each run of finite values)"""
+    finite = np.isfinite(lower) & np.isfinite(upper)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], finite.astype('int8'), [0]))))
+    return [np.column_stack((np.concatenate((x[a:b], x[a:b][::-1])),
+                             np.concatenate((lower[a:b], upper[a:b][::-1]))))
+            for a, b in zip(edges[::2], edges[1::2])]
+
+
 def plot_performance(metrics, results, batches_per_epoch, plottype='summary'):
     """Plots performance traces"""
 
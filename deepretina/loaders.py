@@ -0,0 +1,79 @@
+"""
+Background data loading for training
+"""
+
+from __future__ import absolute_import, division, print_function
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .experiments import BatchBuilder
+
+__all__ = ['prefetch']
+
+
+def prefetch(experiment, shuffle, depth=2, workers=1, seed=None, order=None):
+    """Yields training batches that are assembled ahead of time in background threads
+
+    Wraps `Experiment.train`, so that the next `depth` batches are loaded while
+    the model is training on the current one. Copying batches with numpy (and
+    reading memory-mapped or hdf5 stimuli) releases the GIL, so the worker
+    threads run concurrently with the optimizer step. The batches are yielded in
+    the same order as `experiment.train(shuffle, seed=seed)`, independent of how
+    the workers are scheduled.
+
+    Parameters
+    ----------
+    experiment : experiments.Experiment
+        The experiment to load training batches from
+
+    shuffle : boolean
+        Whether or not to shuffle the order of the batches
+
+    depth : int, optional
+        The maximum number of batches to load ahead of the current one (Default: 2)
+
+    workers : int, optional
+        Number of background threads assembling batches (Default: 1)
+
+    seed : int, optional
+        Seed for shuffling the batches (Default: use the global numpy random state)
+
+    order : array_like, optional
+        The indices of the batches to load, in order (Default: experiment.batch_order(shuffle, seed))
+
+    Notes
+    -----
+    Each batch is stored in one of (depth + 1) reusable buffers, so a yielded
+    batch is only valid until the next batch is requested.
+    """
+    assert depth >= 1, "depth must be at least 1"
+    assert workers >= 1, "workers must be at least 1"
+
+    if order is None:
+        order = experiment.batch_order(shuffle, seed)
+
+    # one set of buffers for every batch that can be loading or in use at the same time
+    builders = [BatchBuilder() for _ in range(depth + 1)]
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    def submit(k):
+        if k < len(order):
+            pending.append(pool.submit(experiment.batch, order[k], builders[k % len(builders)]))
+
+    try:
+        for k in range(depth):
+            submit(k)
+
+        for k in range(len(order)):
+            batch = pending.popleft().result()
+
+            # the buffers of the previous batch are free again, since the caller has moved on
+            submit(k + depth)
+
+            yield batch
+
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
@@ -3,13 +3,14 @@ Metrics comparing predicted and recorded firing rates
 """
 
 from __future__ import absolute_import, division, print_function
+import warnings
 import numpy as np
 import sklearn
 from scipy.stats import pearsonr
 from functools import wraps
 from tqdm import tqdm
 
-__all__ = ['cc', 'lli', 'rmse', 'fev']
+__all__ = ['cc', 'lli', 'rmse', 'fev', 'StreamingMetrics']
 
 
 def multicell(metric):
@@ -74,6 +75,100 @@ def fev(r, rhat):
     return 1.0 - rmse(r, rhat)[0]**2 / r.var()
 
 
+class StreamingMetrics(object):
+    """Accumulates the metrics above over many batches of data
+
+    Keeps per-cell sufficient statistics (means, centered second moments and the
+    co-moment of r and rhat, merged across batches with the pairwise update of
+    Chan et. al. (1979), as in experiments._streaming_moments), so that the scores
+    over all of the data can be computed without keeping the batches around. The
+    scores match calling the metric functions on the concatenated batches, and
+    are NaN where those are undefined (e.g. the correlation with a constant).
+    """
+    supported = ('cc', 'lli', 'rmse', 'fev')
+
+    def __init__(self, functions):
+        """
+        Parameters
+        ----------
+        functions : list of strings
+            Which metrics to compute (a subset of StreamingMetrics.supported)
+        """
+        assert set(functions) <= set(self.supported), \
+            "Streaming metrics are only available for {}".format(self.supported)
+        self.functions = functions
+        self.count = 0
+        self.stats = None
+
+    def update(self, r, rhat):
+        """Adds a batch of true and model responses, with shape (# of samples, # of cells)"""
+        r = np.asarray(r, dtype='float64').reshape(len(r), -1)
+        rhat = np.asarray(rhat, dtype='float64').reshape(len(rhat), -1)
+        n = r.shape[0]
+        if n == 0:
+            return
+
+        mean_r, mean_rhat = r.mean(axis=0), rhat.mean(axis=0)
+        batch = {
+            'mean_r': mean_r,
+            'mean_rhat': mean_rhat,
+            'm2_r': ((r - mean_r) ** 2).sum(axis=0),
+            'm2_rhat': ((rhat - mean_rhat) ** 2).sum(axis=0),
+            'comoment': ((r - mean_r) * (rhat - mean_rhat)).sum(axis=0),
+            'sse': ((rhat - r) ** 2).sum(axis=0),
+            'loglik': (r * np.log(rhat + 1e-9) - rhat).sum(axis=0),
+
+            # a constant response has no variance, which rounding errors can hide
+            'constant_r': (r == r[0]).all(axis=0),
+            'constant_rhat': (rhat == rhat[0]).all(axis=0),
+            'first_r': r[0],
+            'first_rhat': rhat[0],
+        }
+
+        if self.stats is None:
+            self.stats = batch
+            self.count = n
+            return
+
+        # merge the centered moments of the batch into the running totals
+        s, count = self.stats, self.count
+        total = count + n
+        delta_r = batch['mean_r'] - s['mean_r']
+        delta_rhat = batch['mean_rhat'] - s['mean_rhat']
+        s['m2_r'] += batch['m2_r'] + delta_r ** 2 * (count * n / total)
+        s['m2_rhat'] += batch['m2_rhat'] + delta_rhat ** 2 * (count * n / total)
+        s['comoment'] += batch['comoment'] + delta_r * delta_rhat * (count * n / total)
+        s['mean_r'] += delta_r * (n / total)
+        s['mean_rhat'] += delta_rhat * (n / total)
+        s['sse'] += batch['sse']
+        s['loglik'] += batch['loglik']
+        s['constant_r'] &= batch['constant_r'] & (batch['first_r'] == s['first_r'])
+        s['constant_rhat'] &= batch['constant_rhat'] & (batch['first_rhat'] == s['first_rhat'])
+        self.count = total
+
+    def scores(self):
+        """Returns the average scores, and the scores for each cell (see utils.allmetrics)"""
+        n, s = float(self.count), self.stats
+        mse = s['sse'] / n
+
+        # undefined (NaN) where either response is constant
+        var_r = np.where(s['constant_r'] | (s['m2_r'] <= 0), np.nan, s['m2_r'] / n)
+        var_rhat = np.where(s['constant_rhat'] | (s['m2_rhat'] <= 0), np.nan, s['m2_rhat'] / n)
+
+        cells = {
+            'cc': (s['comoment'] / n) / np.sqrt(var_r * var_rhat),
+            'lli': s['loglik'] / n,
+            'rmse': np.sqrt(mse),
+            'fev': 1.0 - mse / var_r,
+        }
+
+        all_scores = {function: list(cells[function]) for function in self.functions}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            avg_scores = {function: np.nanmean(all_scores[function]) for function in self.functions}
+        return avg_scores, all_scores
+
+
 def roc(r, rhat):
     """Generates an ROC curve"""
     thresholds = np.linspace(0, 100, 1e2)
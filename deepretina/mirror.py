@@ -0,0 +1,236 @@
+"""
+Background mirroring of files to another directory (e.g. Dropbox)
+
+Files are queued with `push` after they are written, and copied by a background
+thread. Repeated pushes of the same file are coalesced into a single copy, each
+file is copied at most once every `min_interval` seconds, and the total copy
+rate (over all files) can be limited. Files that only ever grow (e.g. CSV logs) can be pushed with
+append=True, in which case only the bytes added since the last copy are written.
+
+>>> mirror = Mirror(os.path.expanduser('~/Dropbox/deep-retina/saved/model'))
+>>> mirror.push('/path/to/train.csv', append=True)
+>>> mirror.close()
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import shutil
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+from time import time, sleep
+from warnings import warn
+from .profiling import phase
+
+__all__ = ['Mirror', 'TokenBucket']
+
+# files are copied in chunks of this many bytes
+CHUNK_BYTES = 2 ** 20
+
+
+class Mirror(object):
+    def __init__(self, destination, min_interval=10.0, max_bytes_per_second=None, profile_as='mirror.copy'):
+        """Copies files to a destination directory in a background thread
+
+        Parameters
+        ----------
+        destination : string
+            The directory to mirror files to. It is not created: if it does not
+            exist (e.g. Dropbox is not set up), a warning is issued for each file
+            that could not be copied.
+
+        min_interval : float, optional
+            Minimum number of seconds between two copies of the same file. Pushes
+            in between are coalesced into a single copy (Default: 10.0)
+
+        max_bytes_per_second : int, optional
+            Limits the rate at which files are copied, over all files (Default: no limit)
+
+        profile_as : string, optional
+            Name of the (background) profiling phase the copies are recorded under
+            (Default: 'mirror.copy')
+
+        Notes
+        -----
+        A file is mirrored as destination/<basename of the file>. Files are
+        replaced atomically, except for appended deltas, which are written to the
+        end of the mirrored file. `flush` and `close` copy every pending file
+        without waiting for min_interval. Errors while copying a file are issued
+        as warnings, and never stop the background thread.
+        """
+        self.destination = destination
+        self.min_interval = min_interval
+        self.max_bytes_per_second = max_bytes_per_second
+        self.profile_as = profile_as
+
+        # one budget of bytes, shared by every copy
+        self._bucket = TokenBucket(max_bytes_per_second) if max_bytes_per_second else None
+
+        # number of copies made and bytes written
+        self.copies = 0
+        self.bytes_copied = 0
+
+        # pending files (source -> whether only appended to), when each was last
+        # copied, and how many bytes of each appended file have been mirrored
+        self._pending = OrderedDict()
+        self._copied_at = {}
+        self._offsets = {}
+
+        self._busy = False
+        self._flushing = 0
+        self._closed = False
+        self._condition = Condition()
+        self._worker = Thread(target=self._run, name='Mirror', daemon=True)
+        self._worker.start()
+
+    def push(self, source, append=False):
+        """Queues a file to be mirrored
+
+        Parameters
+        ----------
+        source : string
+            Path to the file
+
+        append : boolean, optional
+            Whether the file has only been appended to since it was last pushed, so
+            that only the new bytes need to be copied (Default: False)
+        """
+        with self._condition:
+            assert not self._closed, "the mirror has been closed"
+            # a full rewrite since the last copy requires a full copy
+            self._pending[source] = self._pending.get(source, True) and append
+            self._condition.notify_all()
+
+    def flush(self):
+        """Copies every pending file, and waits until they are copied"""
+        with self._condition:
+            self._flushing += 1
+            self._condition.notify_all()
+            while self._pending or self._busy:
+                self._condition.wait()
+            self._flushing -= 1
+
+    def close(self):
+        """Copies every pending file and stops the background thread"""
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+
+    def _run(self):
+        """Copies pending files as they become due"""
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed and not self._pending:
+                        return
+
+                    # the pending file that has gone the longest without a copy
+                    source, delay = self._next()
+                    if source is not None and (delay <= 0 or self._flushing):
+                        break
+                    self._condition.wait(timeout=delay)
+
+                append = self._pending.pop(source)
+                self._busy = True
+
+            # any error is reported, so that the thread keeps going and flush never hangs
+            try:
+                with phase(self.profile_as):
+                    self._copy(source, append)
+            except Exception as error:
+                warn('Could not copy {} to {} ({})'.format(source, self.destination, error))
+            finally:
+                with self._condition:
+                    self._copied_at[source] = time()
+                    self._busy = False
+                    self._condition.notify_all()
+
+    def _next(self):
+        """The pending file to copy next, and the number of seconds until it is due"""
+        if not self._pending:
+            return None, None
+        now = time()
+        due = {source: self._copied_at.get(source, -float('inf')) + self.min_interval - now
+               for source in self._pending}
+        source = min(due, key=due.get)
+        return source, due[source]
+
+    def _copy(self, source, append):
+        """Copies a file, or the bytes appended to it since the last copy"""
+        if not os.path.isdir(self.destination):
+            warn('Could not copy {} to {}: the directory does not exist.\n'.format(
+                os.path.basename(source), self.destination))
+            return
+
+        target = os.path.join(self.destination, os.path.basename(source))
+        offset = self._offsets.get(source, 0)
+        size = os.path.getsize(source)
+
+        # only append if the mirrored file is exactly the part that was copied before
+        if append and 0 < offset <= size and os.path.exists(target) and os.path.getsize(target) == offset:
+            with open(source, 'rb') as src, open(target, 'ab') as dst:
+                src.seek(offset)
+                self._offsets[source] = offset + self._transfer(src, dst)
+
+        else:
+            with open(source, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+                self._offsets[source] = self._transfer(src, dst)
+            shutil.copymode(source, target + '.tmp')
+            os.replace(target + '.tmp', target)
+
+        self.copies += 1
+
+    def _transfer(self, src, dst):
+        """Copies the rest of src to dst, in chunks, within the rate limit"""
+        nbytes = 0
+        while True:
+            chunk = src.read(CHUNK_BYTES)
+            if not chunk:
+                break
+
+            # wait until the chunk fits within the rate limit
+            if self._bucket is not None:
+                self._bucket.consume(len(chunk))
+            dst.write(chunk)
+            nbytes += len(chunk)
+
+        self.bytes_copied += nbytes
+        return nbytes
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        """Limits the average rate of a stream of work (e.g. bytes copied)
+
+        The bucket refills at `rate` tokens per second, up to `capacity` tokens.
+        Taking more tokens than are available leaves the bucket in debt, and the
+        caller waits until the debt is paid off, so the limit holds across calls
+        (and threads) sharing the bucket, not just within each call.
+
+        Parameters
+        ----------
+        rate : float
+            Number of tokens per second
+
+        capacity : float, optional
+            Largest burst of tokens that can be taken without waiting
+            (Default: one second's worth of tokens)
+        """
+        assert rate > 0, "rate must be positive"
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._updated = time()
+        self._lock = Lock()
+
+    def consume(self, tokens):
+        """Takes the given number of tokens, waiting until the bucket has refilled enough"""
+        with self._lock:
+            now = time()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
@@ -0,0 +1,356 @@
+"""
+Data-parallel training across CPU cores
+
+`DataParallel` wraps a Keras model or GLM, and splits every training batch
+across worker processes. Each worker computes the gradient on its slice of the
+batch, the gradients are averaged (weighted by the number of samples in each
+slice) and a single, synchronous optimizer step is taken in the main process.
+The wrapped model can be passed to `core.train` in place of the model:
+
+>>> with DataParallel(model, workers=8) as parallel_model:
+>>>     train(parallel_model, experiment, monitor, num_epochs)
+
+Usage (scaling benchmark on synthetic data)
+-----
+$ python -m deepretina.parallel --workers 8
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import argparse
+import traceback
+import multiprocessing as mp
+from time import time
+import numpy as np
+import tableprint as tp
+from descent.utils import destruct, restruct
+from .glms import GLM
+from .utils import get_weights, set_weights
+
+__all__ = ['DataParallel', 'scaling']
+
+
+class DataParallel(object):
+    def __init__(self, model, workers=None):
+        """Trains a model on batches that are split across worker processes
+
+        Parameters
+        ----------
+        model : keras.models.Model or glms.GLM
+            A compiled Keras model or a GLM. Keras models are recompiled once, to
+            separate computing the gradient from applying the update. This relies on
+            the internals of Keras 0.3 with the Theano backend, and a RuntimeError
+            is raised for models that do not expose them.
+
+        workers : int, optional
+            Number of worker processes (Default: the number of CPU cores)
+
+        Notes
+        -----
+        The workers are forked from the main process, and read the batch and the
+        current parameters from shared memory, so neither is pickled. Stateful
+        layer updates (other than the optimizer's) are not applied. For GLMs, the
+        spike history is reset at the start of each worker's slice of the batch.
+        """
+        self.model = model
+        self.workers = workers or os.cpu_count()
+        assert self.workers >= 1, "workers must be at least 1"
+
+        self.backend = _GLMBackend(model) if isinstance(model, GLM) else _KerasBackend(model)
+
+        self._processes = []
+        self._connections = []
+        self._capacity = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        # everything else (e.g. save_weights) is handled by the wrapped model
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def predict(self, X):
+        return self.model.predict(X)
+
+    def train_on_batch(self, data, y=None):
+        """Takes a single optimizer step on the given batch
+
+        Accepts either the Keras-style dictionary {'stim': X, 'loss': y} used by
+        `core.train`, or the stimulus and responses as separate arguments.
+        Returns a list whose first element is the objective.
+        """
+        X, y = (data['stim'], data['loss']) if y is None else (data, y)
+        nsamples = X.shape[0]
+
+        # (re)start the workers if the batch does not fit in the shared buffers
+        if nsamples > self._capacity or X.shape[1:] != self._X.shape[1:] or y.shape[1:] != self._y.shape[1:]:
+            self.close()
+            self._start(nsamples, X, y)
+
+        # share the batch and the current parameters
+        self._X[:nsamples] = X
+        self._y[:nsamples] = y
+        self._params[:] = self.backend.get_params()
+
+        # split the batch into (nearly) equal slices
+        edges = np.linspace(0, nsamples, self.workers + 1).astype('int')
+        active = [k for k in range(self.workers) if edges[k + 1] > edges[k]]
+        for k in active:
+            self._connections[k].send((edges[k], edges[k + 1]))
+
+        objectives = []
+        for k in active:
+            objective, error = self._connections[k].recv()
+            if error is not None:
+                raise RuntimeError('Worker {} failed:\n{}'.format(k, error))
+            objectives.append(objective)
+
+        # average the objectives and gradients, weighted by the size of each slice
+        weights = np.diff(edges)[active] / nsamples
+        objective = float(np.dot(weights, objectives))
+        gradient = np.dot(weights, self._gradients[active])
+
+        return [self.backend.apply(objective, gradient)]
+
+    def close(self):
+        """Stops the worker processes"""
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        self._processes = []
+        self._connections = []
+        self._capacity = 0
+
+    def _start(self, nsamples, X, y):
+        """Allocates the shared buffers and forks the worker processes"""
+        ctx = mp.get_context('fork')
+        nparams = self.backend.get_params().size
+
+        self._capacity = nsamples
+        self._X = _shared(ctx, (nsamples,) + X.shape[1:], X.dtype)
+        self._y = _shared(ctx, (nsamples,) + y.shape[1:], y.dtype)
+        self._params = _shared(ctx, (nparams,), 'float64')
+        self._gradients = _shared(ctx, (self.workers, nparams), 'float64')
+
+        # each worker draws different random numbers (e.g. GLM spikes)
+        seeds = np.random.randint(2 ** 31, size=self.workers)
+
+        for rank in range(self.workers):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child, self.backend, self._X, self._y,
+                                                        self._params, self._gradients[rank], seeds[rank]))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._processes.append(process)
+            self._connections.append(parent)
+
+
+def _worker(connection, backend, X, y, params, gradient, seed):
+    """Computes gradients on slices of the shared batch, until it receives None"""
+    np.random.seed(seed)
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+
+        start, stop = task
+        try:
+            backend.set_params(params)
+            objective, gradient[:] = backend.gradient(X[start:stop], y[start:stop])
+            connection.send((objective, None))
+        except Exception:
+            connection.send((None, traceback.format_exc()))
+
+    connection.close()
+
+
+def _shared(ctx, shape, dtype):
+    """Allocates a numpy array in shared memory (inherited by forked processes)"""
+    dtype = np.dtype(dtype)
+    buffer = ctx.RawArray('b', max(1, int(np.prod(shape)) * dtype.itemsize))
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class _GLMBackend(object):
+    """Gradients and updates of a GLM, in terms of the flattened parameter vector"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def get_params(self):
+        return np.array(self.model.opt.xk, dtype='float64')
+
+    def set_params(self, params):
+        self.model.opt.xk = np.array(params)
+
+    def gradient(self, X, y):
+        objective, gradient = self.model.loss(X, y)
+        return objective, destruct(gradient)
+
+    def apply(self, objective, gradient):
+        return self.model.update(objective, restruct(gradient, self.model.theta_init))[0]
+
+
+class _KerasBackend(object):
+    """Gradients and updates of a compiled Keras model, in terms of the flattened parameter vector"""
+
+    def __init__(self, model):
+        from keras import backend as K
+
+        # splitting the gradient from the update relies on the internals of Keras 0.3 with Theano
+        _require(hasattr(model, 'loss') and hasattr(model.optimizer, 'get_updates'),
+                 'the model has no compiled loss and optimizer')
+
+        # recompile, capturing the training loss and parameters that are passed to the optimizer
+        optimizer = model.optimizer
+        captured = {}
+        get_updates = optimizer.get_updates
+
+        def capture(params, constraints, loss):
+            captured.update(params=params, constraints=constraints, loss=loss)
+            return get_updates(params, constraints, loss)
+
+        optimizer.get_updates = capture
+        try:
+            model.compile(optimizer=optimizer, loss=model.loss)
+        finally:
+            del optimizer.get_updates
+
+        _require('params' in captured, 'the optimizer was not given the parameters when compiling')
+
+        # the inputs of the training function: stimulus, targets and sample weights
+        function = getattr(getattr(model, '_train', None), 'function', None)
+        _require(hasattr(getattr(function, 'maker', None), 'inputs'),
+                 'the Theano training function (model._train.function.maker) was not found')
+        self.inputs = [i.variable for i in model._train.function.maker.inputs]
+        assert len(self.inputs) == 3, "only models with a single input and output are supported"
+
+        self.params = captured['params']
+        self.shapes = [K.get_value(p).shape for p in self.params]
+        self.dtypes = [K.get_value(p).dtype for p in self.params]
+
+        # computes the loss and gradients (run in the workers)
+        loss = captured['loss']
+        self._gradient = K.function(self.inputs, [loss] + optimizer.get_gradients(loss, self.params))
+
+        # applies the optimizer update given the (averaged) gradients (run in the main process)
+        placeholders = [K.placeholder(ndim=len(shape)) for shape in self.shapes]
+        optimizer.get_gradients = lambda loss, params: placeholders
+        try:
+            updates = get_updates(self.params, captured['constraints'], loss)
+        finally:
+            del optimizer.get_gradients
+        self._apply = K.function(placeholders, [], updates=updates)
+        self.K = K
+
+    def get_params(self):
+        return np.concatenate([self.K.get_value(p).ravel() for p in self.params]).astype('float64')
+
+    def set_params(self, params):
+        for p, value in zip(self.params, self._split(params)):
+            self.K.set_value(p, value)
+
+    def gradient(self, X, y):
+        outputs = self._gradient([X, y, np.ones(X.shape[0], dtype='float32')])
+        return float(outputs[0]), np.concatenate([np.ravel(g) for g in outputs[1:]])
+
+    def apply(self, objective, gradient):
+        self._apply(self._split(gradient))
+        return objective
+
+    def _split(self, flat):
+        """Splits a flattened parameter vector into arrays with the shapes of the parameters"""
+        edges = np.cumsum([0] + [int(np.prod(shape)) for shape in self.shapes])
+        return [flat[a:b].reshape(shape).astype(dtype)
+                for a, b, shape, dtype in zip(edges[:-1], edges[1:], self.shapes, self.dtypes)]
+
+
+def _require(condition, reason):
+    """Fails with a clear message when a Keras model does not expose the internals DataParallel relies on"""
+    if not condition:
+        raise RuntimeError('DataParallel only supports Keras 0.3 models compiled with the Theano backend '
+                           '({}). Train the model without DataParallel instead.'.format(reason))
+
+
+def scaling(model, X, y, workers=None, num_iter=10):
+    """Measures the training throughput of DataParallel with 1 to N workers
+
+    The model is trained on the same batch (X, y) for num_iter steps with each
+    number of workers, after which its weights are restored.
+
+    Parameters
+    ----------
+    model : keras.models.Model or glms.GLM
+        The model to train
+
+    X, y : array_like
+        A single batch of stimuli and responses
+
+    workers : int or list of ints, optional
+        The numbers of workers to measure, or the maximum number of workers
+        (Default: 1 to the number of CPU cores)
+
+    num_iter : int, optional
+        Number of training steps to time for each number of workers (Default: 10)
+
+    Returns
+    -------
+    throughput : dict
+        Samples per second for each number of workers
+    """
+    if workers is None or np.isscalar(workers):
+        workers = range(1, (workers or os.cpu_count()) + 1)
+
+    weights = get_weights(model)
+    throughput = {}
+    baseline = None
+
+    print(tp.header(['Workers', 'Samples/sec', 'Speedup', 'Efficiency']), flush=True)
+    for nworkers in workers:
+        with DataParallel(model, workers=nworkers) as parallel_model:
+
+            # the first step forks the workers
+            parallel_model.train_on_batch(X, y)
+
+            tstart = time()
+            for _ in range(num_iter):
+                parallel_model.train_on_batch(X, y)
+            throughput[nworkers] = num_iter * X.shape[0] / (time() - tstart)
+
+        # speedup and efficiency relative to the first measurement (usually a single worker)
+        baseline = baseline or (nworkers, throughput[nworkers])
+        speedup = throughput[nworkers] / baseline[1]
+        print(tp.row([nworkers, throughput[nworkers], speedup, speedup * baseline[0] / nworkers]), flush=True)
+    print(tp.bottom(4))
+
+    set_weights(model, weights)
+    return throughput
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Data-parallel GLM training throughput on synthetic data')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='maximum number of worker processes')
+    parser.add_argument('--batchsize', type=int, default=5000, help='number of samples per batch')
+    parser.add_argument('--iters', type=int, default=10, help='training steps per measurement')
+    parser.add_argument('--history', type=int, default=40, help='length of the stimulus filter')
+    parser.add_argument('--ncells', type=int, default=4, help='number of cells')
+    args = parser.parse_args()
+
+    filter_shape = (args.history, 20, 20)
+    X = np.random.randn(args.batchsize, *filter_shape).astype('float32')
+    y = np.random.poisson(1.0, size=(args.batchsize, args.ncells)).astype('float32')
+    scaling(GLM(filter_shape, 20, args.ncells), X, y, workers=args.workers, num_iter=args.iters)
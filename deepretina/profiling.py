@@ -0,0 +1,322 @@
+"""
+Lightweight instrumentation of the training loop
+
+Code paths are instrumented with the `phase` context manager, which only records
+timings while a Profiler is active (and costs a single check otherwise):
+
+>>> with phase('monitor.plot_rates'):
+>>>     plot_rates(...)
+
+A Profiler collects these timings per iteration, writes them to a structured
+(JSON lines) log, summarizes them with percentiles, and can run cProfile on
+every Nth iteration. Phases that run in other threads (e.g. an AsyncMonitor's
+worker) are not charged to the training thread's current iteration; they are
+logged and summarized separately, tagged with the iteration given to
+`attributed` in that thread:
+
+>>> with attributed(iteration):
+>>>     monitor.save(...)
+
+`Progress` reports the training loss and throughput, aggregated over all of the
+iterations since its last report, instead of printing every iteration.
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import json
+import cProfile
+import threading
+from time import time
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+import tableprint as tp
+
+__all__ = ['Profiler', 'Progress', 'phase', 'timed', 'attributed']
+
+# the profiler that is currently recording timings, if any
+_active = None
+
+# the iteration that the work in each (background) thread belongs to
+_local = threading.local()
+
+
+@contextmanager
+def phase(name):
+    """Records the time spent in the enclosed block under the given phase name"""
+    if _active is None:
+        yield
+        return
+
+    tstart = time()
+    try:
+        yield
+    finally:
+        _active.record(name, time() - tstart)
+
+
+@contextmanager
+def attributed(iteration):
+    """Attributes the phases recorded in this thread to the given iteration
+
+    Used by background threads, whose work belongs to the iteration it was
+    submitted at rather than the one the training thread is currently on
+    """
+    previous = getattr(_local, 'iteration', None)
+    _local.iteration = iteration
+    try:
+        yield
+    finally:
+        _local.iteration = previous
+
+
+def timed(iterable, name):
+    """Wraps an iterable, recording the time taken to fetch each item as the given phase"""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class Profiler(object):
+    def __init__(self, logfile=None, profile_every=0, profile_dir=None, enabled=True):
+        """Records per-phase timings of the training loop
+
+        Parameters
+        ----------
+        logfile : string, optional
+            If given, the phase timings of each iteration are appended to this file,
+            one JSON object per line, followed by a summary when the profiler is closed
+
+        profile_every : int, optional
+            If positive, every iteration that is a multiple of profile_every is run
+            under cProfile (Default: 0)
+
+        profile_dir : string, optional
+            Directory to write the cProfile stats to, as iter{:06d}.prof files
+            (Default: the current directory)
+
+        enabled : boolean, optional
+            If False, the profiler records nothing (Default: True)
+        """
+        self.enabled = enabled
+        self.profile_every = profile_every
+        self.profile_dir = profile_dir or os.getcwd()
+        self.timings = defaultdict(list)
+
+        # timings of phases that ran outside of the training thread
+        self.background = defaultdict(list)
+
+        self._logfile = open(logfile, 'a') if (enabled and logfile) else None
+        self._current = defaultdict(float)
+        self._previous = None
+        self._thread = threading.get_ident()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        global _active
+        if self.enabled:
+            self._previous, _active = _active, self
+            self._thread = threading.get_ident()
+        return self
+
+    def __exit__(self, *args):
+        global _active
+        if self.enabled:
+            _active = self._previous
+        self.close()
+
+    def record(self, name, seconds):
+        """Adds a timing (in seconds) for the given phase
+
+        Phases recorded in the training thread count towards the current
+        iteration, phases recorded in other threads are logged on their own
+        """
+        if not self.enabled:
+            return
+
+        if threading.get_ident() == self._thread:
+            self.timings[name].append(seconds)
+            self._current[name] += seconds
+            return
+
+        with self._lock:
+            self.background[name].append(seconds)
+            if self._logfile is not None:
+                entry = {'iteration': getattr(_local, 'iteration', None), 'background': name, 'seconds': seconds}
+                self._logfile.write(json.dumps(entry) + '\n')
+
+    @contextmanager
+    def iteration(self, iteration):
+        """Context for a single training iteration
+
+        Logs the phases recorded during the iteration, and runs cProfile if this
+        iteration is a multiple of profile_every
+        """
+        if not self.enabled:
+            yield
+            return
+
+        profile = self.profile_every > 0 and iteration % self.profile_every == 0
+        if profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            yield
+
+        finally:
+            if profile:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, 'iter{:06d}.prof'.format(iteration)))
+
+            if self._logfile is not None:
+                entry = dict(self._current, iteration=iteration)
+                with self._lock:
+                    self._logfile.write(json.dumps(entry) + '\n')
+            self._current.clear()
+
+    def summary(self, background=False):
+        """Summary statistics (in seconds) of the timings of each phase
+
+        If background is True, summarizes the phases that ran outside of the
+        training thread instead
+        """
+        stats = {}
+        with self._lock:
+            timings = {name: list(times) for name, times in (self.background if background else self.timings).items()}
+        for name, times in timings.items():
+            times = np.array(times)
+            stats[name] = {
+                'count': times.size,
+                'total': times.sum(),
+                'mean': times.mean(),
+                'p50': np.percentile(times, 50),
+                'p90': np.percentile(times, 90),
+                'p99': np.percentile(times, 99),
+                'max': times.max(),
+            }
+        return stats
+
+    def report(self):
+        """Prints tables with the summary statistics of each phase (in the training thread, and in the background)"""
+        columns = ('count', 'total', 'mean', 'p50', 'p90', 'p99', 'max')
+        for title, stats in (('Phase', self.summary()), ('Background phase', self.summary(background=True))):
+            if not stats and title != 'Phase':
+                continue
+            width = max([len(name) for name in stats] + [len(title), 11])
+
+            print(tp.header((title,) + columns, width=width))
+            for name in sorted(stats, key=lambda name: -stats[name]['total']):
+                row = [stats[name]['count']] + [tp.humantime(stats[name][c]) for c in columns[1:]]
+                print(tp.row([name] + row, width=width))
+            print(tp.bottom(len(columns) + 1, width=width), flush=True)
+
+    def close(self):
+        """Writes the summary to the log file, and closes it"""
+        if self._logfile is not None:
+            summary = {name: {k: float(v) for k, v in stats.items()} for name, stats in self.summary().items()}
+            background = {name: {k: float(v) for k, v in stats.items()}
+                          for name, stats in self.summary(background=True).items()}
+            self._logfile.write(json.dumps({'summary': summary, 'background': background}) + '\n')
+            self._logfile.close()
+            self._logfile = None
+
+
+class Progress(object):
+    def __init__(self, interval=10.0, every=None, logfile=None, stream=sys.stdout):
+        """Reports the training loss and throughput over windows of iterations
+
+        Each iteration only adds to a few running sums; a row with the mean loss,
+        samples per second and batches per second of the window is written (and
+        flushed) once per report.
+
+        Parameters
+        ----------
+        interval : float, optional
+            Minimum number of seconds between reports (Default: 10.0)
+
+        every : int, optional
+            If given, report every this many iterations instead of based on time
+
+        logfile : string, optional
+            If given, each report is also appended to this file as a JSON object
+
+        stream : file, optional
+            Where to print the table of reports (Default: sys.stdout). If None,
+            reports are only written to the logfile
+        """
+        self.interval = interval
+        self.every = every
+        self.stream = stream
+        self._logfile = open(logfile, 'a') if logfile else None
+        self._reset(time())
+
+    def _reset(self, now):
+        self._start = now
+        self._count = 0
+        self._samples = 0
+        self._loss = 0.0
+        self._train_time = 0.0
+
+    def header(self):
+        """Starts a new table (e.g. at the start of an epoch)"""
+        if self.stream is not None:
+            print(tp.header(['Iteration', 'Loss', 'Samples/s', 'Batches/s', 'Runtime']), file=self.stream)
+        self._reset(time())
+
+    def update(self, iteration, loss, nsamples, seconds):
+        """Adds an iteration (with the given loss, batch size and training time) to the current window"""
+        self._count += 1
+        self._samples += nsamples
+        self._loss += loss
+        self._train_time += seconds
+
+        if self.every is not None:
+            if iteration % self.every == 0:
+                self.report(iteration)
+        else:
+            now = time()
+            if now - self._start >= self.interval:
+                self.report(iteration, now)
+
+    def report(self, iteration, now=None):
+        """Writes the aggregated loss and throughput of the current window"""
+        if self._count == 0:
+            return
+
+        now = now or time()
+        elapsed = max(now - self._start, 1e-12)
+        entry = {
+            'iteration': iteration,
+            'loss': self._loss / self._count,
+            'samples_per_second': self._samples / elapsed,
+            'batches_per_second': self._count / elapsed,
+            'train_on_batch': self._train_time / self._count,
+        }
+
+        if self.stream is not None:
+            print(tp.row([iteration, entry['loss'], entry['samples_per_second'], entry['batches_per_second'],
+                          tp.humantime(entry['train_on_batch'])]), file=self.stream, flush=True)
+
+        if self._logfile is not None:
+            self._logfile.write(json.dumps(entry) + '\n')
+            self._logfile.flush()
+
+        self._reset(now)
+
+    def bottom(self, iteration):
+        """Reports the remaining iterations and ends the table (e.g. at the end of an epoch)"""
+        self.report(iteration)
+        if self.stream is not None:
+            print(tp.bottom(5), file=self.stream, flush=True)
+
+    def close(self):
+        if self._logfile is not None:
+            self._logfile.close()
+            self._logfile = None
@@ -0,0 +1,293 @@
+"""
+Schedules for deciding when to run (expensive) steps during training, and for
+adapting training (learning rate, early stopping) to the validation performance
+"""
+
+from __future__ import absolute_import, division, print_function
+from time import time
+from threading import Lock
+import numpy as np
+
+__all__ = ['Schedule', 'Every', 'Adaptive', 'Plateau']
+
+
+class Schedule(object):
+    """Base class for save schedules
+
+    A schedule is called with the current iteration and returns whether the monitor
+    should save at that iteration. When a save is due, the monitor calls `submit`
+    (in the training thread, even if the save later runs in the background or is
+    dropped), and after every save that completes it calls `update` with the time
+    the save took and the validation score.
+    """
+
+    def __call__(self, iteration):
+        raise NotImplementedError
+
+    def submit(self, iteration):
+        pass
+
+    def update(self, iteration, seconds, score):
+        pass
+
+    def get_state(self):
+        """The history of the schedule, as a JSON serializable dictionary (see `set_state`)"""
+        return {}
+
+    def set_state(self, state):
+        """Restores the history of the schedule (e.g. when resuming from a checkpoint)"""
+        pass
+
+
+class Every(Schedule):
+    def __init__(self, n):
+        """Saves every n iterations
+
+        Parameters
+        ----------
+        n : int
+            How often to save (in terms of the number of batches)
+        """
+        assert n >= 1, "n must be a positive integer"
+        self.n = n
+
+    def __call__(self, iteration):
+        return iteration % self.n == 0
+
+
+class Adaptive(Schedule):
+    def __init__(self, budget=0.05, min_every=1, max_every=None, patience=2, backoff=2.0,
+                 tighten=0.5, max_backoff=16.0, tolerance=0.0):
+        """Saves based on a wall-clock budget, adapting to the validation performance
+
+        The interval between saves is chosen so that at most a `budget` fraction of
+        the training time is spent monitoring. The interval is multiplied by
+        `backoff` (up to `max_backoff` times the budgeted interval) when the
+        validation score has not improved for `patience` saves, and by `tighten`
+        (down to the budgeted interval) whenever it improves.
+
+        Parameters
+        ----------
+        budget : float, optional
+            Maximum fraction of the training time to spend monitoring (Default: 0.05)
+
+        min_every : int, optional
+            Minimum number of iterations between saves (Default: 1)
+
+        max_every : int, optional
+            If given, always save after this many iterations (Default: None)
+
+        patience : int, optional
+            Number of saves without improvement before backing off (Default: 2)
+
+        backoff : float, optional
+            Factor to grow the interval by when the validation score is flat (Default: 2.0)
+
+        tighten : float, optional
+            Factor to shrink the interval by when the validation score improves (Default: 0.5)
+
+        max_backoff : float, optional
+            Largest multiple of the budgeted interval to back off to (Default: 16.0)
+
+        tolerance : float, optional
+            Minimum increase in the validation score that counts as an improvement (Default: 0.0)
+        """
+        assert 0 < budget < 1, "budget must be between 0 and 1"
+        assert min_every >= 1, "min_every must be a positive integer"
+        assert backoff >= 1 and 0 < tighten <= 1, "backoff must be >= 1 and tighten must be in (0, 1]"
+
+        self.budget = budget
+        self.min_every = min_every
+        self.max_every = max_every
+        self.patience = patience
+        self.backoff = backoff
+        self.tighten = tighten
+        self.max_backoff = max_backoff
+        self.tolerance = tolerance
+
+        # multiple of the budgeted interval to wait between saves
+        self.scale = 1.0
+
+        self.best = -np.inf
+        self.stale = 0
+        self.monitor_time = 0.0
+        self.start = None
+        self.last_iteration = None
+        self.next_time = 0.0
+
+        # duration of the most recent save, used to schedule the next save as soon
+        # as one is submitted (saves may complete later, in a background thread)
+        self.last_seconds = None
+
+        # update may be called from a background monitor's thread
+        self._lock = Lock()
+
+    def __call__(self, iteration):
+        with self._lock:
+            # always save at the start of training
+            if self.start is None:
+                self.start = time()
+                return True
+
+            if self.last_iteration is None:
+                return False
+
+            since = iteration - self.last_iteration
+            if since < self.min_every:
+                return False
+
+            if self.max_every is not None and since >= self.max_every:
+                return True
+
+            return time() >= self.next_time
+
+    def submit(self, iteration):
+        with self._lock:
+            self.last_iteration = iteration
+
+            # until the first save has been timed, wait for it (or for max_every)
+            if self.last_seconds is None:
+                self.next_time = np.inf
+            else:
+                self.next_time = time() + self._interval(self.last_seconds)
+
+    def update(self, iteration, seconds, score):
+        with self._lock:
+            now = time()
+            if self.start is None:
+                self.start = now - seconds
+
+            self.last_seconds = seconds
+            self.monitor_time += seconds
+
+            # tighten while the score improves, back off once it has been flat for a while
+            if score > self.best + self.tolerance:
+                self.best = score
+                self.stale = 0
+                self.scale = max(1.0, self.scale * self.tighten)
+            else:
+                self.stale += 1
+                if self.stale >= self.patience:
+                    self.stale = 0
+                    self.scale = min(self.max_backoff, self.scale * self.backoff)
+
+            # wait long enough that both this save and all saves so far fit in the budget
+            next_time = max(now + self._interval(seconds), self.start + self.monitor_time / self.budget)
+
+            # a save submitted since this one was taken has already scheduled the next one
+            if self.last_iteration is None or iteration >= self.last_iteration:
+                self.last_iteration = iteration
+                self.next_time = next_time
+            elif np.isinf(self.next_time):
+                self.next_time = next_time
+            else:
+                self.next_time = max(self.next_time, next_time)
+
+    def _interval(self, seconds):
+        """Time to train between saves that take the given number of seconds"""
+        return self.scale * seconds * (1 - self.budget) / self.budget
+
+    def get_state(self):
+        # wall-clock times are stored relative to now, since a resumed run starts later
+        with self._lock:
+            now = time()
+            return {
+                'scale': self.scale,
+                'best': float(self.best),
+                'stale': self.stale,
+                'monitor_time': self.monitor_time,
+                'elapsed': None if self.start is None else now - self.start,
+                'last_iteration': None if self.last_iteration is None else int(self.last_iteration),
+                'last_seconds': self.last_seconds,
+                'wait': None if np.isinf(self.next_time) else self.next_time - now,
+            }
+
+    def set_state(self, state):
+        with self._lock:
+            now = time()
+            self.scale = state['scale']
+            self.best = state['best']
+            self.stale = state['stale']
+            self.monitor_time = state['monitor_time']
+            self.start = None if state['elapsed'] is None else now - state['elapsed']
+            self.last_iteration = state['last_iteration']
+            self.last_seconds = state['last_seconds']
+            self.next_time = np.inf if state['wait'] is None else now + state['wait']
+
+
+class Plateau(object):
+    def __init__(self, patience, factor=0.5, min_lr=1e-6, stop_patience=None):
+        """Reduces the learning rate, and stops training, when the validation score plateaus
+
+        Driven by the best validation log-likelihood the monitor has seen so far
+        (`Monitor.best`), so it costs nothing beyond the monitor's own validation.
+
+        Parameters
+        ----------
+        patience : int
+            Number of iterations without a new best validation score (and since the
+            last reduction) before the learning rate is reduced
+
+        factor : float, optional
+            Factor to multiply the learning rate by (Default: 0.5)
+
+        min_lr : float, optional
+            The learning rate is never reduced below this value (Default: 1e-6)
+
+        stop_patience : int, optional
+            Number of iterations without a new best validation score before training
+            is stopped (Default: None, never stop early)
+        """
+        assert patience >= 1, "patience must be a positive integer"
+        assert 0 < factor < 1, "factor must be between 0 and 1"
+
+        self.patience = patience
+        self.factor = factor
+        self.min_lr = min_lr
+        self.stop_patience = stop_patience
+
+        # the iteration of the last new best score or learning rate reduction
+        self.last_change = 0
+
+    def __call__(self, iteration, best, lr):
+        """Decides what to do at the given iteration
+
+        Parameters
+        ----------
+        iteration : int
+            The current iteration
+
+        best : Monitor.best
+            The iteration with the best validation log-likelihood so far
+
+        lr : float
+            The current learning rate
+
+        Returns
+        -------
+        action : string
+            'stop' to stop training, 'reduce' to multiply the learning rate by
+            factor, or 'continue'
+        """
+        # nothing to go on until the monitor has validated the model
+        if best.iteration < 0:
+            return 'continue'
+
+        self.last_change = max(self.last_change, best.iteration)
+
+        if self.stop_patience is not None and iteration - best.iteration >= self.stop_patience:
+            return 'stop'
+
+        if iteration - self.last_change >= self.patience and lr * self.factor >= self.min_lr:
+            self.last_change = iteration
+            return 'reduce'
+
+        return 'continue'
+
+    def get_state(self):
+        """The iteration of the last change, as a dictionary (see `set_state`)"""
+        return {'last_change': int(self.last_change)}
+
+    def set_state(self, state):
+        """Restores the state of the schedule (e.g. when resuming from a checkpoint)"""
+        self.last_change = state['last_change']
@@ -0,0 +1,259 @@
+"""
+Parallel hyperparameter sweeps
+
+The experiment is loaded once, in the main process, and the runs are trained in
+worker processes forked from it, so every run reads the same copy of the data
+(numpy arrays and memory-mapped stimuli are shared with the workers, not copied).
+Each worker trains one configuration at a time and takes the next one from a
+shared queue as soon as it is done, keeping every core busy. Runs periodically
+report their validation log-likelihood, and runs that trail the others at the
+same point in training are stopped early.
+
+>>> configs = grid(l2=[1e-3, 1e-2], filter_size=[(13, 13), (15, 7)])
+>>> results = sweep(build_model, experiment, configs, num_epochs=10, workers=8)
+"""
+
+from __future__ import absolute_import, division, print_function
+import os
+import traceback
+import multiprocessing as mp
+from itertools import product
+from queue import Empty
+from time import time
+import numpy as np
+import tableprint as tp
+from .core import train
+
+__all__ = ['grid', 'sweep']
+
+
+def grid(**params):
+    """Every combination of the given hyperparameter values
+
+    Returns
+    -------
+    configs : list of dicts
+        e.g. grid(l2=[0.1, 0.01], dropout=[0.0]) returns
+        [{'l2': 0.1, 'dropout': 0.0}, {'l2': 0.01, 'dropout': 0.0}]
+    """
+    keys = sorted(params.keys())
+    return [dict(zip(keys, values)) for values in product(*(params[key] for key in keys))]
+
+
+def sweep(build, experiment, configs, num_epochs, workers=None, report_every=100, quantile=0.5,
+          min_reports=3, grace=1, full_validation=False, monitor=None, seed=None):
+    """Trains a model for each configuration, in parallel, stopping runs that trail the pack
+
+    Parameters
+    ----------
+    build : function
+        Called as build(**config) in a worker, and returns a compiled Keras model or GLM
+
+    experiment : experiments.Experiment
+        The (already loaded) experiment to train every model on
+
+    configs : list of dicts
+        The hyperparameters of each run (see `grid`)
+
+    num_epochs : int
+        Number of epochs to train each run for
+
+    workers : int, optional
+        Number of worker processes (Default: the number of CPU cores)
+
+    report_every : int, optional
+        How often (in iterations) runs evaluate and report the validation
+        log-likelihood (Default: 100)
+
+    quantile : float, optional
+        A run is stopped (at its next report) if its best validation
+        log-likelihood is below this quantile of the runs that have reached the
+        same report (Default: 0.5)
+
+    min_reports : int, optional
+        Number of runs that must have reached a report before runs are compared
+        there (Default: 3)
+
+    grace : int, optional
+        Number of reports before a run can be stopped (Default: 1)
+
+    full_validation : boolean, optional
+        Whether to evaluate all held out batches at each report, instead of a
+        single random batch (Default: False)
+
+    monitor : function, optional
+        If given, called as monitor(config, model, experiment) in the worker to
+        build an io.Monitor that saves the run's results
+
+    seed : int, optional
+        Runs are seeded with seed + (index of the config) (Default: a random seed)
+
+    Returns
+    -------
+    results : list of dicts
+        For each config, the 'status' of the run ('finished', 'pruned' or
+        'failed'), its best validation log-likelihood ('lli') and the iteration it
+        was reached at, in the order of configs
+    """
+    workers = min(workers or os.cpu_count(), len(configs))
+    assert workers >= 1, "at least one config is required"
+    assert 0 < quantile < 1, "quantile must be between 0 and 1"
+    seed = np.random.randint(2 ** 31 - len(configs)) if seed is None else seed
+
+    ctx = mp.get_context('fork')
+    tasks, messages = ctx.Queue(), ctx.Queue()
+    pruned = ctx.RawArray('b', len(configs))
+
+    for run, config in enumerate(configs):
+        tasks.put((run, config))
+    for _ in range(workers):
+        tasks.put(None)
+
+    # the experiment and build function are inherited by the forked workers, which are not
+    # daemonic, so that runs can start processes of their own (e.g. DataParallel or plot_workers)
+    processes = [ctx.Process(target=_worker, args=(build, experiment, num_epochs, report_every, full_validation,
+                                                   monitor, seed, tasks, messages, pruned), daemon=False)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    reports = [[] for _ in configs]
+    results = [None] * len(configs)
+
+    print(tp.header(['Run', 'Report', 'Iteration', 'Best LLI', 'Status']), flush=True)
+    finished = False
+    try:
+        while any(result is None for result in results):
+            try:
+                message = messages.get(timeout=1.0)
+            except Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise RuntimeError('The sweep workers exited before finishing every run')
+                continue
+
+            kind, run = message[:2]
+            if kind == 'report':
+                iteration, lli = message[2:]
+                reports[run].append(lli)
+                k = len(reports[run]) - 1
+
+                # compare against every run that has reached this report
+                peers = [r[k] for r in reports if len(r) > k]
+                status = 'running'
+                if k >= grace and len(peers) >= min_reports and lli < np.percentile(peers, 100 * quantile):
+                    pruned[run] = 1
+                    status = 'pruning'
+                print(tp.row([run, k, iteration, lli, status]), flush=True)
+
+            else:
+                results[run] = message[2]
+                results[run]['config'] = configs[run]
+                print(tp.row([run, len(reports[run]), results[run]['iteration'], results[run]['lli'],
+                              results[run]['status']]), flush=True)
+        finished = True
+
+    finally:
+        # after every run is done, the workers exit on their own (once their monitors are cleaned up)
+        for process in processes:
+            process.join(timeout=None if finished else 5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    print(tp.bottom(5))
+    return results
+
+
+class _Pruned(Exception):
+    """Raised to stop a run that trails the other runs"""
+
+
+class _SweepMonitor(object):
+    def __init__(self, run, experiment, messages, pruned, report_every, full_validation, monitor=None):
+        """Reports the best validation log-likelihood of a run to the main process
+
+        Wraps (and runs on its own schedule) an optional io.Monitor
+        """
+        self.run = run
+        self.experiment = experiment
+        self.messages = messages
+        self.pruned = pruned
+        self.report_every = report_every
+        self.full_validation = full_validation
+        self.monitor = monitor
+
+        self.best = (-1, -np.inf)
+        self._due = (False, False)
+
+        # the last iteration seen, for cleaning up runs that are pruned or fail
+        self.iteration = 0
+        self.start = time()
+        self._cleaned_up = False
+
+    def should_save(self, iteration):
+        self.iteration = iteration
+        self._due = (iteration > 0 and iteration % self.report_every == 0,
+                     self.monitor is not None and self.monitor.should_save(iteration))
+        return any(self._due)
+
+    def save(self, epoch, iteration, X_train, r_train, model_predict):
+        report, save = self._due
+
+        if save:
+            self.monitor.save(epoch, iteration, X_train, r_train, model_predict)
+
+        if report:
+            (avg_val, _), _, _ = self.experiment.validate(model_predict, ('lli',), full=self.full_validation)
+            if avg_val['lli'] > self.best[1]:
+                self.best = (iteration, float(avg_val['lli']))
+            self.messages.put(('report', self.run, iteration, self.best[1]))
+
+            if self.pruned[self.run]:
+                raise _Pruned()
+
+    def cleanup(self, iteration=None, elapsed_time=None):
+        """Cleans up the wrapped monitor (once), also when the run was pruned or failed"""
+        if self._cleaned_up:
+            return
+        self._cleaned_up = True
+
+        if self.monitor is not None:
+            self.monitor.cleanup(self.iteration if iteration is None else iteration,
+                                 time() - self.start if elapsed_time is None else elapsed_time)
+
+
+def _worker(build, experiment, num_epochs, report_every, full_validation, monitor, seed, tasks, messages, pruned):
+    """Trains configurations from the task queue, until it receives None"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        run, config = task
+        np.random.seed(seed + run)
+        sweep_monitor = None
+        try:
+            model = build(**config)
+            sweep_monitor = _SweepMonitor(run, experiment, messages, pruned, report_every, full_validation,
+                                          monitor(config, model, experiment) if monitor is not None else None)
+            train(model, experiment, sweep_monitor, num_epochs)
+            status = 'finished'
+
+        except _Pruned:
+            status = 'pruned'
+
+        except Exception:
+            traceback.print_exc()
+            status = 'failed'
+
+        # train only cleans up the monitor of runs that finish, so that the results of the
+        # others are flushed (and their background threads and processes stopped) here
+        finally:
+            if sweep_monitor is not None:
+                try:
+                    sweep_monitor.cleanup()
+                except Exception:
+                    traceback.print_exc()
+
+        best = sweep_monitor.best if sweep_monitor is not None else (-1, -np.inf)
+        messages.put(('done', run, {'status': status, 'iteration': best[0], 'lli': best[1]}))
@@ -4,6 +4,7 @@ Generic utilities
 
 from __future__ import absolute_import, division, print_function
 import sys
+import hashlib
 from contextlib import contextmanager
 from . import metrics
 import numpy as np
@@ -11,7 +12,8 @@ from scipy.stats import zscore
 from itertools import combinations, repeat
 from numbers import Number
 
-__all__ = ['notify', 'allmetrics']
+__all__ = ['notify', 'allmetrics', 'weights_digest', 'get_weights', 'set_weights',
+           'get_learning_rate', 'set_learning_rate']
 
 
 def allmetrics(r, rhat, functions):
@@ -38,6 +40,59 @@ def allmetrics(r, rhat, functions):
     return avg_scores, all_scores
 
 
+def weights_digest(model):
+    """Generates an md5 digest of the parameters of a Keras or GLM model
+
+    The digest changes whenever any of the weights change, so it can be used to
+    cache computations that only depend on the model parameters.
+    """
+    weights = get_weights(model)
+    if isinstance(weights, dict):
+        weights = [weights[key] for key in sorted(weights.keys())]
+
+    digest = hashlib.md5()
+    for w in weights:
+        w = np.ascontiguousarray(w)
+        digest.update(str((w.shape, w.dtype.str)).encode('ascii'))
+        digest.update(w.data)
+
+    return digest.hexdigest()
+
+
+def get_weights(model):
+    """Returns a copy of the weights of a Keras model (a list) or GLM (a dictionary)"""
+    if hasattr(model, 'get_weights'):
+        return [np.array(w) for w in model.get_weights()]
+    else:
+        return {key: np.array(value) for key, value in model.theta.items()}
+
+
+def set_weights(model, weights):
+    """Sets the weights of a Keras or GLM model (see `get_weights`)"""
+    if hasattr(model, 'set_weights'):
+        model.set_weights(weights)
+    else:
+        model.set_theta(weights)
+
+
+def get_learning_rate(model):
+    """Returns the learning rate of the optimizer of a Keras or GLM model"""
+    if hasattr(model, 'optimizer'):
+        from keras import backend as K
+        return float(K.get_value(model.optimizer.lr))
+    else:
+        return float(model.opt.lr)
+
+
+def set_learning_rate(model, lr):
+    """Sets the learning rate of the optimizer of a Keras or GLM model"""
+    if hasattr(model, 'optimizer'):
+        from keras import backend as K
+        K.set_value(model.optimizer.lr, lr)
+    else:
+        model.opt.lr = lr
+
+
 @contextmanager
 def notify(title):
     """Context manager for printing messages of the form 'Loading... Done.'
@@ -7,6 +7,7 @@ from deepretina.models import convnet, ln, sequential
 from deepretina.core import train
 from deepretina.experiments import Experiment
 from deepretina.io import KerasMonitor, main_wrapper
+from deepretina.sweep import sweep, grid
 from keras.optimizers import RMSprop
 
 
@@ -69,6 +70,31 @@ def fit_convnet(cells, train_stimuli, exptdate, nclip=0, readme=None):
     return model
 
 
+def sweep_convnet(cells, train_stimuli, exptdate, workers=None):
+    """Fits convnets with different filter sizes, l2 penalties and dropout in parallel"""
+
+    stim_shape = (40, 50, 50)
+    ncells = len(cells)
+    batchsize = 5000
+
+    # load experiment data (once, shared by every run)
+    test_stimuli = ['whitenoise', 'naturalscene']
+    data = Experiment(exptdate, cells, train_stimuli, test_stimuli, stim_shape[0], batchsize, nskip=6000)
+
+    def build(filter_size, l2, dropout):
+        layers = convnet(stim_shape, ncells, num_filters=(8, 16),
+                         filter_size=filter_size, weight_init='normal',
+                         l2_reg_weights=(l2, l2, l2),
+                         dropout=(dropout, 0.0))
+        return sequential(layers, 'adam', loss='poisson')
+
+    def monitor(config, model, experiment):
+        return KerasMonitor('convnet', model, experiment, str(config), save_every=100)
+
+    configs = grid(filter_size=[(13, 13), (15, 7)], l2=[1e-3, 1e-2], dropout=[0.0, 0.1])
+    return sweep(build, data, configs, num_epochs=20, workers=workers, monitor=monitor)
+
+
 if __name__ == '__main__':
     print("deep-retina")
     print("See models.py for examples of how to build models")
@@ -0,0 +1,33 @@
+"""
+Synthetic experiments, written under a temporary home directory
+"""
+
+import numpy as np
+import h5py
+import pytest
+from deepretina import experiments
+
+
+@pytest.fixture
+def home(tmpdir, monkeypatch):
+    """A temporary home directory (holding ~/experiments/data)"""
+    monkeypatch.setenv('HOME', str(tmpdir))
+    return tmpdir
+
+
+@pytest.fixture
+def write_experiment(home, monkeypatch):
+    """Writes synthetic experiment files (train and test splits) under ~/experiments/data"""
+
+    def write(expt, filename, stimulus, ncells=2, num_blocks=1, seed=1):
+        monkeypatch.setitem(experiments.NUM_BLOCKS, expt, num_blocks)
+        directory = home.join('experiments', 'data', expt).ensure(dir=True)
+        rng = np.random.RandomState(seed)
+        with h5py.File(str(directory.join(filename + '.h5')), 'w') as f:
+            for split in ('train', 'test'):
+                f[split + '/time'] = np.arange(len(stimulus)) * 0.01
+                f[split + '/stimulus'] = stimulus
+                f[split + '/response/firing_rate_10ms'] = rng.rand(ncells, len(stimulus))
+        return str(directory.join(filename + '.h5'))
+
+    return write
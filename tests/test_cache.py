@@ -0,0 +1,73 @@
+"""
+Tests for the on-disk cache of preprocessed experiment data in deepretina.cache
+"""
+
+import os
+import numpy as np
+import pytest
+from deepretina import cache
+
+
+@pytest.fixture
+def cachedir(tmpdir, monkeypatch):
+    """An empty cache directory, with the default size limit"""
+    directory = str(tmpdir.join('cache'))
+    monkeypatch.setattr(cache, 'CACHE_DIR', directory)
+    return directory
+
+
+def _store(key, nframes=20, seed=0):
+    """Stores a random stimulus (in chunks of 7 frames) and response under the given key"""
+    rng = np.random.RandomState(seed)
+    stim, resp = rng.randn(nframes, 3, 3).astype('float32'), rng.rand(nframes, 2)
+    chunks = (stim[start:start + 7] for start in range(0, nframes, 7))
+    return stim, resp, cache.store_cached(key, chunks, stim.shape, resp)
+
+
+def test_round_trip(cachedir):
+    assert cache.load_cached('missing') is None
+
+    stim, resp, (cached_stim, cached_resp) = _store('abc')
+    np.testing.assert_array_equal(cached_stim, stim)
+    np.testing.assert_array_equal(cached_resp, resp.astype('float32'))
+    assert isinstance(cached_stim, np.memmap)
+
+    # later loads memory-map the same arrays, and no temporary directories are left behind
+    loaded_stim, loaded_resp = cache.load_cached('abc')
+    np.testing.assert_array_equal(loaded_stim, stim)
+    np.testing.assert_array_equal(loaded_resp, resp.astype('float32'))
+    assert os.listdir(cachedir) == ['abc']
+
+
+def test_cachekey_invalidation():
+    args = ('15-10-07', 'whitenoise', 'train', [0, 1], 6000, True, 1234.5)
+    key = cache.cachekey(*args)
+    assert cache.cachekey(*args) == key
+
+    # a scalar cell and a one element list select the same data
+    assert cache.cachekey('15-10-07', 'whitenoise', 'train', 0, 6000, True, 1234.5) == \
+        cache.cachekey('15-10-07', 'whitenoise', 'train', [0], 6000, True, 1234.5)
+
+    # any change to the load parameters, or to the file on disk, gives a new key
+    for position, value in enumerate(('15-11-21', 'naturalscene', 'test', [0, 2], 0, False, 1234.6)):
+        changed = args[:position] + (value,) + args[position + 1:]
+        assert cache.cachekey(*changed) != key
+
+
+def test_lru_eviction(cachedir, monkeypatch):
+    for k, key in enumerate(('old', 'used', 'new')):
+        _store(key, seed=k)
+        os.utime(os.path.join(cachedir, key), (1000. * k, 1000. * k))
+    size = sum(os.path.getsize(os.path.join(cachedir, 'old', f)) for f in os.listdir(os.path.join(cachedir, 'old')))
+
+    # loading an entry marks it as the most recently used one
+    cache.load_cached('used')
+
+    # storing a fourth entry in a cache that only holds two evicts the least recently used ones
+    monkeypatch.setattr(cache, 'MAX_CACHE_SIZE', 2 * size)
+    _store('newest', seed=3)
+    assert sorted(os.listdir(cachedir)) == ['newest', 'used']
+
+    # entries that should be kept survive even if the cache is too large
+    cache.evict(0, keep=('used',))
+    assert os.listdir(cachedir) == ['used']
@@ -0,0 +1,157 @@
+"""
+Tests for resuming from checkpoints, and the weight store, in deepretina.checkpoints
+"""
+
+import os
+import numpy as np
+import pytest
+from deepretina.experiments import Experiment, ShardedExperiment
+from deepretina.checkpoints import TrainingState, save_checkpoint, load_checkpoint, WeightStore
+
+HISTORY = 5
+
+
+class StubGLM(object):
+    """The parameters and optimizer state of a GLM (see glms.GLM), without the model"""
+
+    class Optimizer(object):
+        pass
+
+    def __init__(self, seed):
+        rng = np.random.RandomState(seed)
+        self.theta = {'filter': rng.randn(HISTORY, 4, 4), 'bias': rng.randn(2)}
+        self.opt = self.Optimizer()
+        self.opt.lr = 0.01 * (seed + 1)
+        self.opt.k = seed
+        self.opt.cache = rng.rand(10)
+
+    def set_theta(self, theta):
+        self.theta = {key: np.array(value) for key, value in theta.items()}
+
+
+def _experiment(kind):
+    """A two-file experiment, with a train / validation split drawn from the global random state"""
+    if kind == 'experiment':
+        return Experiment('synthetic', [0, 1], ['whitenoise', 'naturalscene'], ['whitenoise'], HISTORY, 10,
+                          holdout=0.2, nskip=0)
+    return ShardedExperiment([('synthetic', 'whitenoise'), ('synthetic', 'naturalscene')], [0, 1],
+                             [('synthetic', 'whitenoise')], HISTORY, 10, holdout=0.2, nskip=0, max_resident=1)
+
+
+@pytest.mark.parametrize('kind', ['experiment', 'sharded'])
+def test_resume_mid_epoch(tmpdir, write_experiment, kind):
+    for k, filename in enumerate(('whitenoise', 'naturalscene')):
+        write_experiment('synthetic', filename, np.random.RandomState(k).randn(200, 4, 4).astype('float32'), seed=k)
+    filepath = str(tmpdir.join('checkpoint.h5'))
+
+    # train partway into an epoch
+    np.random.seed(0)
+    experiment = _experiment(kind)
+    model = StubGLM(0)
+    order = experiment.batch_order(shuffle=True)
+    position = 3
+    save_checkpoint(filepath, model, experiment, TrainingState(2, 40, order, position, False))
+    expected_random = np.random.rand(5)
+
+    # a fresh process: a different model, split and random state
+    np.random.seed(1)
+    resumed_experiment = _experiment(kind)
+    resumed = StubGLM(1)
+    assert [list(inds) for _, inds in resumed_experiment.get_split()[0]] != \
+        [list(inds) for _, inds in experiment.get_split()[0]]
+
+    state = load_checkpoint(filepath, resumed, resumed_experiment)
+    assert (state.epoch, state.iteration, state.position, state.stopped) == (2, 40, position, False)
+
+    # weights and optimizer state
+    for key, value in model.theta.items():
+        np.testing.assert_array_equal(resumed.theta[key], value)
+    assert resumed.opt.lr == model.opt.lr and resumed.opt.k == model.opt.k
+    np.testing.assert_array_equal(resumed.opt.cache, model.opt.cache)
+
+    # random number stream
+    np.testing.assert_array_equal(np.random.rand(5), expected_random)
+
+    # the split, including the (tuple) shard keys of a sharded experiment
+    for expected, actual in zip(experiment.get_split(), resumed_experiment.get_split()):
+        assert [key for key, _ in actual] == [key for key, _ in expected]
+        assert all(type(a) is type(e) for (a, _), (e, _) in zip(actual, expected))
+        for (_, a), (_, e) in zip(actual, expected):
+            np.testing.assert_array_equal(a, e)
+    assert resumed_experiment.batches_per_epoch == experiment.batches_per_epoch
+
+    # the remaining batches of the epoch, in the same order
+    np.testing.assert_array_equal(state.order[state.position:], order[position:])
+    for ix in state.order[state.position:]:
+        for a, e in zip(resumed_experiment.batch(ix), experiment.batch(ix)):
+            np.testing.assert_array_equal(a, e)
+
+
+def _blobs(store):
+    return sorted(os.listdir(os.path.join(store.directory, 'blobs')))
+
+
+def test_weight_store_deduplicates(tmpdir):
+    store = WeightStore(str(tmpdir.join('weights')))
+    frozen, bias = np.arange(12.).reshape(3, 4), np.zeros(3)
+
+    # only the layer that changes is stored again
+    for iteration in range(5):
+        store.save([frozen, bias + iteration], 0, iteration)
+    assert len(_blobs(store)) == 1 + 5
+
+    # snapshots are restored as they were saved
+    for iteration in range(5):
+        weights = store.load(iteration)
+        np.testing.assert_array_equal(weights[0], frozen)
+        np.testing.assert_array_equal(weights[1], bias + iteration)
+
+    # as are the dictionaries of GLM parameters
+    store.save({'filter': frozen, 'bias': bias}, 0, 5)
+    assert sorted(store.load().keys()) == ['bias', 'filter']
+    assert len(_blobs(store)) == 1 + 5
+
+
+def test_weight_store_reopens(tmpdir):
+    directory = str(tmpdir.join('weights'))
+    store = WeightStore(directory)
+    for iteration in (0, 10, 20):
+        store.save([np.full(3, iteration)], 0, iteration, best=(iteration == 10))
+
+    reopened = WeightStore(directory)
+    assert reopened.iterations() == [0, 10, 20]
+    assert reopened.best == 10
+    np.testing.assert_array_equal(reopened.load('best')[0], np.full(3, 10))
+
+    # new snapshots continue the numbering of the existing ones
+    reopened.save([np.full(3, 30)], 1, 30)
+    assert reopened.manifests[30]['index'] == 3
+
+
+def test_weight_store_keeps_everything_by_default(tmpdir):
+    store = WeightStore(str(tmpdir.join('weights')))
+    for iteration in range(20):
+        store.save([np.full(3, iteration)], 0, iteration)
+    assert store.iterations() == list(range(20))
+
+
+def test_weight_store_pruning(tmpdir):
+    store = WeightStore(str(tmpdir.join('weights')), keep_last=2, keep_every=4)
+    for iteration in range(10):
+        store.save([np.full(3, iteration), np.ones(2)], 0, iteration, best=(iteration == 1))
+
+    # the most recent snapshots, every 4th one and the best one survive
+    assert store.iterations() == [0, 1, 4, 8, 9]
+    assert WeightStore(store.directory).iterations() == [0, 1, 4, 8, 9]
+    np.testing.assert_array_equal(store.load('best')[0], np.full(3, 1))
+
+    # blobs of the deleted snapshots are garbage collected, shared ones are kept
+    assert len(_blobs(store)) == 5 + 1
+    for iteration in store.iterations():
+        np.testing.assert_array_equal(store.load(iteration)[1], np.ones(2))
+
+    # a new best snapshot replaces the old one, which can then be pruned
+    store.save([np.full(3, 10), np.ones(2)], 0, 10, best=True)
+    assert store.best == 10
+    assert store.iterations() == [0, 4, 8, 9, 10]
+    assert len(_blobs(store)) == 5 + 1
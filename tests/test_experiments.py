@@ -0,0 +1,254 @@
+"""
+Tests for the lazy and reduced precision stimulus loading in deepretina.experiments
+"""
+
+import os
+import warnings
+import numpy as np
+import h5py
+import pytest
+from deepretina import experiments
+from deepretina.experiments import ShardedExperiment, ToeplitzStimulus, BatchBuilder, rolling_window, precision_check, _index_runs
+
+HISTORY = 5
+
+
+@pytest.fixture
+def stimuli(tmpdir):
+    """A lazily loaded stimulus, and the eager array it should match"""
+    frames = np.random.RandomState(0).randn(60, 4, 3).astype('float32')
+    filepath = str(tmpdir.join('stimulus.h5'))
+    with h5py.File(filepath, 'w') as f:
+        f['train/stimulus'] = frames
+
+    # clipping (e.g. at stimulus transitions) leaves non-contiguous valid frames
+    valid = np.concatenate((np.arange(0, 25), np.arange(30, 60)))
+    mean, std = frames.mean(axis=0), frames.std(axis=0)
+
+    lazy = ToeplitzStimulus(filepath, 'train/stimulus', valid, HISTORY, mean=mean, std=std)
+    eager = rolling_window(((frames - mean) / std)[valid], HISTORY)
+    return lazy, eager
+
+
+@pytest.mark.parametrize('key', [
+    5,
+    -1,
+    slice(None),
+    slice(3, 20, 2),
+    np.array([0, 7, 3, 40]),
+    np.arange(50) % 3 == 0,
+    (5, 3),
+    (-2, 0, 1),
+    (slice(2, 10), 3),
+    (slice(None), slice(1, 4), 2),
+    (np.array([1, 4, 8]), -1),
+    (np.array([1, 4, 8]), slice(None), 0, 2),
+    (Ellipsis, 0),
+])
+def test_toeplitz_matches_rolling_window(stimuli, key):
+    lazy, eager = stimuli
+    expected = eager[key]
+    actual = lazy[key]
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_toeplitz_shape(stimuli):
+    lazy, eager = stimuli
+    assert lazy.shape == eager.shape
+    assert len(lazy) == len(eager)
+    np.testing.assert_allclose(np.array(lazy), eager, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('inds', [
+    [],
+    [7],
+    list(range(3, 13)),
+    [0, 1, 2, 10, 11, 5, 6, 6, 40],
+    [9, 8, 7],
+])
+def test_index_runs(inds):
+    inds = np.array(inds, dtype='int64')
+    runs = _index_runs(inds)
+
+    # every run is contiguous, and together they cover the indices in order
+    rebuilt = np.empty_like(inds)
+    for start, stop, offset in runs:
+        assert stop > start
+        rebuilt[offset:offset + stop - start] = np.arange(start, stop)
+    np.testing.assert_array_equal(rebuilt, inds)
+    assert sum(stop - start for start, stop, _ in runs) == inds.size
+    assert [offset for _, _, offset in runs] == sorted(offset for _, _, offset in runs)
+
+
+def test_batch_builder(stimuli):
+    lazy, eager = stimuli
+    responses = np.random.RandomState(1).rand(len(eager), 2)
+    builder = BatchBuilder()
+
+    batches = [np.arange(10, 20), np.array([0, 1, 2, 30, 31, 5]), np.arange(40, 44), np.arange(10, 22)]
+    previous = None
+    for inds in batches:
+        for stimulus in (lazy, eager):
+            X, y = builder(inds, stimulus, responses)
+            np.testing.assert_allclose(X, eager[inds], rtol=1e-5, atol=1e-5)
+            np.testing.assert_array_equal(y, responses[inds])
+            assert builder.bytes_copied == X.nbytes + y.nbytes
+
+        # the buffers are reused (growing when a batch does not fit), so each batch overwrites the last
+        if previous is not None and inds.size <= previous.shape[0]:
+            assert np.shares_memory(X, previous)
+        previous = X
+
+    # a batch of a different shape gets new buffers
+    X, = builder(np.arange(5), responses[:, :1])
+    assert X.shape == (5, 1) and not np.shares_memory(X, previous)
+
+
+def _linear_nonlinear(data):
+    """A fixed LN model, so that stimulus errors show up in its predictions"""
+    X = data['stim'].reshape(data['stim'].shape[0], -1).astype('float64')
+    weights = np.random.RandomState(2).randn(X.shape[1], 2) / np.sqrt(X.shape[1])
+    return {'loss': np.log1p(np.exp(X.dot(weights)))}
+
+
+@pytest.mark.parametrize('name, stimulus, stim_dtype, max_error, score_tol', [
+
+    # binary white noise and 8-bit natural scenes are stored without loss as uint8
+    ('binary', np.random.RandomState(3).randint(2, size=(400, 6, 6)).astype('uint8') * 255, 'uint8', 1e-5, 1e-6),
+    ('scenes', np.random.RandomState(4).randint(256, size=(400, 6, 6)).astype('uint8'), 'uint8', 1e-5, 1e-6),
+
+    # a continuous stimulus is quantized to 1/255 of its range (about 0.03 standard deviations here)
+    ('gaussian', np.random.RandomState(5).randn(400, 6, 6).astype('float32'), 'uint8', 0.05, 1e-2),
+
+    # float16 has a relative precision of 2 ** -11
+    ('gaussian', np.random.RandomState(5).randn(400, 6, 6).astype('float32'), 'float16', 5e-3, 1e-3),
+])
+def test_precision_check(write_experiment, monkeypatch, name, stimulus, stim_dtype, max_error, score_tol):
+    write_experiment('synthetic', name, stimulus)
+
+    # the model only ever sees chunks of the stimulus
+    monkeypatch.setattr(experiments, 'CHUNKSIZE', 64)
+    sizes = []
+
+    def modelrate(data):
+        sizes.append(len(data['stim']))
+        return _linear_nonlinear(data)
+
+    scores, error = precision_check(modelrate, 'synthetic', [0, 1], name, HISTORY, stim_dtype,
+                                    metrics=('cc', 'fev', 'rmse'))
+
+    assert max(sizes) == 64 and len(sizes) > 2
+    assert error <= max_error
+    for metric, (reference, reduced) in scores.items():
+        assert abs(reference - reduced) <= score_tol, metric
+
+
+@pytest.mark.parametrize('options', [
+    {'lazy': True, 'cache': True},
+    {'lazy': True, 'stim_dtype': 'uint8'},
+    {'cache': True, 'stim_dtype': 'float16'},
+    {'compact': True, 'lazy': True},
+    {'compact': True, 'cache': True},
+    {'compact': True, 'stim_dtype': 'uint8'},
+])
+def test_conflicting_load_options(write_experiment, options):
+    write_experiment('synthetic', 'whitenoise', np.random.RandomState(0).randn(100, 4, 4).astype('float32'))
+    with pytest.raises(AssertionError):
+        experiments.Experiment('synthetic', [0, 1], ['whitenoise'], ['whitenoise'], HISTORY, 10, nskip=0, **options)
+
+    # loadexpt checks the options that it handles itself
+    if not options.pop('compact', False):
+        with pytest.raises(AssertionError):
+            experiments.loadexpt('synthetic', [0, 1], 'whitenoise', 'train', HISTORY, 0, **options)
+
+
+def test_loadcompact_warns_when_stale(home, write_experiment, monkeypatch):
+    from deepretina import compact
+    monkeypatch.setattr(compact, 'COMPACT_DIR', str(home.join('compact')))
+    monkeypatch.setattr(experiments, 'COMPACT_DIR', str(home.join('compact')))
+    stimulus = np.random.RandomState(6).randint(256, size=(100, 4, 4)).astype('uint8')
+    write_experiment('synthetic', 'scenes', stimulus)
+    compact.export('synthetic', 'scenes')
+
+    # a fresh export loads without warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        experiments.loadcompact('synthetic', [0, 1], 'scenes', 'test', HISTORY, 0)
+
+    # the original file is modified after the export
+    source = experiments._datapath('synthetic', 'scenes')
+    mtime = os.path.getmtime(source)
+    os.utime(source, (mtime + 10, mtime + 10))
+    with pytest.warns(UserWarning, match='re-export'):
+        experiments.loadcompact('synthetic', [0, 1], 'scenes', 'test', HISTORY, 0)
+
+
+SHARDS = [('synthetic', 'shard{}'.format(k)) for k in range(4)]
+
+
+@pytest.fixture
+def sharded(write_experiment):
+    """A factory of experiments sharded over four recordings, that counts how often each shard is loaded"""
+    for k, (expt, filename) in enumerate(SHARDS):
+        write_experiment(expt, filename, np.random.RandomState(k).randn(100 + 20 * k, 4, 4).astype('float32'), seed=k)
+
+    def make(**kwargs):
+        experiment = ShardedExperiment(SHARDS, [0, 1], SHARDS[:1], HISTORY, 10, holdout=0.1, nskip=0, **kwargs)
+        experiment.loads = []
+        load = experiment._load_data
+
+        def counted(expt, cells, filename, *args, **kw):
+            experiment.loads.append((expt, filename))
+            return load(expt, cells, filename, *args, **kw)
+
+        experiment._load_data = counted
+        return experiment
+
+    return make
+
+
+def test_sharded_lru_eviction(sharded):
+    experiment = sharded(max_resident=2)
+    first = {shard: next(ix for ix, (key, _) in enumerate(experiment.get_split()[0]) if key == shard)
+             for shard in SHARDS}
+
+    for shard in (SHARDS[0], SHARDS[1], SHARDS[0], SHARDS[2], SHARDS[1]):
+        experiment.batch(first[shard])
+
+    # the least recently used shard is evicted, and loaded again when it is needed
+    assert experiment.loads == [SHARDS[0], SHARDS[1], SHARDS[2], SHARDS[1]]
+    assert list(experiment._resident.keys()) == [SHARDS[2], SHARDS[1]]
+
+    # validation reads from separate copies, and leaves the working set alone
+    experiment.validate(lambda data: {'loss': np.ones((data['stim'].shape[0], 2))}, ('cc', 'lli'), full=True)
+    assert list(experiment._resident.keys()) == [SHARDS[2], SHARDS[1]]
+
+
+@pytest.mark.parametrize('mixing, max_loads', [('sequential', 4), ('window', 4), ('random', None)])
+def test_sharded_mixing(sharded, mixing, max_loads):
+    experiment = sharded(max_resident=2, mixing=mixing)
+    batches = experiment.get_split()[0]
+    shards = [key for key, _ in batches]
+
+    order = experiment.batch_order(shuffle=True, seed=0)
+    assert sorted(order) == list(range(len(batches)))
+    np.testing.assert_array_equal(experiment.batch_order(shuffle=True, seed=0), order)
+    np.testing.assert_array_equal(experiment.batch_order(shuffle=False), np.arange(len(batches)))
+
+    # the batches of each shard (sequential), or each group of max_resident shards (window), are contiguous
+    if mixing != 'random':
+        groupsize = 1 if mixing == 'sequential' else 2
+        runs = [shards[order[0]]]
+        for ix in order[1:]:
+            if shards[ix] not in runs[-groupsize:]:
+                runs.append(shards[ix])
+        assert sorted(runs) == sorted(SHARDS)
+
+    # so that every shard is loaded once per epoch
+    for X, y in experiment.train(shuffle=True, seed=0):
+        pass
+    if max_loads is not None:
+        assert len(experiment.loads) == max_loads
+    else:
+        assert len(experiment.loads) > len(SHARDS)
@@ -0,0 +1,78 @@
+"""
+Tests for the buffered results writer in deepretina.io
+"""
+
+import numpy as np
+import h5py
+import pytest
+
+pytest.importorskip('keras')
+from deepretina.io import ResultsWriter  # noqa: E402
+
+
+@pytest.fixture
+def results(tmpdir):
+    """An empty results file, with resizable datasets like the ones a Monitor creates"""
+    filepath = str(tmpdir.join('results.h5'))
+    with h5py.File(filepath, 'x') as f:
+        f.create_dataset('iter', (0,), maxshape=(None,), dtype='float64', fillvalue=np.nan)
+        f.create_dataset('train/cc', (0, 3), maxshape=(None, 3), dtype='float64', fillvalue=np.nan)
+        f.attrs['md5'] = 'abc'
+    return filepath
+
+
+def _row(k):
+    return {'iter': 10 * k, 'train/cc': np.full(3, k)}
+
+
+def test_buffered_rows_are_written_in_batches(results):
+    writer = ResultsWriter(results, flush_every=7)
+
+    # more rows than the initial capacity (64), so the buffers and datasets grow
+    for k in range(150):
+        writer.append(_row(k))
+
+        # the file can be read while rows are being appended, and holds every complete batch
+        with h5py.File(results, 'r') as f:
+            written = f.attrs.get('rows', 0)
+            assert written == 7 * ((k + 1) // 7)
+            np.testing.assert_array_equal(f['iter'][:written], 10 * np.arange(written))
+
+    assert writer.count == 150
+    np.testing.assert_array_equal(writer.rows()['train']['cc'], np.repeat(np.arange(150.)[:, None], 3, axis=1))
+
+    # the datasets grow geometrically, beyond the number of rows
+    with h5py.File(results, 'r') as f:
+        assert f['iter'].shape[0] > f.attrs['rows']
+        assert np.isnan(f['iter'][f.attrs['rows']:]).all()
+
+    # closing writes the remaining rows and trims the datasets
+    writer.close()
+    with h5py.File(results, 'r') as f:
+        assert f.attrs['rows'] == 150
+        assert f['iter'].shape == (150,)
+        assert f['train/cc'].shape == (150, 3)
+        np.testing.assert_array_equal(f['iter'][()], 10 * np.arange(150))
+        assert f.attrs['md5'] == 'abc'
+
+
+def test_reopen_and_truncate(results):
+    writer = ResultsWriter(results, flush_every=4)
+    for k in range(10):
+        writer.append(_row(k))
+    writer.close()
+
+    # reopening picks up where the writer left off
+    writer = ResultsWriter(results, flush_every=4)
+    assert writer.count == 10
+    np.testing.assert_array_equal(writer.rows()['iter'], 10 * np.arange(10))
+
+    # discarded rows are overwritten by the rows appended after them
+    writer.truncate(6)
+    with h5py.File(results, 'r') as f:
+        assert f.attrs['rows'] == 6
+    writer.append(_row(100))
+    writer.close()
+
+    with h5py.File(results, 'r') as f:
+        np.testing.assert_array_equal(f['iter'][()], list(10 * np.arange(6)) + [1000])
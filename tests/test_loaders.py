@@ -0,0 +1,57 @@
+"""
+Tests for the background batch loading in deepretina.loaders
+"""
+
+import time
+import numpy as np
+import pytest
+from deepretina.experiments import Experiment
+from deepretina.loaders import prefetch
+
+HISTORY = 5
+
+
+@pytest.fixture(params=[False, True], ids=['eager', 'lazy'])
+def experiment(request, write_experiment):
+    for k, filename in enumerate(('whitenoise', 'naturalscene')):
+        write_experiment('synthetic', filename, np.random.RandomState(k).randn(300, 4, 4).astype('float32'), seed=k)
+    return Experiment('synthetic', [0, 1], ['whitenoise', 'naturalscene'], ['whitenoise'], HISTORY, 16,
+                      holdout=0.1, nskip=0, lazy=request.param)
+
+
+@pytest.mark.parametrize('depth, workers', [(1, 1), (2, 3), (4, 2)])
+def test_prefetch_matches_batches(experiment, depth, workers):
+    expected = [experiment.batch(ix) for ix in experiment.batch_order(shuffle=True, seed=3)]
+
+    count = 0
+    for k, (X, y) in enumerate(prefetch(experiment, shuffle=True, depth=depth, workers=workers, seed=3)):
+
+        # the workers keep loading the next batches (into the other buffers) while this one is in use
+        time.sleep(0.002)
+        np.testing.assert_array_equal(X, expected[k][0])
+        np.testing.assert_array_equal(y, expected[k][1])
+        count += 1
+
+    assert count == len(expected) == experiment.batches_per_epoch
+
+
+def test_prefetch_reuses_buffers(experiment):
+    depth = 2
+    batches = list(prefetch(experiment, shuffle=False, depth=depth, workers=2))
+
+    # batches are views into (depth + 1) sets of buffers, so a batch is only valid until the next one
+    assert all(np.shares_memory(batches[k][0], batches[k + depth + 1][0])
+               for k in range(len(batches) - depth - 1))
+    assert not any(np.shares_memory(batches[k][0], batches[k + 1][0]) for k in range(len(batches) - 1))
+
+
+def test_prefetch_order(experiment):
+    order = experiment.batch_order(shuffle=True, seed=5)[7:]
+    for ix, (X, y) in zip(order, prefetch(experiment, shuffle=True, order=order)):
+        np.testing.assert_array_equal(y, experiment.batch(ix)[1])
+
+
+def test_prefetch_stops_early(experiment):
+    batches = prefetch(experiment, shuffle=True, depth=3, workers=2, seed=0)
+    next(batches)
+    batches.close()
@@ -0,0 +1,65 @@
+"""
+Tests for the streaming metrics in deepretina.metrics
+"""
+
+import warnings
+import numpy as np
+import pytest
+from deepretina.metrics import StreamingMetrics
+from deepretina.utils import allmetrics
+
+FUNCTIONS = ('cc', 'lli', 'rmse', 'fev')
+
+
+def _streaming(r, rhat, batchsize):
+    """Scores of the responses, accumulated over batches of the given size"""
+    scores = StreamingMetrics(FUNCTIONS)
+    for start in range(0, r.shape[0], batchsize):
+        scores.update(r[start:(start + batchsize)], rhat[start:(start + batchsize)])
+    return scores.scores()
+
+
+def _responses(kind):
+    """True and model responses, with shape (# of samples, # of cells)"""
+    rng = np.random.RandomState(0)
+    r = rng.rand(500, 3) * 4
+    rhat = r + rng.rand(500, 3)
+
+    if kind == 'constant':
+        # a constant prediction (for the first cell) and a constant response (for the second)
+        rhat[:, 0] = 0.1
+        r[:, 1] = 2.0
+
+    elif kind == 'offset':
+        # a large mean, where computing the variance from raw sums cancels catastrophically
+        r += 1e6
+        rhat += 1e6
+
+    return r, rhat
+
+
+@pytest.mark.parametrize('kind', ['random', 'constant', 'offset'])
+@pytest.mark.parametrize('batchsize', [1, 64, 500])
+def test_streaming_matches_allmetrics(kind, batchsize):
+    r, rhat = _responses(kind)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected_avg, expected = allmetrics(r, {'loss': rhat}, FUNCTIONS)
+
+        # the fev of a constant response divides by zero (-inf), which the streaming scores leave undefined
+        expected = {function: np.where(np.isfinite(scores), scores, np.nan) for function, scores in expected.items()}
+        expected_avg = {function: np.nanmean(scores) for function, scores in expected.items()}
+    actual_avg, actual = _streaming(r, rhat, batchsize)
+
+    for function in FUNCTIONS:
+        np.testing.assert_allclose(actual[function], expected[function], rtol=1e-6, atol=1e-9, err_msg=function)
+        np.testing.assert_allclose(actual_avg[function], expected_avg[function], rtol=1e-6, atol=1e-9,
+                                   err_msg=function)
+
+
+def test_constant_is_nan():
+    r, rhat = _responses('constant')
+    _, cells = _streaming(r, rhat, 64)
+    assert np.isnan(cells['cc'][0]) and np.isnan(cells['cc'][1])
+    assert np.isnan(cells['fev'][1])
+    assert np.isfinite(cells['cc'][2])
@@ -0,0 +1,206 @@
+"""
+Tests for the background file mirroring in deepretina.mirror, against a local
+directory standing in for Dropbox
+"""
+
+import os
+import threading
+import pytest
+from deepretina import mirror
+from deepretina.mirror import Mirror, TokenBucket
+
+
+class FakeClock(object):
+    """A clock that only advances when something sleeps on it"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        with self._lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.now += seconds
+            self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(mirror, 'time', fake.time)
+    monkeypatch.setattr(mirror, 'sleep', fake.sleep)
+    return fake
+
+
+@pytest.fixture
+def dirs(tmpdir):
+    """A source directory, and the (existing) directory it is mirrored to"""
+    return tmpdir.mkdir('database'), tmpdir.mkdir('dropbox')
+
+
+def _read(directory, filename):
+    with open(str(directory.join(filename)), 'rb') as f:
+        return f.read()
+
+
+def test_append_deltas(dirs):
+    source, destination = dirs
+    filepath = str(source.join('train.csv'))
+    m = Mirror(str(destination), min_interval=0)
+
+    with open(filepath, 'w') as f:
+        f.write('Epoch,Iteration\n')
+    m.push(filepath, append=True)
+    m.flush()
+    assert _read(destination, 'train.csv') == b'Epoch,Iteration\n'
+
+    for line in ('0,0\n', '0,10\n'):
+        with open(filepath, 'a') as f:
+            f.write(line)
+        m.push(filepath, append=True)
+        m.flush()
+
+    assert _read(destination, 'train.csv') == _read(source, 'train.csv')
+
+    # the first copy is a full copy, later ones only copy the appended lines
+    assert m.copies == 3
+    assert m.bytes_copied == os.path.getsize(filepath)
+    m.close()
+
+
+def test_rewrite(dirs):
+    source, destination = dirs
+    filepath = str(source.join('validation.csv'))
+    m = Mirror(str(destination), min_interval=0)
+
+    with open(filepath, 'w') as f:
+        f.write('header\n0\n1\n2\n')
+    m.push(filepath, append=True)
+    m.flush()
+
+    # truncated and rewritten (e.g. when resuming), then appended to
+    with open(filepath, 'w') as f:
+        f.write('header\n0\n')
+    m.push(filepath, append=False)
+    with open(filepath, 'a') as f:
+        f.write('5\n')
+    m.push(filepath, append=True)
+    m.close()
+
+    assert _read(destination, 'validation.csv') == b'header\n0\n5\n'
+    assert not os.path.exists(str(destination.join('validation.csv.tmp')))
+
+
+def test_append_after_external_change(dirs):
+    source, destination = dirs
+    filepath = str(source.join('train.csv'))
+    m = Mirror(str(destination), min_interval=0)
+
+    with open(filepath, 'w') as f:
+        f.write('a\n')
+    m.push(filepath, append=True)
+    m.flush()
+
+    # the mirrored file no longer matches what was copied, so the next copy is a full one
+    with open(str(destination.join('train.csv')), 'w') as f:
+        f.write('something else\n')
+    with open(filepath, 'a') as f:
+        f.write('b\n')
+    m.push(filepath, append=True)
+    m.close()
+
+    assert _read(destination, 'train.csv') == b'a\nb\n'
+
+
+def test_flush_and_close_copy_pending_files(dirs):
+    source, destination = dirs
+
+    # pushes are coalesced, and held back by min_interval until flushed
+    m = Mirror(str(destination), min_interval=3600)
+    filepaths = [str(source.join('file{}.txt'.format(k))) for k in range(3)]
+    for filepath in filepaths:
+        with open(filepath, 'w') as f:
+            f.write(filepath)
+        m.push(filepath)
+    m.flush()
+    assert sorted(os.listdir(str(destination))) == ['file0.txt', 'file1.txt', 'file2.txt']
+
+    with open(filepaths[0], 'w') as f:
+        f.write('updated')
+    m.push(filepaths[0])
+    m.push(filepaths[0])
+    m.close()
+
+    assert _read(destination, 'file0.txt') == b'updated'
+    assert m.copies == 4
+    assert not m._worker.is_alive()
+    with pytest.raises(AssertionError):
+        m.push(filepaths[1])
+
+
+def test_errors_do_not_stop_the_mirror(dirs):
+    source, destination = dirs
+    m = Mirror(str(destination), min_interval=0)
+
+    with pytest.warns(UserWarning, match='Could not copy'):
+        m.push(str(source.join('missing.txt')))
+        m.flush()
+
+    filepath = str(source.join('present.txt'))
+    with open(filepath, 'w') as f:
+        f.write('ok')
+    m.push(filepath)
+    m.close()
+    assert _read(destination, 'present.txt') == b'ok'
+
+
+def test_missing_destination(dirs):
+    source, destination = dirs
+    filepath = str(source.join('README.md'))
+    with open(filepath, 'w') as f:
+        f.write('readme')
+
+    m = Mirror(str(destination.join('missing')), min_interval=0)
+    with pytest.warns(UserWarning, match='does not exist'):
+        m.push(filepath)
+        m.close()
+    assert not destination.join('missing').check()
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(100, capacity=50)
+
+    # a burst up to the capacity does not wait
+    bucket.consume(50)
+    assert clock.slept == 0
+
+    # beyond it, waits until the debt is paid off
+    bucket.consume(100)
+    assert clock.slept == pytest.approx(1.0)
+
+    # the bucket refills (up to its capacity) while idle
+    clock.sleep(10)
+    clock.slept = 0
+    bucket.consume(50)
+    assert clock.slept == 0
+
+
+def test_rate_limit_is_shared_across_files(dirs, clock, monkeypatch):
+    source, destination = dirs
+    monkeypatch.setattr(mirror, 'CHUNK_BYTES', 1000)
+
+    # five 2 kB files at 1 kB/s (with a 1 kB burst) take 9 seconds in total
+    m = Mirror(str(destination), min_interval=0, max_bytes_per_second=1000)
+    for k in range(5):
+        filepath = str(source.join('file{}.bin'.format(k)))
+        with open(filepath, 'wb') as f:
+            f.write(b'x' * 2000)
+        m.push(filepath)
+    m.close()
+
+    assert m.bytes_copied == 10000
+    assert clock.slept == pytest.approx(9.0)